@@ -0,0 +1,767 @@
+"""
+Banco de pruebas sin red para main_post_bot.
+
+Levanta la aplicación real (build_application) contra una Bot API falsa en
+proceso que registra cada llamada e inyecta latencia, y recorre los flujos
+completos con Updates sintéticos a través de application.process_update:
+
+    python bench_post_bot.py --iterations 200 --latency-ms 5 --users 300
+
+Informa llamadas a la API por flujo, latencia p50/p99 por manejador y memoria
+por usuario, para que las regresiones se vean en números.
+
+Con --load simula N usuarios editando borradores a la vez (las updates entran
+por la update_queue, igual que con run_polling) y M publicaciones programadas
+que vencen en el mismo instante:
+
+    python bench_post_bot.py --load --users 2000 --jobs 5000 --latency-ms 20
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import queue
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from logging.handlers import QueueListener
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram import InlineKeyboardMarkup, Update
+from telegram.ext import TypeHandler
+from telegram.request import BaseRequest, RequestData
+
+import main_post_bot as bot
+
+BENCH_TOKEN = "123456789:" + "A" * 35
+BENCH_ADMIN_ID = 1000
+BENCH_TARGET_CHAT_ID = -1001234567890
+
+
+# --------- Bot API falsa ---------
+class FakeBotAPI(BaseRequest):
+    """
+    Sustituye la capa HTTP de python-telegram-bot. Serializa cada petición
+    igual que la real (json_payload), cuenta las llamadas por método y
+    devuelve respuestas mínimas válidas.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.payload_bytes = 0
+        self.files: Dict[str, bytes] = {}
+        self.channel_send_times: List[float] = []
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        read_timeout: Any = None,
+        write_timeout: Any = None,
+        connect_timeout: Any = None,
+        pool_timeout: Any = None,
+    ) -> Tuple[int, bytes]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if "/file/bot" in url:
+            self.calls["downloadFile"] += 1
+            return 200, self.files.get(url.rsplit("/", 1)[-1], b"")
+
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        params: Dict[str, Any] = {}
+        if request_data is not None:
+            self.payload_bytes += len(request_data.json_payload)
+            params = request_data.parameters
+        chat_id = params.get("chat_id")
+        if endpoint.startswith(("send", "copy")) and (
+            isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+        ):
+            self.channel_send_times.append(time.monotonic())
+        result = self._result(endpoint, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+    def _next_message(self, chat_id: Any, extra: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        self._message_id += 1
+        if isinstance(chat_id, str):
+            chat = {"id": -1, "type": "channel", "username": chat_id.lstrip("@")}
+        else:
+            chat = {"id": int(chat_id), "type": "channel" if int(chat_id) < 0 else "private"}
+        message = {"message_id": self._message_id, "date": int(time.time()), "chat": chat}
+        message.update(extra or {})
+        return message
+
+    def _result(self, endpoint: str, params: Dict[str, Any]) -> Any:
+        if endpoint == "getMe":
+            return {
+                "id": 123456789,
+                "is_bot": True,
+                "first_name": "Bench",
+                "username": "bench_bot",
+                "can_join_groups": False,
+                "can_read_all_group_messages": False,
+                "supports_inline_queries": False,
+            }
+        if endpoint == "sendMessage":
+            return self._next_message(params.get("chat_id"), {"text": params.get("text", "")})
+        if endpoint in ("sendPhoto", "sendVideo", "sendVoice", "sendDocument", "sendAnimation"):
+            return self._next_message(params.get("chat_id"), {"caption": params.get("caption", "")})
+        if endpoint == "copyMessage":
+            self._message_id += 1
+            return {"message_id": self._message_id}
+        if endpoint.startswith("editMessage"):
+            return self._next_message(params.get("chat_id", BENCH_ADMIN_ID))
+        if endpoint == "getChat":
+            chat_id = params.get("chat_id")
+            return {
+                "id": chat_id if isinstance(chat_id, int) else -1,
+                "type": "channel",
+                "title": "Bench",
+            }
+        if endpoint == "getChatMember":
+            rights = (
+                "can_be_edited", "is_anonymous", "can_manage_chat", "can_delete_messages",
+                "can_manage_video_chats", "can_restrict_members", "can_promote_members",
+                "can_change_info", "can_invite_users",
+            )
+            member = {right: False for right in rights}
+            member.update(
+                status="administrator",
+                user={"id": 123456789, "is_bot": True, "first_name": "Bench"},
+                can_post_messages=True,
+            )
+            return member
+        if endpoint == "getFile":
+            file_id = params.get("file_id", "")
+            return {
+                "file_id": file_id,
+                "file_unique_id": f"u-{file_id}",
+                "file_size": len(self.files.get(file_id, b"")),
+                "file_path": f"documents/{file_id}",
+            }
+        return True
+
+
+# --------- Updates sintéticos ---------
+class UpdateFactory:
+    def __init__(self) -> None:
+        self._update_id = 0
+        self._message_id = 0
+
+    def _ids(self) -> Tuple[int, int]:
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    @staticmethod
+    def _user(user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+
+    def _message(self, user_id: int, **fields: Any) -> Dict[str, Any]:
+        update_id, message_id = self._ids()
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+        }
+        message.update(fields)
+        return {"update_id": update_id, "message": message}
+
+    def command(self, user_id: int, command: str) -> Dict[str, Any]:
+        return self._message(
+            user_id,
+            text=command,
+            entities=[{"type": "bot_command", "offset": 0, "length": len(command.split()[0])}],
+        )
+
+    def text(self, user_id: int, text: str) -> Dict[str, Any]:
+        return self._message(user_id, text=text)
+
+    def photo(self, user_id: int, caption: str, file_unique_id: str = "banner") -> Dict[str, Any]:
+        return self._message(
+            user_id,
+            caption=caption,
+            photo=[
+                {"file_id": f"fid-{file_unique_id}-s", "file_unique_id": f"{file_unique_id}-s", "width": 90, "height": 51},
+                {"file_id": f"fid-{file_unique_id}", "file_unique_id": file_unique_id, "width": 1280, "height": 720, "file_size": 88000},
+            ],
+        )
+
+    def document(self, user_id: int, file_id: str, file_name: str) -> Dict[str, Any]:
+        return self._message(
+            user_id,
+            document={"file_id": file_id, "file_unique_id": f"u-{file_id}", "file_name": file_name},
+        )
+
+    def callback(self, user_id: int, data: str) -> Dict[str, Any]:
+        update_id, message_id = self._ids()
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": 123456789, "is_bot": True, "first_name": "Bench"},
+                    "text": "menu",
+                },
+            },
+        }
+
+
+# --------- Ejecución de flujos ---------
+class FlowRunner:
+    def __init__(self, application: Any, api: FakeBotAPI) -> None:
+        self.application = application
+        self.api = api
+        self.updates = UpdateFactory()
+        self.latencies: List[float] = []
+        self.scheduled = 0
+
+    async def feed(self, raw: Dict[str, Any]) -> None:
+        update = Update.de_json(raw, self.application.bot)
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        self.latencies.append(time.perf_counter() - started)
+
+    async def create_with_buttons(self, user_id: int) -> None:
+        u = self.updates
+        await self.feed(u.command(user_id, "/start"))
+        await self.feed(u.callback(user_id, "MENU_CREATE"))
+        await self.feed(u.photo(user_id, "📈 Señal EURUSD compra 1.0850"))
+        await self.feed(u.text(user_id, "Canal - https://t.me/canal\nRegistro - https://example.com/r"))
+        await self.feed(u.callback(user_id, "SAVE_BUTTONS_NO"))
+
+    async def flow_schedule_and_fire(self, user_id: int) -> None:
+        await self.create_with_buttons(user_id)
+        # Un minuto distinto por flujo: la misma hora tendría la misma clave en el outbox
+        self.scheduled += 1
+        when = datetime.now(bot.LOCAL_TZ) + timedelta(days=1, minutes=self.scheduled)
+        await self.feed(self.updates.callback(user_id, "MENU_SCHEDULE"))
+        await self.feed(self.updates.text(user_id, when.strftime("%Y-%m-%d %H:%M")))
+        job = bot.get_draft(user_id).job
+        if job is not None:
+            started = time.perf_counter()
+            await job.run(self.application)
+            self.latencies.append(time.perf_counter() - started)
+            job.schedule_removal()
+
+    async def flow_send_now(self, user_id: int) -> None:
+        await self.create_with_buttons(user_id)
+        await self.feed(self.updates.callback(user_id, "MENU_SEND_NOW"))
+
+    async def flow_edit_text(self, user_id: int) -> None:
+        await self.create_with_buttons(user_id)
+        for n in range(3):
+            await self.feed(self.updates.callback(user_id, "EDIT_TEXT"))
+            await self.feed(self.updates.text(user_id, f"📈 Señal EURUSD compra 1.08{50 + n}"))
+
+    async def flow_template_insert(self, user_id: int) -> None:
+        if not bot.get_templates(user_id):
+            bot.save_template_from_text(user_id, "🔔 Recordatorio: sesión en vivo hoy a las 20:00")
+        template_id = bot.get_templates(user_id)[0]["id"]
+        await self.feed(self.updates.command(user_id, "/start"))
+        await self.feed(self.updates.callback(user_id, "TEMPLATE_INSERT"))
+        await self.feed(self.updates.callback(user_id, f"TEMPLATE_INSERT_PICK_{template_id}"))
+
+    async def flow_copy_document(self, user_id: int) -> None:
+        u = self.updates
+        await self.feed(u.command(user_id, "/start"))
+        await self.feed(u.callback(user_id, "MENU_CREATE"))
+        if bot.get_templates(user_id):
+            await self.feed(u.callback(user_id, "NEWPUB_NO_TEMPLATE"))
+        await self.feed(u.document(user_id, "informe-semanal", "informe.pdf"))
+        await self.feed(u.text(user_id, "Canal - https://t.me/canal"))
+        await self.feed(u.callback(user_id, "SAVE_BUTTONS_NO"))
+        await self.feed(u.callback(user_id, "MENU_SEND_NOW"))
+
+    async def flow_batch_delete(self, user_id: int) -> None:
+        for n in range(5):
+            bot.save_template_from_text(user_id, f"Plantilla de prueba {user_id}-{n}")
+        await self.feed(self.updates.command(user_id, "/start"))
+        await self.feed(self.updates.callback(user_id, "TEMPLATE_DELETE"))
+        for tpl in bot.get_templates(user_id)[-3:]:
+            await self.feed(self.updates.callback(user_id, f"SEL_TOGGLE_{tpl['id']}"))
+        await self.feed(self.updates.callback(user_id, "SEL_APPLY"))
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def allow_bench_users(user_ids: List[int]) -> None:
+    """
+    El bot solo atiende a ADMIN_ID; para simular muchos usuarios el banco
+    sustituye la comprobación por una que admite los ids simulados.
+    """
+    allowed = frozenset(user_ids) | {BENCH_ADMIN_ID}
+
+    def is_bench_user(update: Update) -> bool:
+        user, chat = update.effective_user, update.effective_chat
+        return user is not None and chat is not None and chat.type == "private" and user.id in allowed
+
+    bot.is_admin_private = is_bench_user
+
+
+async def build_bench_application(latency: float) -> Tuple[Any, FakeBotAPI]:
+    bot.ADMIN_ID = BENCH_ADMIN_ID
+    bot.TARGET_CHAT_ID = BENCH_TARGET_CHAT_ID
+    bot.STATE_DB_PATH = ":memory:"
+    # Sin peticiones reales al widget público del canal
+    bot.ANALYTICS_CHANNEL = None
+    api = FakeBotAPI(latency)
+    application = bot.build_application(BENCH_TOKEN, request=api)
+    await application.initialize()
+    await application.start()
+    return application, api
+
+
+async def bench_flow(runner: FlowRunner, name: str, iterations: int) -> Dict[str, Any]:
+    flow = getattr(runner, f"flow_{name}")
+    runner.latencies = []
+    calls_before = Counter(runner.api.calls)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        await flow(BENCH_ADMIN_ID)
+    elapsed = time.perf_counter() - started
+    calls = runner.api.calls - calls_before
+    return {
+        "flow": name,
+        "iterations": iterations,
+        "flows_per_s": iterations / elapsed if elapsed else 0.0,
+        "api_calls_per_flow": sum(calls.values()) / iterations,
+        "api_calls_by_method": {k: v / iterations for k, v in sorted(calls.items())},
+        "handler_p50_ms": percentile(runner.latencies, 50) * 1000,
+        "handler_p99_ms": percentile(runner.latencies, 99) * 1000,
+    }
+
+
+async def bench_memory_per_user(runner: FlowRunner, users: int) -> Dict[str, Any]:
+    """Crea un borrador completo para `users` usuarios distintos y mide lo retenido."""
+    user_ids = [BENCH_ADMIN_ID + 1 + offset for offset in range(users)]
+    allow_bench_users(user_ids)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for user_id in user_ids:
+        await runner.create_with_buttons(user_id)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return {"users": users, "bytes_per_user": retained / users if users else 0.0}
+
+
+def bench_keyboard_serialization(iterations: int) -> Dict[str, Any]:
+    """
+    Coste de preparar el reply_markup de los menús fijos tal y como lo hace
+    PTB (to_dict + json.dumps): construido en cada envío frente al registro.
+    """
+    builders: Dict[str, Callable[[], InlineKeyboardMarkup]] = {
+        "main_menu": lambda: InlineKeyboardMarkup(bot.build_main_menu_keyboard()),
+        "final_action": lambda: InlineKeyboardMarkup(bot.build_final_action_keyboard()),
+    }
+    rows = []
+    for name, build in builders.items():
+        started = time.perf_counter()
+        for _ in range(iterations):
+            json.dumps(build().to_dict())
+        rebuilt = (time.perf_counter() - started) / iterations
+        started = time.perf_counter()
+        for _ in range(iterations):
+            json.dumps(bot.static_keyboard(name).to_dict())
+        cached = (time.perf_counter() - started) / iterations
+        rows.append({"keyboard": name, "rebuilt_us": rebuilt * 1e6, "cached_us": cached * 1e6})
+    return {"iterations": iterations, "keyboards": rows}
+
+
+def bench_template_render(iterations: int) -> Dict[str, Any]:
+    """Coste por envío de sustituir {variables}: plantilla compilada frente a re.sub."""
+    text = "📈 {par} en {precio} · {fecha} {hora} ({dia})\n" * 8 + "Sin variables al final."
+    values = bot.template_values(None, {"par": "EURUSD", "precio": "1.0850"})
+    pattern = bot._TEMPLATE_VAR_RE
+
+    def naive(match: Any) -> str:
+        name = match.group(1)
+        return match.group(0)[0] if name is None else values.get(name, match.group(0))
+
+    started = time.perf_counter()
+    for _ in range(iterations):
+        pattern.sub(naive, text)
+    regex = (time.perf_counter() - started) / iterations
+    bot.forget_compiled_text(text)
+    started = time.perf_counter()
+    for _ in range(iterations):
+        bot.render_template_text(text, values)
+    compiled = (time.perf_counter() - started) / iterations
+    return {"iterations": iterations, "regex_us": regex * 1e6, "compiled_us": compiled * 1e6}
+
+
+def bench_logging(iterations: int) -> Dict[str, Any]:
+    """Coste por registro en el hilo del bucle: escribir el JSON directamente o encolarlo."""
+    sink = open(os.devnull, "w", encoding="utf-8")
+    output = logging.StreamHandler(sink)
+    output.setFormatter(bot.JsonLogFormatter())
+    logger = logging.getLogger("bench.logging")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+    def measure(handler: logging.Handler) -> float:
+        logger.handlers[:] = [handler]
+        started = time.perf_counter()
+        for index in range(iterations):
+            logger.info(
+                "Publicación enviada al canal.",
+                extra={"event": "published", "message_id": index, "parts": 1},
+            )
+        return (time.perf_counter() - started) / iterations
+
+    direct = measure(output)
+    log_queue: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+    listener = QueueListener(log_queue, output)
+    listener.start()
+    try:
+        queued = measure(bot.ContextQueueHandler(log_queue))
+    finally:
+        listener.stop()
+        logger.handlers[:] = []
+        sink.close()
+    return {"iterations": iterations, "direct_us": direct * 1e6, "queued_us": queued * 1e6}
+
+
+async def bench_startup() -> Dict[str, Any]:
+    """Construcción + initialize + post_init real + primer update, con la Bot API falsa."""
+    bot.ADMIN_ID = BENCH_ADMIN_ID
+    bot.TARGET_CHAT_ID = BENCH_TARGET_CHAT_ID
+    bot.STATE_DB_PATH = ":memory:"
+    # Sin peticiones reales al widget público del canal
+    bot.ANALYTICS_CHANNEL = None
+    bot._DB["conn"] = None
+    bot._STARTUP.update(started=time.perf_counter(), ready=None, first_update=None)
+    api = FakeBotAPI()
+    application = bot.build_application(BENCH_TOKEN, request=api)
+    built = time.perf_counter() - bot._STARTUP["started"]
+    await application.initialize()
+    await bot.on_application_start(application)
+    await application.start()
+    try:
+        runner = FlowRunner(application, api)
+        await runner.feed(runner.updates.command(BENCH_ADMIN_ID, "/start"))
+    finally:
+        await application.stop()
+        await application.shutdown()
+        bot._DB["conn"] = None
+    return {
+        "built_s": built,
+        "ready_s": bot._STARTUP["ready"],
+        "first_update_s": bot._STARTUP["first_update"],
+    }
+
+
+def print_report(results: Dict[str, Any]) -> None:
+    print(f"Latencia inyectada por llamada: {results['latency_ms']:.1f} ms")
+    print(f"{'flujo':<20}{'flujos/s':>10}{'API/flujo':>11}{'p50 ms':>9}{'p99 ms':>9}")
+    for row in results["flows"]:
+        print(
+            f"{row['flow']:<20}{row['flows_per_s']:>10.1f}{row['api_calls_per_flow']:>11.1f}"
+            f"{row['handler_p50_ms']:>9.3f}{row['handler_p99_ms']:>9.3f}"
+        )
+        methods = ", ".join(f"{k}={v:g}" for k, v in row["api_calls_by_method"].items())
+        print(f"{'':<20}{methods}")
+    memory = results["memory"]
+    print(f"Memoria por usuario: {memory['bytes_per_user'] / 1024:.1f} KiB ({memory['users']} usuarios)")
+    startup = results["startup"]
+    print(
+        f"Arranque: app construida {startup['built_s'] * 1000:.1f} ms · lista "
+        f"{startup['ready_s'] * 1000:.1f} ms · primer update {startup['first_update_s'] * 1000:.1f} ms"
+    )
+    for row in results["keyboards"]["keyboards"]:
+        print(
+            f"Teclado {row['keyboard']}: {row['rebuilt_us']:.1f} µs construido "
+            f"vs {row['cached_us']:.1f} µs registro"
+        )
+    render = results["render"]
+    print(
+        f"Variables de plantilla: {render['regex_us']:.1f} µs re.sub "
+        f"vs {render['compiled_us']:.1f} µs compilada"
+    )
+    logs = results["logging"]
+    print(
+        f"Registro JSON: {logs['direct_us']:.1f} µs escritura directa "
+        f"vs {logs['queued_us']:.1f} µs en cola"
+    )
+
+
+async def run_benchmarks(iterations: int, latency_ms: float, users: int) -> Dict[str, Any]:
+    startup = await bench_startup()
+    application, api = await build_bench_application(latency_ms / 1000.0)
+    runner = FlowRunner(application, api)
+    try:
+        flows = [
+            await bench_flow(runner, name, iterations)
+            for name in (
+                "schedule_and_fire",
+                "send_now",
+                "edit_text",
+                "template_insert",
+                "copy_document",
+                "batch_delete",
+            )
+        ]
+        memory = await bench_memory_per_user(runner, users)
+    finally:
+        await application.stop()
+        await application.shutdown()
+    keyboards = bench_keyboard_serialization(max(iterations, 1000))
+    render = bench_template_render(max(iterations, 1000))
+    logs = bench_logging(max(iterations, 1000))
+    return {
+        "latency_ms": latency_ms,
+        "startup": startup,
+        "flows": flows,
+        "memory": memory,
+        "keyboards": keyboards,
+        "render": render,
+        "logging": logs,
+    }
+
+
+# --------- Prueba de carga ---------
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/status", encoding="ascii") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class LoopLagMonitor:
+    """Mide cuánto se retrasa un sleep corto: retraso = bucle de eventos ocupado."""
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - started - self.interval))
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+async def wait_until(
+    predicate: Callable[[], bool],
+    timeout: float,
+    on_tick: Optional[Callable[[], None]] = None,
+) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        if on_tick is not None:
+            on_tick()
+        await asyncio.sleep(0.005)
+    return True
+
+
+def draft_editing_session(updates: UpdateFactory, user_id: int) -> List[Dict[str, Any]]:
+    return [
+        updates.command(user_id, "/start"),
+        updates.callback(user_id, "MENU_CREATE"),
+        updates.photo(user_id, "📈 Señal EURUSD compra 1.0850", file_unique_id=f"banner{user_id % 50}"),
+        updates.text(user_id, "Canal - https://t.me/canal\nRegistro - https://example.com/r"),
+        updates.callback(user_id, "SAVE_BUTTONS_NO"),
+        updates.callback(user_id, "EDIT_TEXT"),
+        updates.text(user_id, "📈 Señal EURUSD compra 1.0855 (actualizada)"),
+        updates.callback(user_id, "BACK_TO_MENU"),
+    ]
+
+
+async def run_load_test(
+    users: int, jobs: int, latency_ms: float, timeout: float
+) -> Dict[str, Any]:
+    application, api = await build_bench_application(latency_ms / 1000.0)
+    user_ids = [BENCH_ADMIN_ID + 1 + offset for offset in range(users)]
+    allow_bench_users(user_ids)
+
+    processed = {"count": 0}
+
+    async def count_update(update: object, context: Any) -> None:
+        processed["count"] += 1
+
+    application.add_handler(TypeHandler(Update, count_update), group=99)
+    monitor = LoopLagMonitor()
+    monitor.start()
+    results: Dict[str, Any] = {"users": users, "jobs": jobs, "latency_ms": latency_ms}
+
+    try:
+        # Fase 1: N usuarios editando borradores, intercalados como llegarían
+        gc.collect()
+        rss_start = current_rss_bytes()
+        updates = UpdateFactory()
+        sessions = [draft_editing_session(updates, user_id) for user_id in user_ids]
+        raw_updates = [step for round_ in zip(*sessions) for step in round_]
+        started = time.perf_counter()
+        for raw in raw_updates:
+            await application.update_queue.put(Update.de_json(raw, application.bot))
+        drained = await wait_until(lambda: processed["count"] >= len(raw_updates), timeout)
+        elapsed = time.perf_counter() - started
+        gc.collect()
+        rss_drafts = current_rss_bytes()
+        results["updates"] = {
+            "total": len(raw_updates),
+            "processed": processed["count"],
+            "completed": drained,
+            "seconds": elapsed,
+            "updates_per_s": processed["count"] / elapsed if elapsed else 0.0,
+            "api_calls": api.total_calls(),
+            "rss_growth_bytes": rss_drafts - rss_start,
+            "rss_per_user_bytes": (rss_drafts - rss_start) / users if users else 0.0,
+            "active_drafts": len(bot.DRAFTS),
+        }
+
+        # Fase 2: M publicaciones programadas para el mismo instante
+        lead = 1.0
+        fire_at = datetime.now(timezone.utc) + timedelta(seconds=lead)
+        fire_mono = time.monotonic() + lead
+        sends_before = len(api.channel_send_times)
+        for index in range(jobs):
+            application.job_queue.run_once(
+                bot.send_scheduled_publication,
+                when=fire_at,
+                data={"user_id": user_ids[index % users]},
+            )
+        backlog = {"max": 0}
+
+        def sample_backlog() -> None:
+            if time.monotonic() >= fire_mono:
+                pending = jobs - (len(api.channel_send_times) - sends_before)
+                backlog["max"] = max(backlog["max"], pending)
+
+        monitor.samples.clear()
+        fired_all = await wait_until(
+            lambda: len(api.channel_send_times) - sends_before >= jobs,
+            lead + timeout,
+            on_tick=sample_backlog,
+        )
+        send_times = api.channel_send_times[sends_before:]
+        drain = (send_times[-1] - fire_mono) if send_times else 0.0
+        results["jobs_phase"] = {
+            "scheduled": jobs,
+            "sent": len(send_times),
+            "completed": fired_all,
+            "max_backlog": backlog["max"],
+            "drain_seconds": drain,
+            "sends_per_s": len(send_times) / drain if drain > 0 else 0.0,
+            "rss_after_bytes": current_rss_bytes(),
+        }
+    finally:
+        await monitor.stop()
+        await application.stop()
+        await application.shutdown()
+
+    results["loop_lag_ms"] = {
+        "p50": percentile(monitor.samples, 50) * 1000,
+        "p99": percentile(monitor.samples, 99) * 1000,
+        "max": max(monitor.samples, default=0.0) * 1000,
+    }
+    return results
+
+
+def print_load_report(results: Dict[str, Any]) -> None:
+    upd = results["updates"]
+    jobs = results["jobs_phase"]
+    lag = results["loop_lag_ms"]
+    print(
+        f"Carga: {results['users']} usuarios, {results['jobs']} jobs, "
+        f"latencia API {results['latency_ms']:.1f} ms"
+    )
+    print(
+        f"Updates: {upd['processed']}/{upd['total']} en {upd['seconds']:.2f}s "
+        f"({upd['updates_per_s']:.0f}/s), {upd['api_calls']} llamadas API"
+    )
+    print(
+        f"RSS: +{upd['rss_growth_bytes'] / 1048576:.1f} MiB "
+        f"({upd['rss_per_user_bytes'] / 1024:.1f} KiB/usuario), "
+        f"borradores activos {upd['active_drafts']}"
+    )
+    print(
+        f"Jobs: {jobs['sent']}/{jobs['scheduled']} enviados, backlog máx {jobs['max_backlog']}, "
+        f"vaciado en {jobs['drain_seconds']:.2f}s ({jobs['sends_per_s']:.0f} envíos/s)"
+    )
+    print(f"Lag del bucle (fase jobs): p50 {lag['p50']:.2f} ms, p99 {lag['p99']:.2f} ms, máx {lag['max']:.2f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--load", action="store_true", help="modo prueba de carga")
+    parser.add_argument("--jobs", type=int, default=1000, help="publicaciones simultáneas (--load)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="espera máxima por fase (--load)")
+    parser.add_argument("--json", dest="json_path", help="guardar resultados en este archivo")
+    args = parser.parse_args()
+
+    if args.load:
+        results = asyncio.run(
+            run_load_test(args.users, args.jobs, args.latency_ms, args.timeout)
+        )
+        print_load_report(results)
+    else:
+        results = asyncio.run(run_benchmarks(args.iterations, args.latency_ms, args.users))
+        print_report(results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
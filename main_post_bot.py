@@ -1,62 +1,272 @@
+import asyncio
 import logging
 import os
 import copy
+import random
+import csv
+import gzip
+import hashlib
+import heapq
+import json
+import queue
+import re
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextvars import ContextVar
+from itertools import count, islice
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Any, Optional, List
+from html.parser import HTMLParser
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Any, Optional, List, Tuple
 
+import httpx
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    MessageEntity,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    ApplicationHandlerStop,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    TypeHandler,
     filters,
 )
 
 # Estructuras en memoria
-DRAFTS: Dict[int, Dict[str, Any]] = {}
+DRAFTS: Dict[int, "Draft"] = {}
 DEFAULTS: Dict[int, Dict[str, Any]] = {}
 
 ADMIN_ID: int = 0
 TARGET_CHAT_ID: Any = None
 
+# Zona horaria en la que el admin escribe las fechas (UTC-5)
+LOCAL_TZ = timezone(timedelta(hours=-5))
+
+
+# Estado por usuario: se guarda en disco en segundo plano y los usuarios
+# inactivos se expulsan de memoria (se recargan al volver a escribir).
+STATE_DB_PATH = "postbot_state.sqlite3"
+STATE_IDLE_TTL_SECONDS = 30 * 60
+STATE_MAX_ACTIVE_USERS = 500
+STATE_MAINTENANCE_INTERVAL_SECONDS = 60
+
+# user_id -> último acceso (monotonic); el primero es el menos reciente
+_USER_LAST_ACCESS: "OrderedDict[int, float]" = OrderedDict()
+_DIRTY_USERS: set = set()
+_STATE_STATS: Dict[str, int] = {"evicted": 0, "restored": 0, "flushed": 0}
+
+# Parada ordenada (SIGTERM): plazo para terminar envíos en curso y ventana en
+# la que se consideran "debidas durante el reinicio" las publicaciones programadas.
+DRAIN_TIMEOUT_SECONDS = 20
+RESTART_WINDOW_SECONDS = 5 * 60
+_SHUTDOWN_STATE: Dict[str, Any] = {"draining": False, "inflight_sends": 0}
+
+# Estadísticas del canal: usuario público del canal (sin @) para leer las vistas.
+# None = desactivadas (no se hace ninguna petición a t.me)
+ANALYTICS_CHANNEL: Optional[str] = None
+ANALYTICS_TICK_SECONDS = 60
+ANALYTICS_BATCH_SIZE = 30
+ANALYTICS_CONCURRENCY = 3
+
+# Tiempos de arranque en segundos desde que empieza main()
+_STARTUP: Dict[str, Optional[float]] = {
+    "started": None,
+    "config": None,
+    "built": None,
+    "ready": None,
+    "first_update": None,
+}
+
+# Reintentos de envío al canal (backoff exponencial con jitter)
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY_SECONDS = 2.0
+RETRY_MAX_DELAY_SECONDS = 300.0
+
+# Outbox: los registros enviados se conservan este tiempo para detectar duplicados
+OUTBOX_RETENTION_SECONDS = 7 * 24 * 3600
+
 
 # --------- Utilidades de estado y estructuras ---------
+class Draft:
+    """Borrador de publicación (también se usa como copia para envíos programados)."""
+
+    __slots__ = (
+        "type",
+        "file_id",
+        "text",
+        "buttons",
+        "scheduled_at",
+        "job",
+        "template_id",
+        "media_uid",
+        "draft_id",
+        "name",
+        "entities",
+        "source",
+    )
+
+    def __init__(
+        self,
+        type: Optional[str] = None,
+        file_id: Optional[str] = None,
+        text: str = "",
+        buttons: Optional[List[List[InlineKeyboardButton]]] = None,
+        scheduled_at: Optional[datetime] = None,
+        template_id: Optional[int] = None,
+        media_uid: Optional[str] = None,
+        draft_id: Optional[int] = None,
+        name: str = "",
+        entities: Tuple[MessageEntity, ...] = (),
+        source: Optional[Tuple[int, int, str]] = None,
+    ) -> None:
+        self.type = type
+        self.file_id = file_id
+        self.text = text
+        self.buttons = buttons if buttons is not None else []
+        self.scheduled_at = scheduled_at
+        self.job: Any = None
+        self.template_id = template_id
+        self.media_uid = media_uid
+        self.draft_id = draft_id
+        self.name = name
+        # Formato del texto (negrita, enlaces...) con offsets en UTF-16
+        self.entities = entities
+        # Tipo "copy": (chat_id, message_id, tipo original) del mensaje del admin
+        self.source = source
+
+    def reset(self) -> None:
+        self.__init__()  # type: ignore[misc]
+
+    def copy(self) -> "Draft":
+        # Los InlineKeyboardButton son inmutables: basta con copiar las filas
+        return Draft(
+            type=self.type,
+            file_id=self.file_id,
+            text=self.text,
+            buttons=[list(row) for row in self.buttons],
+            scheduled_at=self.scheduled_at,
+            template_id=self.template_id,
+            media_uid=self.media_uid,
+            entities=self.entities,
+            source=self.source,
+        )
+
+    def to_data(self) -> Dict[str, Any]:
+        return {
+            "type": self.type,
+            "file_id": self.file_id,
+            "text": self.text,
+            "buttons": buttons_to_data(self.buttons),
+            "scheduled_at": self.scheduled_at.isoformat() if self.scheduled_at else None,
+            "template_id": self.template_id,
+            "media_uid": self.media_uid,
+            "draft_id": self.draft_id,
+            "name": self.name,
+            "entities": entities_to_data(self.entities),
+            "source": list(self.source) if self.source else None,
+        }
+
+    @classmethod
+    def from_data(cls, data: Dict[str, Any]) -> "Draft":
+        scheduled_at = data.get("scheduled_at")
+        return cls(
+            type=data.get("type"),
+            file_id=data.get("file_id"),
+            text=data.get("text") or "",
+            buttons=buttons_from_data(data.get("buttons")),
+            scheduled_at=datetime.fromisoformat(scheduled_at) if scheduled_at else None,
+            template_id=data.get("template_id"),
+            media_uid=data.get("media_uid"),
+            draft_id=data.get("draft_id"),
+            name=data.get("name") or "",
+            entities=entities_from_data(data.get("entities")),
+            source=tuple(data["source"]) if data.get("source") else None,  # type: ignore[arg-type]
+        )
+
+
+class DraftIndex:
+    """
+    Borradores guardados de un usuario aparte del activo (DRAFTS[user_id]).
+    `shelved` va por id en orden de uso; `scheduled` guarda la hora de los
+    que tienen envío programado para resumirlos sin recorrerlos todos.
+    """
+
+    __slots__ = ("shelved", "scheduled", "seq")
+
+    def __init__(self, seq: int = 0) -> None:
+        self.shelved: "OrderedDict[int, Draft]" = OrderedDict()
+        self.scheduled: Dict[int, datetime] = {}
+        self.seq = seq
+
+
+DRAFT_INDEX: Dict[int, DraftIndex] = {}
+
+
+def touch_user(user_id: int) -> None:
+    _USER_LAST_ACCESS[user_id] = time.monotonic()
+    _USER_LAST_ACCESS.move_to_end(user_id)
+
+
+def mark_user_dirty(user_id: int) -> None:
+    """El estado del usuario cambió: se guarda en el próximo volcado."""
+    _DIRTY_USERS.add(user_id)
+
+
 def init_user_structs(user_id: int) -> None:
+    touch_user(user_id)
+    if user_id not in DRAFTS and user_id not in DEFAULTS:
+        restore_user_state(user_id)
     if user_id not in DRAFTS:
-        DRAFTS[user_id] = {
-            "type": None,
-            "file_id": None,
-            "text": "",
-            "buttons": [],
-            "scheduled_at": None,
-            "job": None,
-        }
+        DRAFTS[user_id] = Draft()
+    if user_id not in DRAFT_INDEX:
+        DRAFT_INDEX[user_id] = DraftIndex()
     if user_id not in DEFAULTS:
         DEFAULTS[user_id] = {
             "buttons": [],
-            "templates": [],  # cada item: {"id": int, "title": str, "text": str}
+            "templates": [],  # cada item: {"id": int, "title": str, "text": str, "hash": str}
+            "template_ids": {},  # id -> plantilla
+            "template_hashes": {},  # hash del texto -> id
+            "template_seq": 0,  # los ids nunca se reutilizan
+            "variables": {},  # valores de {variable} propios del usuario
+            "format": "",  # "html": el texto escrito se interpreta como HTML
+            "copy_mode": False,  # publicar con copy_message también foto/video/voz
         }
     else:
         if "templates" not in DEFAULTS[user_id]:
             DEFAULTS[user_id]["templates"] = []
+        if "variables" not in DEFAULTS[user_id]:
+            DEFAULTS[user_id]["variables"] = {}
+        if "format" not in DEFAULTS[user_id]:
+            DEFAULTS[user_id]["format"] = ""
+        if "copy_mode" not in DEFAULTS[user_id]:
+            DEFAULTS[user_id]["copy_mode"] = False
+        if "template_ids" not in DEFAULTS[user_id]:
+            _reindex_templates(DEFAULTS[user_id])
 
 
-def draft_has_content(draft: Optional[Dict[str, Any]]) -> bool:
+def draft_has_content(draft: Optional[Draft]) -> bool:
     if not draft:
         return False
-    if draft.get("type"):
+    if draft.type:
         return True
-    text = draft.get("text") or ""
-    return text.strip() != ""
+    return draft.text.strip() != ""
 
 
-def get_draft(user_id: int) -> Dict[str, Any]:
+def get_draft(user_id: int) -> Draft:
     init_user_structs(user_id)
     return DRAFTS[user_id]
 
@@ -66,6 +276,404 @@ def get_defaults(user_id: int) -> Dict[str, Any]:
     return DEFAULTS[user_id]
 
 
+# --------- Varios borradores ---------
+def get_draft_index(user_id: int) -> DraftIndex:
+    init_user_structs(user_id)
+    return DRAFT_INDEX[user_id]
+
+
+def draft_ref(user_id: int, draft: Draft) -> int:
+    """Id del borrador dentro del usuario; se asigna la primera vez que hace falta."""
+    if draft.draft_id is None:
+        index = get_draft_index(user_id)
+        index.seq += 1
+        draft.draft_id = index.seq
+        mark_user_dirty(user_id)
+    return draft.draft_id
+
+
+def draft_label(draft: Draft) -> str:
+    if draft.name:
+        return draft.name
+    if draft.draft_id is not None:
+        return f"Borrador {draft.draft_id}"
+    return "Sin nombre"
+
+
+def find_user_draft(user_id: int, draft_id: Optional[int]) -> Optional[Draft]:
+    """Busca sin crear estado: el activo si coincide el id (o no hay id), si no uno guardado."""
+    active = DRAFTS.get(user_id)
+    if active is not None and (draft_id is None or active.draft_id == draft_id):
+        return active
+    index = DRAFT_INDEX.get(user_id)
+    if index is None or draft_id is None:
+        return None
+    return index.shelved.get(draft_id)
+
+
+def note_draft_schedule(user_id: int, draft: Draft) -> None:
+    """
+    Actualiza el índice de programados después de cambiar draft.job y lo deja
+    en disco: la fila de draft_schedules y el borrador con su contenido.
+    """
+    invalidate_slots()
+    mark_user_dirty(user_id)
+    index = get_draft_index(user_id)
+    if draft.job is not None and draft.scheduled_at is not None:
+        draft_id = draft_ref(user_id, draft)
+        index.scheduled[draft_id] = draft.scheduled_at
+        conn = _db()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO draft_schedules (user_id, draft_id, due_at, title)"
+                " VALUES (?, ?, ?, ?)",
+                (
+                    user_id,
+                    draft_id,
+                    draft.scheduled_at.replace(tzinfo=LOCAL_TZ).timestamp(),
+                    f"{draft_label(draft)}: {_make_template_title(draft.text, 0)}",
+                ),
+            )
+        flush_user_states([user_id])
+    elif draft.draft_id is not None:
+        drop_draft_schedule(user_id, draft.draft_id)
+
+
+def drop_draft_schedule(user_id: int, draft_id: int) -> None:
+    index = DRAFT_INDEX.get(user_id)
+    if index is not None:
+        index.scheduled.pop(draft_id, None)
+    conn = _db()
+    with conn:
+        conn.execute(
+            "DELETE FROM draft_schedules WHERE user_id = ? AND draft_id = ?",
+            (user_id, draft_id),
+        )
+
+
+def _shelve_active_draft(user_id: int) -> None:
+    active = get_draft(user_id)
+    if draft_has_content(active) or active.job is not None:
+        DRAFT_INDEX[user_id].shelved[draft_ref(user_id, active)] = active
+        mark_user_dirty(user_id)
+
+
+def new_named_draft(user_id: int, name: str) -> Draft:
+    """Guarda el borrador activo (si tiene algo) y empieza uno vacío."""
+    _shelve_active_draft(user_id)
+    draft = Draft(name=name)
+    draft_ref(user_id, draft)
+    DRAFTS[user_id] = draft
+    mark_user_dirty(user_id)
+    return draft
+
+
+def switch_draft(user_id: int, draft_id: int) -> Optional[Draft]:
+    index = get_draft_index(user_id)
+    target = index.shelved.pop(draft_id, None)
+    if target is None:
+        return None
+    _shelve_active_draft(user_id)
+    DRAFTS[user_id] = target
+    mark_user_dirty(user_id)
+    return target
+
+
+def delete_shelved_draft(user_id: int, draft_id: int) -> bool:
+    index = get_draft_index(user_id)
+    draft = index.shelved.pop(draft_id, None)
+    if draft is None:
+        return False
+    if draft.job is not None:
+        try:
+            draft.job.schedule_removal()
+        except Exception:
+            pass
+        draft.job = None
+    drop_draft_schedule(user_id, draft_id)
+    mark_user_dirty(user_id)
+    return True
+
+
+# --------- Almacenamiento ---------
+_DB: Dict[str, Any] = {"conn": None}
+
+
+def _db() -> sqlite3.Connection:
+    conn = _DB["conn"]
+    if conn is None:
+        conn = sqlite3.connect(STATE_DB_PATH)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_state ("
+            " user_id INTEGER PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS schedule_entries ("
+            " id INTEGER PRIMARY KEY,"
+            " data TEXT NOT NULL)"
+        )
+        # Reintentos de envío pendientes: se retoman al arrancar
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS send_retries ("
+            " key TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL)"
+        )
+        # Contadores que deben sobrevivir a los reinicios (p. ej. schedule_seq)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta ("
+            " key TEXT PRIMARY KEY,"
+            " value INTEGER NOT NULL)"
+        )
+        # Borradores programados: se escribe al programar y se borra al enviar o
+        # cancelar, así sobreviven aunque el proceso muera sin pasar por post_stop
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS draft_schedules ("
+            " user_id INTEGER NOT NULL,"
+            " draft_id INTEGER NOT NULL,"
+            " due_at REAL NOT NULL,"
+            " title TEXT NOT NULL,"
+            " PRIMARY KEY (user_id, draft_id))"
+        )
+        # Instantánea al parar de versiones anteriores: solo se migra al arrancar
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS restart_due ("
+            " kind TEXT NOT NULL,"
+            " user_id INTEGER NOT NULL,"
+            " ref INTEGER,"
+            " due_at REAL NOT NULL,"
+            " title TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " key TEXT PRIMARY KEY,"
+            " state TEXT NOT NULL,"
+            " message_id INTEGER,"
+            " title TEXT NOT NULL,"
+            " error TEXT,"
+            " reviewed INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        # Historial: solo se añaden filas. El contenido se guarda una vez por hash.
+        # Biblioteca de medios; pos conserva el orden de uso (el mayor, el más reciente)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS media_library ("
+            " pos INTEGER PRIMARY KEY,"
+            " uid TEXT NOT NULL,"
+            " data TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " sent_at REAL NOT NULL,"
+            " user_id INTEGER,"
+            " target TEXT NOT NULL,"
+            " message_id INTEGER,"
+            " content_hash TEXT NOT NULL,"
+            " template_id INTEGER,"
+            " kind TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS history_sent_at ON history (sent_at)")
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS history_template ON history (template_id, id)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS history_content ("
+            " hash TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL)"
+        )
+        # Estadísticas: estado de seguimiento por publicación y serie temporal
+        # de vistas (solo se guarda una muestra cuando cambia el valor)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS post_tracking ("
+            " history_id INTEGER PRIMARY KEY,"
+            " message_id INTEGER NOT NULL,"
+            " sent_at REAL NOT NULL,"
+            " next_check REAL,"
+            " last_views INTEGER,"
+            " unchanged INTEGER NOT NULL DEFAULT 0)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS post_tracking_next ON post_tracking (next_check)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS post_views ("
+            " history_id INTEGER NOT NULL,"
+            " ts INTEGER NOT NULL,"
+            " views INTEGER NOT NULL,"
+            " PRIMARY KEY (history_id, ts)) WITHOUT ROWID"
+        )
+        conn.commit()
+        _DB["conn"] = conn
+    return conn
+
+
+def _user_state_data(user_id: int) -> Dict[str, Any]:
+    defaults = DEFAULTS.get(user_id) or {}
+    draft = DRAFTS.get(user_id)
+    index = DRAFT_INDEX.get(user_id)
+    return {
+        "draft": draft.to_data() if draft is not None else None,
+        "drafts": [d.to_data() for d in index.shelved.values()] if index else [],
+        "draft_seq": index.seq if index else 0,
+        "buttons": buttons_to_data(defaults.get("buttons") or []),
+        "templates": [
+            {
+                "id": tpl["id"],
+                "title": tpl["title"],
+                "text": tpl["text"],
+                "entities": entities_to_data(tpl.get("entities") or ()),
+            }
+            for tpl in defaults.get("templates", [])
+        ],
+        "template_seq": defaults.get("template_seq", 0),
+        "variables": defaults.get("variables") or {},
+        "format": defaults.get("format") or "",
+        "copy_mode": bool(defaults.get("copy_mode")),
+    }
+
+
+def flush_user_states(user_ids: Optional[List[int]] = None) -> int:
+    """Guarda en una sola transacción el estado de los usuarios indicados (o de los modificados)."""
+    pending = list(_DIRTY_USERS) if user_ids is None else user_ids
+    rows = [
+        (user_id, json.dumps(_user_state_data(user_id), ensure_ascii=False), time.time())
+        for user_id in pending
+        if user_id in DRAFTS or user_id in DEFAULTS
+    ]
+    if rows:
+        conn = _db()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO user_state (user_id, data, updated_at) VALUES (?, ?, ?)",
+                rows,
+            )
+    _DIRTY_USERS.difference_update(pending)
+    _STATE_STATS["flushed"] += len(rows)
+    return len(rows)
+
+
+def restore_user_state(user_id: int) -> bool:
+    row = _db().execute(
+        "SELECT data FROM user_state WHERE user_id = ?", (user_id,)
+    ).fetchone()
+    if row is None:
+        return False
+    data = json.loads(row[0])
+    if data.get("draft"):
+        DRAFTS[user_id] = Draft.from_data(data["draft"])
+    index = DraftIndex(data.get("draft_seq", 0))
+    for item in data.get("drafts") or []:
+        shelved = Draft.from_data(item)
+        if shelved.draft_id is not None:
+            index.shelved[shelved.draft_id] = shelved
+    DRAFT_INDEX[user_id] = index
+    defaults: Dict[str, Any] = {
+        "buttons": buttons_from_data(data.get("buttons")),
+        "templates": data.get("templates") or [],
+        "template_seq": data.get("template_seq", 0),
+        "variables": data.get("variables") or {},
+        "format": data.get("format") or "",
+        "copy_mode": bool(data.get("copy_mode")),
+    }
+    _reindex_templates(defaults)
+    DEFAULTS[user_id] = defaults
+    _STATE_STATS["restored"] += 1
+    return True
+
+
+def _forget_user(user_id: int, application: Optional[Application]) -> None:
+    DRAFTS.pop(user_id, None)
+    DRAFT_INDEX.pop(user_id, None)
+    DEFAULTS.pop(user_id, None)
+    _PREVIEWS.pop(user_id, None)
+    _USER_LAST_ACCESS.pop(user_id, None)
+    if application is not None and user_id in application.user_data:
+        application.drop_user_data(user_id)
+    _STATE_STATS["evicted"] += 1
+
+
+def evict_idle_users(
+    application: Optional[Application] = None, now: Optional[float] = None
+) -> int:
+    """
+    Expulsa a los usuarios inactivos más de STATE_IDLE_TTL_SECONDS y, si aun
+    así se supera STATE_MAX_ACTIVE_USERS, a los menos recientes. Los que
+    tienen una publicación programada pendiente (borrador, recurrente o de
+    calendario) se conservan.
+    """
+    now = time.monotonic() if now is None else now
+    over_budget = len(_USER_LAST_ACCESS) - STATE_MAX_ACTIVE_USERS
+    victims: List[int] = []
+    with_entries = {entry["user_id"] for entry in SCHEDULE_ENTRIES.values()}
+    for user_id, last_access in _USER_LAST_ACCESS.items():
+        if now - last_access < STATE_IDLE_TTL_SECONDS and len(victims) >= over_budget:
+            break
+        if user_id in with_entries:
+            continue
+        draft = DRAFTS.get(user_id)
+        if draft is not None and draft.job is not None:
+            continue
+        index = DRAFT_INDEX.get(user_id)
+        if index is not None and index.scheduled:
+            continue
+        victims.append(user_id)
+    flush_user_states(victims)
+    for user_id in victims:
+        _forget_user(user_id, application)
+    return len(victims)
+
+
+async def maintain_user_state(context: ContextTypes.DEFAULT_TYPE) -> None:
+    begin_job_trace(context)
+    try:
+        flush_user_states()
+        if _SCHEDULE_STORE["dirty"]:
+            save_schedule_entries()
+        if _MEDIA_STORE["dirty"]:
+            save_media_library()
+        prune_outbox()
+        evicted = evict_idle_users(context.application)
+        if evicted:
+            logging.info("Usuarios inactivos expulsados de memoria: %s", evicted)
+    except Exception as exc:
+        logging.error("Error guardando el estado de usuarios: %s", exc)
+
+
+def _approx_size(obj: Any, seen: Optional[set] = None) -> int:
+    """Tamaño aproximado en bytes de una estructura (recorre contenedores y __slots__)."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_approx_size(k, seen) + _approx_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_approx_size(item, seen) for item in obj)
+    elif isinstance(obj, Draft):
+        size += sum(_approx_size(getattr(obj, slot), seen) for slot in Draft.__slots__)
+    return size
+
+
+def memory_footprint(application: Optional[Application] = None) -> Dict[str, Any]:
+    stored = _db().execute("SELECT COUNT(*) FROM user_state").fetchone()[0]
+    return {
+        "active_users": len(_USER_LAST_ACCESS),
+        "stored_users": stored,
+        "dirty_users": len(_DIRTY_USERS),
+        "drafts_bytes": _approx_size(DRAFTS),
+        "defaults_bytes": _approx_size(DEFAULTS),
+        "user_data_entries": len(application.user_data) if application is not None else 0,
+        "media_library": len(MEDIA_LIBRARY),
+        "schedule_entries": len(SCHEDULE_ENTRIES),
+        **_STATE_STATS,
+    }
+
+
 def is_admin_private(update: Update) -> bool:
     if update.effective_user is None or update.effective_chat is None:
         return False
@@ -120,26 +728,882 @@ def _make_template_title(text: str, index: int) -> str:
     return title
 
 
-def save_template_from_text(user_id: int, text: str) -> str:
+def template_content_hash(text: str, entities: Tuple[MessageEntity, ...] = ()) -> str:
+    """Mismo texto con distinto formato cuenta como otra plantilla."""
+    content = text if not entities else text + "\0" + repr(entities_key(entities))
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def strip_with_entities(
+    text: str, entities: Tuple[MessageEntity, ...]
+) -> Tuple[str, Tuple[MessageEntity, ...]]:
+    """text.strip() con las entidades recortadas y desplazadas a la par."""
+    stripped = text.strip()
+    if not entities or stripped == text:
+        return stripped, entities
+    start = utf16_len(text[: len(text) - len(text.lstrip())])
+    return stripped, slice_entities(entities, start, start + utf16_len(stripped))
+
+
+def _reindex_templates(defaults: Dict[str, Any]) -> None:
+    """Reconstruye los índices de plantillas (datos antiguos o importados)."""
+    templates = defaults.setdefault("templates", [])
+    seq = max([int(tpl.get("id") or 0) for tpl in templates] + [0])
+    ids: Dict[int, Dict[str, Any]] = {}
+    hashes: Dict[str, int] = {}
+    for tpl in templates:
+        if not tpl.get("id") or tpl["id"] in ids:
+            seq += 1
+            tpl["id"] = seq
+        tpl["text"] = sys.intern(tpl["text"])
+        # En disco (y en datos antiguos o importados) llegan como lista de dicts
+        if not isinstance(tpl.get("entities"), tuple):
+            tpl["entities"] = entities_from_data(tpl.get("entities"))
+        tpl["hash"] = template_content_hash(tpl["text"], tpl["entities"])
+        ids[tpl["id"]] = tpl
+        hashes.setdefault(tpl["hash"], tpl["id"])
+    defaults["template_ids"] = ids
+    defaults["template_hashes"] = hashes
+    defaults["template_seq"] = max(seq, defaults.get("template_seq", 0))
+
+
+def find_template_by_text(
+    user_id: int, text: str, entities: Tuple[MessageEntity, ...] = ()
+) -> Optional[Dict[str, Any]]:
+    defaults = get_defaults(user_id)
+    template_id = defaults["template_hashes"].get(template_content_hash(text, entities))
+    if template_id is None:
+        return None
+    return defaults["template_ids"].get(template_id)
+
+
+def save_template_from_text(
+    user_id: int, text: str, entities: Tuple[MessageEntity, ...] = ()
+) -> str:
+    """
+    Guarda el texto (con su formato) como plantilla. Si ya existe una plantilla
+    con el mismo contenido no se duplica: se devuelve el título de la existente.
+    """
     defaults = get_defaults(user_id)
-    templates: List[Dict[str, str]] = defaults.get("templates", [])
-    idx = len(templates) + 1
-    title = _make_template_title(text, idx)
-    templates.append({"id": idx, "title": title, "text": text})
-    defaults["templates"] = templates
+    content_hash = template_content_hash(text, entities)
+    existing_id = defaults["template_hashes"].get(content_hash)
+    if existing_id is not None:
+        return defaults["template_ids"][existing_id]["title"]
+
+    defaults["template_seq"] += 1
+    template_id = defaults["template_seq"]
+    title = _make_template_title(text, template_id)
+    # Textos iguales (entre usuarios o tras editar) comparten la misma cadena
+    tpl = {
+        "id": template_id,
+        "title": title,
+        "text": sys.intern(text),
+        "entities": entities,
+        "hash": content_hash,
+    }
+    defaults["templates"].append(tpl)
+    defaults["template_ids"][template_id] = tpl
+    defaults["template_hashes"][content_hash] = template_id
+    mark_user_dirty(user_id)
     return title
 
 
-def get_templates(user_id: int) -> List[Dict[str, str]]:
+def update_template_text(
+    user_id: int, tpl: Dict[str, Any], text: str, entities: Tuple[MessageEntity, ...] = ()
+) -> None:
+    defaults = get_defaults(user_id)
+    hashes = defaults["template_hashes"]
+    if hashes.get(tpl["hash"]) == tpl["id"]:
+        del hashes[tpl["hash"]]
+    forget_compiled_text(tpl["text"])
+    tpl["text"] = sys.intern(text)
+    tpl["entities"] = entities
+    tpl["hash"] = template_content_hash(text, entities)
+    hashes.setdefault(tpl["hash"], tpl["id"])
+    mark_user_dirty(user_id)
+
+
+def delete_templates(user_id: int, template_ids: Any) -> List[Dict[str, Any]]:
+    """Elimina varias plantillas de una pasada; devuelve las eliminadas."""
+    defaults = get_defaults(user_id)
+    kept: List[Dict[str, Any]] = []
+    removed: List[Dict[str, Any]] = []
+    for tpl in defaults["templates"]:
+        (removed if tpl["id"] in template_ids else kept).append(tpl)
+    defaults["templates"] = kept
+    for tpl in removed:
+        forget_compiled_text(tpl["text"])
+        defaults["template_ids"].pop(tpl["id"], None)
+        if defaults["template_hashes"].get(tpl["hash"]) == tpl["id"]:
+            del defaults["template_hashes"][tpl["hash"]]
+    mark_user_dirty(user_id)
+    return removed
+
+
+def get_templates(user_id: int) -> List[Dict[str, Any]]:
     defaults = get_defaults(user_id)
     return defaults.get("templates", [])
 
 
+def get_template_by_id(user_id: int, template_id: Any) -> Optional[Dict[str, Any]]:
+    return get_defaults(user_id)["template_ids"].get(template_id)
+
+
+# --------- Variables de plantilla ---------
+# Los textos pueden llevar {variable}; "{{" y "}}" son llaves literales. Se
+# sustituyen al enviar: {fecha}, {hora} y {dia} salen de la hora del envío y
+# el resto de /variable o de los valores de cada publicación recurrente. Las
+# variables sin valor (o con valor vacío) se dejan tal cual. Cada texto se
+# compila una vez y se guarda hasta que la plantilla cambia o se borra; lo
+# compilado sirve tanto para el texto plano como para mover las entidades.
+TEMPLATE_CACHE_SIZE = 1024
+_COMPILED_TEXTS: "OrderedDict[str, CompiledText]" = OrderedDict()
+_TEMPLATE_VAR_RE = re.compile(r"\{\{|\}\}|\{([A-Za-z_áéíóúñ][\wáéíóúñ]*)\}")
+_WEEKDAY_LABELS = ("lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo")
+
+
+class CompiledText:
+    """
+    Texto con {variables} partido una sola vez. `render(values)` es un join
+    sobre tuplas; `pieces` guarda por cada marca (literal previo, su ancho
+    UTF-16, nombre o None si es "{{"/"}}", marca original y su ancho) para
+    recolocar las entidades sin volver a recorrer el texto.
+    """
+
+    __slots__ = ("render", "pieces", "tail")
+
+    def __init__(self, text: str) -> None:
+        pieces: List[Tuple[str, int, Optional[str], str, int]] = []
+        literals: List[str] = []
+        names: List[str] = []
+        current: List[str] = []
+        pos = 0
+        for match in _TEMPLATE_VAR_RE.finditer(text):
+            literal = text[pos:match.start()]
+            token = match.group(0)
+            name = match.group(1)
+            pieces.append((literal, utf16_len(literal), name, token, utf16_len(token)))
+            current.append(literal)
+            pos = match.end()
+            if name is None:
+                current.append(token[0])
+            else:
+                literals.append("".join(current))
+                names.append(name)
+                current = []
+        self.tail = text[pos:]
+        current.append(self.tail)
+        self.pieces = tuple(pieces)
+        tail = "".join(current)
+        if not names:
+            self.render = lambda values, _text=tail: _text
+            return
+
+        pairs = tuple(zip(literals, names))
+        fallbacks = {name: "{" + name + "}" for name in names}
+
+        def render(values: Dict[str, str]) -> str:
+            get = values.get
+            parts = []
+            for literal, name in pairs:
+                parts.append(literal)
+                parts.append(get(name) or fallbacks[name])
+            parts.append(tail)
+            return "".join(parts)
+
+        self.render = render
+
+
+def compile_template_text(text: str) -> CompiledText:
+    compiled = _COMPILED_TEXTS.get(text)
+    if compiled is None:
+        compiled = _COMPILED_TEXTS[text] = CompiledText(text)
+        if len(_COMPILED_TEXTS) > TEMPLATE_CACHE_SIZE:
+            _COMPILED_TEXTS.popitem(last=False)
+    return compiled
+
+
+def render_template_text(text: str, values: Dict[str, str]) -> str:
+    if "{" not in text and "}" not in text:
+        return text
+    return compile_template_text(text).render(values)
+
+
+def forget_compiled_text(text: str) -> None:
+    _COMPILED_TEXTS.pop(text, None)
+
+
+def template_values(
+    user_id: Optional[int],
+    extra: Optional[Dict[str, str]] = None,
+    now: Optional[datetime] = None,
+) -> Dict[str, str]:
+    now = (now or datetime.now(LOCAL_TZ)).astimezone(LOCAL_TZ)
+    values = {
+        "fecha": now.strftime("%Y-%m-%d"),
+        "hora": now.strftime("%H:%M"),
+        "dia": _WEEKDAY_LABELS[now.weekday()],
+    }
+    if user_id is not None:
+        # get_defaults recarga de SQLite al usuario expulsado de memoria
+        values.update(get_defaults(user_id).get("variables") or {})
+    if extra:
+        values.update(extra)
+    return values
+
+
+def parse_variable_assignments(raw: str) -> Dict[str, str]:
+    """"par=EURUSD; precio=1.0850" -> {"par": "EURUSD", "precio": "1.0850"}"""
+    result: Dict[str, str] = {}
+    for part in raw.split(";"):
+        if not part.strip():
+            continue
+        if "=" not in part:
+            raise ValueError(f"falta '=' en {part.strip()!r}")
+        name, value = part.split("=", 1)
+        name = name.strip().strip("{}")
+        if not re.fullmatch(r"[A-Za-z_áéíóúñ][\wáéíóúñ]*", name):
+            raise ValueError(f"nombre de variable inválido {name!r}")
+        result[name] = value.strip()
+    return result
+
+
+# --------- Formato (entidades y HTML) ---------
+# El formato se guarda como entidades de Telegram (offsets en UTF-16) y se
+# envía tal cual, sin parse_mode. Las que Telegram detecta solo (enlaces,
+# menciones, hashtags...) no se guardan. En modo HTML el texto se interpreta
+# una vez al guardarlo en el borrador: los errores salen ahí y no al enviar.
+_KEPT_ENTITY_TYPES = frozenset(
+    {
+        MessageEntity.BOLD,
+        MessageEntity.ITALIC,
+        MessageEntity.UNDERLINE,
+        MessageEntity.STRIKETHROUGH,
+        MessageEntity.SPOILER,
+        MessageEntity.CODE,
+        MessageEntity.PRE,
+        MessageEntity.TEXT_LINK,
+        MessageEntity.TEXT_MENTION,
+        MessageEntity.CUSTOM_EMOJI,
+    }
+)
+
+_HTML_TAGS = {
+    "b": MessageEntity.BOLD,
+    "strong": MessageEntity.BOLD,
+    "i": MessageEntity.ITALIC,
+    "em": MessageEntity.ITALIC,
+    "u": MessageEntity.UNDERLINE,
+    "ins": MessageEntity.UNDERLINE,
+    "s": MessageEntity.STRIKETHROUGH,
+    "strike": MessageEntity.STRIKETHROUGH,
+    "del": MessageEntity.STRIKETHROUGH,
+    "tg-spoiler": MessageEntity.SPOILER,
+    "code": MessageEntity.CODE,
+    "pre": MessageEntity.PRE,
+    "a": MessageEntity.TEXT_LINK,
+    "tg-emoji": MessageEntity.CUSTOM_EMOJI,
+    "span": MessageEntity.SPOILER,  # solo con class="tg-spoiler"
+}
+HTML_CACHE_SIZE = 256
+_HTML_CACHE: "OrderedDict[str, Tuple[str, Tuple[MessageEntity, ...]]]" = OrderedDict()
+
+
+def keep_entities(entities: Any) -> Tuple[MessageEntity, ...]:
+    return tuple(e for e in entities or () if e.type in _KEPT_ENTITY_TYPES)
+
+
+def entities_key(entities: Tuple[MessageEntity, ...]) -> Tuple[Any, ...]:
+    # MessageEntity compara solo tipo/offset/longitud: la url también cuenta
+    return tuple(
+        (e.type, e.offset, e.length, e.url, e.language, e.custom_emoji_id, e.user.id if e.user else None)
+        for e in entities
+    )
+
+
+def entities_to_data(entities: Tuple[MessageEntity, ...]) -> List[Dict[str, Any]]:
+    return [e.to_dict() for e in entities]
+
+
+def entities_from_data(data: Any) -> Tuple[MessageEntity, ...]:
+    entities = []
+    for item in data or []:
+        try:
+            entity = MessageEntity.de_json(item, None)
+        except (KeyError, TypeError):
+            continue
+        if entity is not None:
+            entities.append(entity)
+    return keep_entities(entities)
+
+
+def _moved_entity(entity: MessageEntity, offset: int, length: int) -> MessageEntity:
+    return MessageEntity(
+        type=entity.type,
+        offset=offset,
+        length=length,
+        url=entity.url,
+        user=entity.user,
+        language=entity.language,
+        custom_emoji_id=entity.custom_emoji_id,
+    )
+
+
+def slice_entities(
+    entities: Tuple[MessageEntity, ...], start: int, end: int
+) -> Tuple[MessageEntity, ...]:
+    """Entidades recortadas a [start, end) (UTF-16) con offsets relativos a start."""
+    result = []
+    for entity in entities:
+        lo = max(entity.offset, start)
+        hi = min(entity.offset + entity.length, end)
+        if hi > lo:
+            if lo == entity.offset and hi - lo == entity.length and start == 0:
+                result.append(entity)
+            else:
+                result.append(_moved_entity(entity, lo - start, hi - lo))
+    return tuple(result)
+
+
+def shift_entities(entities: Tuple[MessageEntity, ...], delta: int) -> Tuple[MessageEntity, ...]:
+    if not delta:
+        return entities
+    return tuple(_moved_entity(e, e.offset + delta, e.length) for e in entities)
+
+
+class _TelegramHTMLParser(HTMLParser):
+    """Subconjunto de HTML que admite Telegram -> (texto, entidades)."""
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.chunks: List[str] = []
+        self.units = 0
+        self.entities: List[MessageEntity] = []
+        self.stack: List[Tuple[str, int, Dict[str, Any]]] = []
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag not in _HTML_TAGS:
+            raise ValueError(f"etiqueta <{tag}> no admitida")
+        extra: Dict[str, Any] = {}
+        attributes = dict(attrs)
+        if tag == "a":
+            if not attributes.get("href"):
+                raise ValueError("<a> sin href")
+            extra["url"] = attributes["href"]
+        elif tag == "span" and attributes.get("class") != "tg-spoiler":
+            raise ValueError('<span> solo se admite con class="tg-spoiler"')
+        elif tag == "tg-emoji":
+            if not attributes.get("emoji-id"):
+                raise ValueError("<tg-emoji> sin emoji-id")
+            extra["custom_emoji_id"] = attributes["emoji-id"]
+        elif tag == "code" and self.stack and self.stack[-1][0] == "pre":
+            # <pre><code class="language-x"> es un único bloque con lenguaje
+            language = (attributes.get("class") or "").removeprefix("language-")
+            if language:
+                self.stack[-1][2]["language"] = language
+            extra["inside_pre"] = True
+        self.stack.append((tag, self.units, extra))
+
+    def handle_endtag(self, tag: str) -> None:
+        if not self.stack or self.stack[-1][0] != tag:
+            raise ValueError(f"</{tag}> no cierra la última etiqueta abierta")
+        _, start, extra = self.stack.pop()
+        if extra.pop("inside_pre", False) or self.units == start:
+            return
+        self.entities.append(
+            MessageEntity(type=_HTML_TAGS[tag], offset=start, length=self.units - start, **extra)
+        )
+
+    def handle_data(self, data: str) -> None:
+        self.chunks.append(data)
+        self.units += utf16_len(data)
+
+
+def parse_html_text(source: str) -> Tuple[str, Tuple[MessageEntity, ...]]:
+    """HTML de Telegram -> (texto plano, entidades). ValueError si no es válido."""
+    cached = _HTML_CACHE.get(source)
+    if cached is not None:
+        _HTML_CACHE.move_to_end(source)
+        return cached
+    parser = _TelegramHTMLParser()
+    parser.feed(source)
+    parser.close()
+    if parser.stack:
+        raise ValueError(f"falta cerrar <{parser.stack[-1][0]}>")
+    entities = sorted(parser.entities, key=lambda e: (e.offset, -e.length))
+    result = ("".join(parser.chunks), tuple(entities))
+    _HTML_CACHE[source] = result
+    if len(_HTML_CACHE) > HTML_CACHE_SIZE:
+        _HTML_CACHE.popitem(last=False)
+    return result
+
+
+def html_error_text(exc: Exception) -> str:
+    return (
+        f"HTML no válido: {exc}.\n"
+        "Corrígelo y envíalo de nuevo, o desactiva el modo HTML con /formato normal."
+    )
+
+
+def format_input(
+    user_id: int, text: str, entities: Any = None
+) -> Tuple[str, Tuple[MessageEntity, ...]]:
+    """
+    Texto y formato a guardar en el borrador. El formato hecho en Telegram
+    se respeta; si no lo hay y el usuario está en modo HTML se interpreta.
+    """
+    kept = keep_entities(entities)
+    if not kept and get_defaults(user_id).get("format") == "html":
+        return parse_html_text(text)
+    return text, kept
+
+
+def render_with_entities(
+    text: str, entities: Tuple[MessageEntity, ...], values: Dict[str, str]
+) -> Tuple[str, Tuple[MessageEntity, ...]]:
+    """Como render_template_text, moviendo las entidades con el texto sustituido."""
+    if not entities:
+        return render_template_text(text, values), entities
+    if "{" not in text and "}" not in text:
+        return text, entities
+    compiled = compile_template_text(text)
+    out: List[str] = []
+    # (unidades originales, unidades nuevas) al final de cada sustitución
+    marks: List[Tuple[int, int, int]] = []
+    old_units = 0
+    new_units = 0
+    for literal, width, name, original, original_width in compiled.pieces:
+        out.append(literal)
+        old_units += width
+        new_units += width
+        if name is None:
+            replacement = original[0]
+            new_width = 1
+        else:
+            replacement = values.get(name) or original
+            new_width = original_width if replacement is original else utf16_len(replacement)
+        out.append(replacement)
+        old_start = old_units
+        old_units += original_width
+        new_units += new_width
+        marks.append((old_start, old_units, new_units))
+    out.append(compiled.tail)
+    if not marks:
+        return text, entities
+
+    def moved(position: int) -> int:
+        delta = 0
+        for old_start, old_end, new_end in marks:
+            if position < old_end:
+                # Dentro de una {variable}: se lleva al final de su valor
+                return new_end if position > old_start else position + delta
+            delta = new_end - old_end
+        return position + delta
+
+    result = []
+    for entity in entities:
+        start = moved(entity.offset)
+        end = moved(entity.offset + entity.length)
+        if end > start:
+            result.append(_moved_entity(entity, start, end - start))
+    return "".join(out), tuple(result)
+
+
+# --------- Longitud de texto ---------
+# Telegram limita el pie de foto/video/voz a 1024 caracteres y el mensaje a
+# 4096, contados en unidades UTF-16 (un emoji suele valer 2). Lo que no cabe
+# se envía en mensajes de texto a continuación. El reparto depende solo del
+# texto y del tipo, así que cada versión del borrador se calcula una vez.
+CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
+SPLIT_CACHE_SIZE = 256
+_SPLIT_CACHE: "OrderedDict[Tuple[Any, ...], Tuple[Tuple[str, Tuple[MessageEntity, ...]], ...]]" = (
+    OrderedDict()
+)
+
+# Dónde preferimos cortar, de mejor a peor: fin de párrafo, fin de línea, espacio
+_BREAKS = ("\n\n", "\n", " ")
+
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _fit_utf16(text: str, start: int, budget: int) -> int:
+    """Índice final del trozo más largo desde `start` que cabe en `budget` unidades."""
+    end = min(len(text), start + budget)  # cada carácter ocupa al menos 1 unidad
+    excess = utf16_len(text[start:end]) - budget
+    while excess > 0:
+        # Quitar excess/2 caracteres quita al menos esa cantidad de unidades
+        end -= (excess + 1) // 2
+        excess = utf16_len(text[start:end]) - budget
+    return end
+
+
+def split_spans(text: str, first_limit: int, limit: int = MESSAGE_LIMIT) -> Tuple[Tuple[int, int], ...]:
+    """
+    (inicio, fin) de trozos de como mucho `first_limit` (el primero) y `limit`
+    unidades UTF-16. Cada trozo se corta en el mejor separador que lo deje al
+    menos a medias, o en seco si no hay ninguno; los separadores del corte se
+    descartan.
+    """
+    if utf16_len(text) <= first_limit:
+        return ((0, len(text)),)
+
+    spans: List[Tuple[int, int]] = []
+    budget = first_limit
+    start = 0
+    n = len(text)
+    while start < n:
+        end = _fit_utf16(text, start, budget)
+        if end < n:
+            cut = -1
+            for sep in _BREAKS:
+                pos = text.rfind(sep, start, end)
+                if pos > start and utf16_len(text[start:pos]) * 2 >= budget:
+                    cut = pos
+                    break
+            if cut < 0:
+                cut = max(text.rfind(sep, start, end) for sep in _BREAKS)
+            end = cut if cut > start else end
+        chunk_end = start + len(text[start:end].rstrip())
+        if chunk_end > start:
+            spans.append((start, chunk_end))
+        start = end
+        while start < n and text[start] in " \n":
+            start += 1
+        budget = limit
+    return tuple(spans) or ((0, 0),)
+
+
+def split_text(text: str, first_limit: int, limit: int = MESSAGE_LIMIT) -> Tuple[str, ...]:
+    return tuple(text[start:end] for start, end in split_spans(text, first_limit, limit))
+
+
+def draft_has_caption(draft: Draft) -> bool:
+    """El texto va como pie de una media (límite CAPTION_LIMIT)."""
+    if draft.type == "copy":
+        return bool(draft.source) and draft.source[2] in COPY_CAPTION_KINDS  # type: ignore[index]
+    return draft.type in ("photo", "video", "voice") and bool(draft.file_id)
+
+
+def publication_parts(draft: Draft) -> Tuple[Tuple[str, Tuple[MessageEntity, ...]], ...]:
+    """
+    (texto, entidades) del pie/mensaje principal y de los mensajes siguientes.
+    Las entidades se recortan a cada trozo con offsets relativos a él.
+    """
+    first_limit = CAPTION_LIMIT if draft_has_caption(draft) else MESSAGE_LIMIT
+    cache_key = (draft.text, first_limit, entities_key(draft.entities))
+    parts = _SPLIT_CACHE.get(cache_key)
+    if parts is None:
+        text = draft.text
+        spans = split_spans(text, first_limit)
+        if len(spans) == 1 and spans[0] == (0, len(text)):
+            parts = ((text, draft.entities),)
+        else:
+            built = []
+            for start, end in spans:
+                offset = utf16_len(text[:start])
+                built.append(
+                    (
+                        text[start:end],
+                        slice_entities(draft.entities, offset, offset + utf16_len(text[start:end])),
+                    )
+                )
+            parts = tuple(built)
+        _SPLIT_CACHE[cache_key] = parts
+        if len(_SPLIT_CACHE) > SPLIT_CACHE_SIZE:
+            _SPLIT_CACHE.popitem(last=False)
+    else:
+        _SPLIT_CACHE.move_to_end(cache_key)
+    return parts
+
+
+def text_length_notice(draft: Draft) -> str:
+    """Aviso para el usuario si el texto no cabe en un solo mensaje ("" si cabe)."""
+    parts = publication_parts(draft)
+    if len(parts) == 1:
+        return ""
+    has_media = draft_has_caption(draft)
+    limit = CAPTION_LIMIT if has_media else MESSAGE_LIMIT
+    where = "el pie admite" if has_media else "cada mensaje admite"
+    return (
+        f"\n\nℹ️ El texto ocupa {utf16_len(draft.text)} caracteres y {where} {limit}: "
+        f"se publicará en {len(parts)} mensajes seguidos."
+    )
+
+
+# --------- Copia de mensajes ---------
+# Lo que el bot no sabe reconstruir (GIF, documentos, encuestas, stickers...)
+# se publica con copy_message desde el mensaje original del admin: una sola
+# llamada, cualquier tipo y el formato tal cual. Con /copia on se usa también
+# para foto, video y voz. El mensaje original debe seguir en el chat del bot.
+COPY_CAPTION_KINDS = frozenset({"photo", "video", "voice", "animation", "document", "audio"})
+# animation va antes que document: un GIF trae los dos campos
+_MESSAGE_KINDS = (
+    "animation",
+    "document",
+    "audio",
+    "video_note",
+    "sticker",
+    "poll",
+    "venue",
+    "location",
+    "contact",
+    "dice",
+    "photo",
+    "video",
+    "voice",
+    "text",
+)
+COPY_KIND_LABELS = {
+    "animation": "GIF",
+    "document": "documento",
+    "audio": "audio",
+    "video_note": "video redondo",
+    "sticker": "sticker",
+    "poll": "encuesta",
+    "venue": "lugar",
+    "location": "ubicación",
+    "contact": "contacto",
+    "dice": "dado",
+    "photo": "foto",
+    "video": "video",
+    "voice": "nota de voz",
+}
+
+
+def message_kind(message: Any) -> Optional[str]:
+    for kind in _MESSAGE_KINDS:
+        if getattr(message, kind, None):
+            return kind
+    return None
+
+
+def draft_accepts_text(draft: Draft) -> bool:
+    """False en copias de mensajes sin pie (encuestas, stickers...)."""
+    return draft.type != "copy" or draft_has_caption(draft)
+
+
+# --------- Biblioteca de medios ---------
+# Indexada por file_unique_id (estable entre reenvíos); el orden del
+# OrderedDict es el de uso más reciente, así que el primero es el que se expulsa.
+# Se guarda en SQLite (los file_id siguen valiendo tras reiniciar el bot): se
+# carga al arrancar y se vuelca con el mantenimiento periódico si ha cambiado.
+MEDIA_LIBRARY: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+MEDIA_LIBRARY_CAPACITY = 200
+# Solo se envía el último file_id (cualquiera de este bot sirve); los anteriores
+# quedan de reserva. Se limitan porque reenviar muchas veces el mismo archivo
+# puede dar ids distintos y cada entrada se reescribe entera al guardarla.
+MEDIA_MAX_FILE_IDS = 10
+_MEDIA_STORE: Dict[str, bool] = {"dirty": False}
+
+MEDIA_TYPE_LABELS = {
+    "photo": "🖼 Foto",
+    "video": "🎬 Video",
+    "voice": "🎙 Nota de voz",
+}
+
+
+def register_media(message: Any) -> Optional[Dict[str, Any]]:
+    """Añade (o refresca) en la biblioteca la media de un mensaje."""
+    if message.photo:
+        content_type, media = "photo", message.photo[-1]
+    elif message.video:
+        content_type, media = "video", message.video
+    elif message.voice:
+        content_type, media = "voice", message.voice
+    else:
+        return None
+
+    uid = media.file_unique_id
+    entry = MEDIA_LIBRARY.get(uid)
+    if entry is None:
+        entry = {
+            "uid": uid,
+            "type": content_type,
+            "file_ids": [],
+            "file_size": getattr(media, "file_size", None),
+            "width": getattr(media, "width", None),
+            "height": getattr(media, "height", None),
+            "duration": getattr(media, "duration", None),
+            "uses": 0,
+        }
+        MEDIA_LIBRARY[uid] = entry
+        if len(MEDIA_LIBRARY) > MEDIA_LIBRARY_CAPACITY:
+            MEDIA_LIBRARY.popitem(last=False)
+    else:
+        MEDIA_LIBRARY.move_to_end(uid)
+
+    if media.file_id not in entry["file_ids"]:
+        entry["file_ids"].append(media.file_id)
+        del entry["file_ids"][:-MEDIA_MAX_FILE_IDS]
+    entry["uses"] += 1
+    _MEDIA_STORE["dirty"] = True
+    return entry
+
+
+def get_media(uid: str) -> Optional[Dict[str, Any]]:
+    entry = MEDIA_LIBRARY.get(uid)
+    if entry is not None:
+        MEDIA_LIBRARY.move_to_end(uid)
+        _MEDIA_STORE["dirty"] = True
+    return entry
+
+
+def save_media_library() -> int:
+    """Reescribe en una transacción la biblioteca, en orden de uso."""
+    rows = [
+        (pos, uid, json.dumps(entry, ensure_ascii=False))
+        for pos, (uid, entry) in enumerate(MEDIA_LIBRARY.items())
+    ]
+    conn = _db()
+    with conn:
+        conn.execute("DELETE FROM media_library")
+        conn.executemany("INSERT INTO media_library (pos, uid, data) VALUES (?, ?, ?)", rows)
+    _MEDIA_STORE["dirty"] = False
+    return len(rows)
+
+
+def load_media_library() -> int:
+    MEDIA_LIBRARY.clear()
+    for uid, raw in _db().execute("SELECT uid, data FROM media_library ORDER BY pos"):
+        MEDIA_LIBRARY[uid] = json.loads(raw)
+    while len(MEDIA_LIBRARY) > MEDIA_LIBRARY_CAPACITY:
+        MEDIA_LIBRARY.popitem(last=False)
+    _MEDIA_STORE["dirty"] = False
+    return len(MEDIA_LIBRARY)
+
+
+def list_recent_media(limit: int = 10) -> List[Dict[str, Any]]:
+    return list(islice(reversed(MEDIA_LIBRARY.values()), limit))
+
+
+def describe_media(entry: Dict[str, Any]) -> str:
+    parts = [MEDIA_TYPE_LABELS.get(entry["type"], entry["type"])]
+    if entry.get("width") and entry.get("height"):
+        parts.append(f"{entry['width']}x{entry['height']}")
+    if entry.get("duration"):
+        parts.append(f"{entry['duration']}s")
+    if entry.get("file_size"):
+        parts.append(f"{entry['file_size'] // 1024} KB")
+    parts.append(f"usada {entry['uses']}x")
+    return " · ".join(parts)
+
+
 # --------- Construcción de menús ---------
 def build_main_menu_text(user_id: int) -> str:
-    return "Menú principal:"
+    index = get_draft_index(user_id)
+    draft = DRAFTS[user_id]
+    if not index.shelved and not index.scheduled and not draft.name:
+        return "Menú principal:"
+    lines = [
+        "Menú principal:",
+        f"📝 Borrador activo: {draft_label(draft)}",
+        f"🗂 Borradores: {len(index.shelved) + 1} · programados: {len(index.scheduled)}",
+    ]
+    if index.scheduled:
+        upcoming = min(index.scheduled.values())
+        lines.append(f"⏰ Próximo envío: {upcoming.strftime('%Y-%m-%d %H:%M')}")
+    return "\n".join(lines)
+
+
+def build_drafts_menu(user_id: int) -> Tuple[str, List[List[InlineKeyboardButton]]]:
+    index = get_draft_index(user_id)
+    active = get_draft(user_id)
+    lines = [f"📝 Activo: {draft_label(active)}"]
+    keyboard: List[List[InlineKeyboardButton]] = [
+        [InlineKeyboardButton("➕ Nuevo borrador", callback_data="DRAFT_NEW")],
+    ]
+    if not index.shelved:
+        lines.append("No hay otros borradores guardados.")
+    for draft_id, draft in reversed(index.shelved.items()):
+        label = draft_label(draft)
+        when = index.scheduled.get(draft_id)
+        suffix = f" · ⏰ {when.strftime('%Y-%m-%d %H:%M')}" if when else ""
+        lines.append(f"• {label}{suffix}: {_make_template_title(draft.text, draft_id)}")
+        keyboard.append(
+            [
+                InlineKeyboardButton(f"↪️ {label}", callback_data=f"DRAFT_SWITCH_{draft_id}"),
+                InlineKeyboardButton("🗑", callback_data=f"DRAFT_DEL_{draft_id}"),
+            ]
+        )
+    keyboard.append([InlineKeyboardButton("⬅️ Volver al menú", callback_data="BACK_TO_MENU")])
+    return "\n".join(lines), keyboard
+
+
+# --------- Selección múltiple ---------
+# Borrar varias plantillas o botones de una vez: cada pulsación marca o
+# desmarca editando el propio teclado y "Eliminar" aplica todo junto y guarda
+# el estado en una sola transacción. La selección vive en user_data.
+SELECTION_KINDS = {
+    "templates": ("plantillas", "Marca las plantillas que quieres eliminar:"),
+    "buttons": ("botones", "Marca los botones que quieres eliminar:"),
+}
+
+
+def selection_items(user_id: int, kind: str) -> List[Tuple[str, str]]:
+    """(clave, etiqueta) de lo que se puede marcar."""
+    if kind == "templates":
+        return [(str(tpl["id"]), tpl["title"]) for tpl in get_templates(user_id)]
+    return [
+        (str(idx), f"{row[0].text} - {row[0].url}")
+        for idx, row in enumerate(get_draft(user_id).buttons)
+        if row
+    ]
 
 
+def start_selection(user_id: int, kind: str) -> Dict[str, Any]:
+    selection: Dict[str, Any] = {"kind": kind, "picked": set()}
+    if kind == "buttons":
+        # Las claves son posiciones: solo valen si los botones no han cambiado
+        selection["signature"] = _buttons_signature(get_draft(user_id).buttons)
+    return selection
+
+
+def build_selection_keyboard(user_id: int, selection: Dict[str, Any]) -> InlineKeyboardMarkup:
+    picked = selection["picked"]
+    items = selection_items(user_id, selection["kind"])
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                f"{'☑️' if key in picked else '⬜'} {label}"[:60],
+                callback_data=f"SEL_TOGGLE_{key}",
+            )
+        ]
+        for key, label in items
+    ]
+    all_picked = bool(items) and len(picked) == len(items)
+    keyboard.append(
+        [
+            InlineKeyboardButton(
+                "Ninguno" if all_picked else "Todos", callback_data="SEL_ALL"
+            ),
+            InlineKeyboardButton(f"🗑 Eliminar ({len(picked)})", callback_data="SEL_APPLY"),
+        ]
+    )
+    keyboard.append([InlineKeyboardButton("❌ Cancelar", callback_data="SEL_CANCEL")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def apply_selection(user_id: int, selection: Dict[str, Any]) -> str:
+    """Aplica la selección, guarda el estado y devuelve el texto de confirmación."""
+    picked = selection["picked"]
+    label = SELECTION_KINDS[selection["kind"]][0]
+    if not picked:
+        return f"No se ha eliminado ninguna de las {label}."
+    if selection["kind"] == "templates":
+        removed = [tpl["title"] for tpl in delete_templates(user_id, {int(k) for k in picked})]
+    else:
+        draft = get_draft(user_id)
+        if _buttons_signature(draft.buttons) != selection["signature"]:
+            return "Los botones del borrador han cambiado; vuelve a abrir la selección."
+        removed = [row[0].text for idx, row in enumerate(draft.buttons) if str(idx) in picked]
+        draft.buttons = [row for idx, row in enumerate(draft.buttons) if str(idx) not in picked]
+    flush_user_states([user_id])
+    listing = "\n".join(f"• {title}" for title in removed)
+    return f"🗑 Eliminados {len(removed)} {label}:\n{listing}"
+
 
 def build_main_menu_keyboard() -> List[List[InlineKeyboardButton]]:
     keyboard = [
@@ -158,6 +1622,10 @@ def build_main_menu_keyboard() -> List[List[InlineKeyboardButton]]:
             InlineKeyboardButton("✏️ Editar publicación", callback_data="MENU_EDIT"),
             InlineKeyboardButton("📄 Plantillas", callback_data="MENU_TEMPLATES"),
         ],
+        [
+            InlineKeyboardButton("🔁 Recurrentes", callback_data="MENU_RECURRING"),
+            InlineKeyboardButton("🗂 Borradores", callback_data="MENU_DRAFTS"),
+        ],
         [
             InlineKeyboardButton("❌ Cancelar borrador", callback_data="MENU_CANCEL_DRAFT"),
         ],
@@ -181,7 +1649,7 @@ def build_buttons_menu_keyboard() -> List[List[InlineKeyboardButton]]:
             InlineKeyboardButton("🗑 Eliminar TODOS los botones", callback_data="BUTTONS_MENU_DELETE_ALL"),
         ],
         [
-            InlineKeyboardButton("➖ Eliminar UN botón", callback_data="BUTTONS_MENU_DELETE_ONE"),
+            InlineKeyboardButton("➖ Eliminar botones", callback_data="BUTTONS_MENU_DELETE_SOME"),
         ],
         [
             InlineKeyboardButton("💾 Guardar actuales como predeterminados", callback_data="BUTTONS_MENU_SAVE_DEFAULTS"),
@@ -220,102 +1688,1085 @@ async def send_main_menu_simple(
     context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int
 ) -> None:
     text_menu = build_main_menu_text(user_id)
-    keyboard = build_main_menu_keyboard()
     await context.bot.send_message(
         chat_id=chat_id,
         text=text_menu,
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=static_keyboard("main_menu"),
     )
 
 
-# --------- Vista previa y envío ---------
-async def send_draft_preview(
-    user_id: int, chat_id: int, context: ContextTypes.DEFAULT_TYPE
-) -> None:
-    draft = get_draft(user_id)
-    if not draft_has_content(draft):
-        await context.bot.send_message(chat_id=chat_id, text="(Sin publicación para vista previa)")
-        return
-
-    buttons = draft.get("buttons") or []
-    reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
-    text = draft.get("text") or ""
-    content_type = draft.get("type")
-    file_id = draft.get("file_id")
-
-    if content_type == "photo" and file_id:
-        await context.bot.send_photo(
-            chat_id=chat_id,
-            photo=file_id,
-            caption=text,
-            reply_markup=reply_markup,
-        )
-    elif content_type == "video" and file_id:
-        await context.bot.send_video(
-            chat_id=chat_id,
-            video=file_id,
-            caption=text,
-            reply_markup=reply_markup,
-        )
-    elif content_type == "voice" and file_id:
-        await context.bot.send_voice(
-            chat_id=chat_id,
-            voice=file_id,
-            caption=text,
-            reply_markup=reply_markup,
-        )
-    else:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=text if text else "(Publicación sin texto)",
-            reply_markup=reply_markup,
-        )
-
-
-async def send_publication_to_target(
-    draft: Dict[str, Any],
-    context: ContextTypes.DEFAULT_TYPE,
-) -> Any:
-    if not draft_has_content(draft):
-        return None
-
-    buttons = draft.get("buttons") or []
-    reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
-    text = draft.get("text") or ""
-    content_type = draft.get("type")
-    file_id = draft.get("file_id")
-
-    message = None
+# --------- Teclados fijos ---------
+# Los menús que nunca cambian se construyen una sola vez al arrancar y se
+# comparten entre todos los envíos. InlineKeyboardMarkup ya es inmutable en
+# PTB 20; FrozenKeyboard además guarda el resultado de to_dict(), que es lo
+# que PTB serializa a JSON en cada petición.
+class FrozenKeyboard(InlineKeyboardMarkup):
+    """Teclado con la serialización precalculada; el dict devuelto es de solo lectura."""
 
-    if content_type == "photo" and file_id:
-        message = await context.bot.send_photo(
-            chat_id=TARGET_CHAT_ID,
-            photo=file_id,
-            caption=text,
-            reply_markup=reply_markup,
-        )
-    elif content_type == "video" and file_id:
-        message = await context.bot.send_video(
-            chat_id=TARGET_CHAT_ID,
-            video=file_id,
-            caption=text,
-            reply_markup=reply_markup,
-        )
-    elif content_type == "voice" and file_id:
-        message = await context.bot.send_voice(
-            chat_id=TARGET_CHAT_ID,
-            voice=file_id,
-            caption=text,
-            reply_markup=reply_markup,
-        )
-    else:
-        message = await context.bot.send_message(
-            chat_id=TARGET_CHAT_ID,
-            text=text if text else "(Publicación sin texto)",
-            reply_markup=reply_markup,
-        )
+    __slots__ = ("_cached_dict",)
 
-    return message
+    def __init__(self, inline_keyboard: List[List[InlineKeyboardButton]]) -> None:
+        super().__init__(inline_keyboard)
+        self._unfreeze()
+        self._cached_dict = super().to_dict()
+        self._freeze()
+
+    def to_dict(self, recursive: bool = True) -> Dict[str, Any]:
+        return self._cached_dict
+
+
+def build_static_keyboards() -> Dict[str, InlineKeyboardMarkup]:
+    layouts: Dict[str, List[List[InlineKeyboardButton]]] = {
+        "main_menu": build_main_menu_keyboard(),
+        "buttons_menu": build_buttons_menu_keyboard(),
+        "final_action": build_final_action_keyboard(),
+        "use_template": [
+            [
+                InlineKeyboardButton(
+                    "✔ Sí, usar plantilla", callback_data="NEWPUB_USE_TEMPLATE"
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    "✏️ No, escribir texto nuevo", callback_data="NEWPUB_NO_TEMPLATE"
+                )
+            ],
+            [InlineKeyboardButton("❌ Cancelar", callback_data="BACK_TO_MENU")],
+        ],
+        "edit_menu": [
+            [InlineKeyboardButton("✏️ Editar texto", callback_data="EDIT_TEXT")],
+            [InlineKeyboardButton("🔗 Editar botones", callback_data="EDIT_BUTTONS")],
+            [InlineKeyboardButton("🖼 Cambiar media", callback_data="EDIT_MEDIA")],
+            [
+                InlineKeyboardButton(
+                    "🗂 Elegir media de la biblioteca", callback_data="EDIT_MEDIA_LIBRARY"
+                )
+            ],
+            [InlineKeyboardButton("⬅️ Volver al menú", callback_data="BACK_TO_MENU")],
+        ],
+        "templates_menu": [
+            [
+                InlineKeyboardButton(
+                    "💾 Guardar texto actual como plantilla", callback_data="TEMPLATE_SAVE"
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    "📥 Insertar plantilla en borrador", callback_data="TEMPLATE_INSERT"
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    "📚 Ver plantillas guardadas", callback_data="TEMPLATE_VIEW"
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    "🗑 Eliminar plantilla guardada", callback_data="TEMPLATE_DELETE"
+                )
+            ],
+            [InlineKeyboardButton("❌ Cancelar y volver", callback_data="BACK_TO_MENU")],
+        ],
+        "confirm_cancel_draft": [
+            [
+                InlineKeyboardButton(
+                    "Sí, cancelar borrador", callback_data="CONFIRM_CANCEL_DRAFT"
+                )
+            ],
+            [InlineKeyboardButton("⬅️ Volver al menú", callback_data="BACK_TO_MENU")],
+        ],
+        "template_actions": [
+            [
+                InlineKeyboardButton(
+                    "✏ Editar esta plantilla", callback_data="TEMPLATE_EDIT_CURRENT"
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    "⬅️ Volver a la lista de plantillas", callback_data="TEMPLATE_VIEW"
+                )
+            ],
+        ],
+        "use_default_buttons": [
+            [
+                InlineKeyboardButton(
+                    "✔ Usar botones predeterminados",
+                    callback_data="NEW_USE_DEFAULT_BUTTONS",
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    "✏️ No, crear nuevos botones",
+                    callback_data="NEW_CREATE_BUTTONS",
+                )
+            ],
+        ],
+        "save_default_buttons": [
+            [
+                InlineKeyboardButton(
+                    "Sí, guardar como predeterminados",
+                    callback_data="SAVE_BUTTONS_YES",
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    "No, solo usar en este borrador",
+                    callback_data="SAVE_BUTTONS_NO",
+                )
+            ],
+        ],
+    }
+    return {name: FrozenKeyboard(rows) for name, rows in layouts.items()}
+
+
+STATIC_KEYBOARDS: Dict[str, InlineKeyboardMarkup] = build_static_keyboards()
+
+
+def static_keyboard(name: str) -> InlineKeyboardMarkup:
+    return STATIC_KEYBOARDS[name]
+
+
+# --------- Vista previa y envío ---------
+# Última vista previa enviada a cada usuario. Si solo cambian el texto o los
+# botones se edita ese mensaje; un mensaje nuevo solo cuando cambia la media.
+_PREVIEWS: Dict[int, Dict[str, Any]] = {}
+_PREVIEW_STATS: Dict[str, int] = {"sent": 0, "edited": 0, "unchanged": 0}
+
+
+def forget_preview(user_id: int) -> None:
+    _PREVIEWS.pop(user_id, None)
+
+
+def _buttons_signature(buttons: List[List[InlineKeyboardButton]]) -> Tuple[Any, ...]:
+    return tuple(tuple((btn.text, btn.url) for btn in row) for row in buttons)
+
+
+async def _edit_preview(
+    cached: Dict[str, Any],
+    text: Optional[str],
+    entities: Tuple[MessageEntity, ...],
+    reply_markup: Optional[InlineKeyboardMarkup],
+    text_changed: bool,
+    context: ContextTypes.DEFAULT_TYPE,
+) -> bool:
+    """Aplica los cambios sobre el mensaje existente; False si hay que enviar otro."""
+    try:
+        if not text_changed:
+            await context.bot.edit_message_reply_markup(
+                chat_id=cached["chat_id"],
+                message_id=cached["message_id"],
+                reply_markup=reply_markup,
+            )
+        elif cached["type"] == "text":
+            await context.bot.edit_message_text(
+                chat_id=cached["chat_id"],
+                message_id=cached["message_id"],
+                text=text if text else "(Publicación sin texto)",
+                entities=entities or None,
+                reply_markup=reply_markup,
+            )
+        else:
+            await context.bot.edit_message_caption(
+                chat_id=cached["chat_id"],
+                message_id=cached["message_id"],
+                caption=text,
+                caption_entities=entities or None,
+                reply_markup=reply_markup,
+            )
+    except BadRequest as exc:
+        if "not modified" in str(exc).lower():
+            return True
+        # Mensaje borrado o demasiado antiguo para editarse
+        logging.info("No se pudo editar la vista previa: %s", exc)
+        return False
+    return True
+
+
+async def send_content(
+    context: ContextTypes.DEFAULT_TYPE,
+    chat_id: Any,
+    content_type: Optional[str],
+    file_id: Optional[str],
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup],
+    entities: Tuple[MessageEntity, ...] = (),
+    source: Optional[Tuple[int, int, str]] = None,
+) -> Any:
+    """Un mensaje: la media con `text` como pie, la copia del original o texto."""
+    if content_type == "copy" and source:
+        with_caption = source[2] in COPY_CAPTION_KINDS and bool(text)
+        return await context.bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=source[0],
+            message_id=source[1],
+            caption=text if with_caption else None,
+            caption_entities=(entities or None) if with_caption else None,
+            reply_markup=reply_markup,
+        )
+    if content_type == "photo" and file_id:
+        return await context.bot.send_photo(
+            chat_id=chat_id,
+            photo=file_id,
+            caption=text,
+            caption_entities=entities or None,
+            reply_markup=reply_markup,
+        )
+    if content_type == "video" and file_id:
+        return await context.bot.send_video(
+            chat_id=chat_id,
+            video=file_id,
+            caption=text,
+            caption_entities=entities or None,
+            reply_markup=reply_markup,
+        )
+    if content_type == "voice" and file_id:
+        return await context.bot.send_voice(
+            chat_id=chat_id,
+            voice=file_id,
+            caption=text,
+            caption_entities=entities or None,
+            reply_markup=reply_markup,
+        )
+    return await context.bot.send_message(
+        chat_id=chat_id,
+        text=text if text else "(Publicación sin texto)",
+        entities=entities or None,
+        reply_markup=reply_markup,
+    )
+
+
+async def send_draft_preview(
+    user_id: int,
+    chat_id: int,
+    context: ContextTypes.DEFAULT_TYPE,
+    force_new: bool = False,
+) -> None:
+    draft = get_draft(user_id)
+    if not draft_has_content(draft):
+        await context.bot.send_message(chat_id=chat_id, text="(Sin publicación para vista previa)")
+        return
+
+    buttons = draft.buttons
+    reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
+    text = draft.text
+    content_type = draft.type if draft_has_caption(draft) or draft.type == "copy" else "text"
+    file_id = draft.file_id if content_type != "text" else None
+    buttons_sig = _buttons_signature(buttons)
+    format_sig = entities_key(draft.entities)
+    parts = publication_parts(draft)
+
+    if len(parts) > 1 or content_type == "copy":
+        # Varios mensajes o una copia: no se edita en sitio, se envía completa
+        forget_preview(user_id)
+        for index, (part, part_entities) in enumerate(parts):
+            last = index == len(parts) - 1
+            await send_content(
+                context,
+                chat_id,
+                content_type if index == 0 else "text",
+                file_id if index == 0 else None,
+                part,
+                reply_markup if last else None,
+                part_entities,
+                draft.source if index == 0 else None,
+            )
+        _PREVIEW_STATS["sent"] += 1
+        return
+
+    cached = _PREVIEWS.get(user_id)
+    if (
+        not force_new
+        and cached is not None
+        and cached["chat_id"] == chat_id
+        and cached["type"] == content_type
+        and cached["file_id"] == file_id
+    ):
+        text_changed = cached["text"] != text or cached["format"] != format_sig
+        if not text_changed and cached["buttons"] == buttons_sig:
+            _PREVIEW_STATS["unchanged"] += 1
+            return
+        if await _edit_preview(
+            cached, text, draft.entities, reply_markup, text_changed, context
+        ):
+            cached["text"] = text
+            cached["format"] = format_sig
+            cached["buttons"] = buttons_sig
+            _PREVIEW_STATS["edited"] += 1
+            return
+
+    message = await send_content(
+        context, chat_id, content_type, file_id, text, reply_markup, draft.entities
+    )
+    _PREVIEW_STATS["sent"] += 1
+    _PREVIEWS[user_id] = {
+        "chat_id": chat_id,
+        "message_id": message.message_id,
+        "type": content_type,
+        "file_id": file_id,
+        "text": text,
+        "format": format_sig,
+        "buttons": buttons_sig,
+    }
+
+
+# --------- Outbox ---------
+# Cada publicación al canal lleva una clave de idempotencia. Antes de enviar se
+# registra como "pending" (commit incluido) y al confirmarse pasa a "sent" con
+# su message_id. Una clave ya registrada nunca se vuelve a enviar: si quedó en
+# "pending" (caída a mitad de envío o timeout) no se sabe si llegó al canal y
+# se avisa al admin para que lo compruebe. Solo "failed" (error definitivo de
+# Telegram) permite reintentar con la misma clave.
+class OutboxHit:
+    """Publicación que ya tenía registro en el outbox y no se ha reenviado."""
+
+    __slots__ = ("key", "state", "message_id")
+
+    def __init__(self, key: str, state: str, message_id: Optional[int]) -> None:
+        self.key = key
+        self.state = state
+        self.message_id = message_id
+
+
+def outbox_get(key: str) -> Optional[Tuple[str, Optional[int]]]:
+    row = _db().execute(
+        "SELECT state, message_id FROM outbox WHERE key = ?", (key,)
+    ).fetchone()
+    return (row[0], row[1]) if row else None
+
+
+def outbox_claim(key: str, title: str) -> Optional[OutboxHit]:
+    """Marca la clave como "pending"; devuelve el registro previo si no se puede enviar."""
+    conn = _db()
+    now = time.time()
+    with conn:
+        row = conn.execute(
+            "SELECT state, message_id FROM outbox WHERE key = ?", (key,)
+        ).fetchone()
+        if row is not None and row[0] != "failed":
+            return OutboxHit(key, row[0], row[1])
+        conn.execute(
+            "INSERT OR REPLACE INTO outbox"
+            " (key, state, message_id, title, error, reviewed, created_at, updated_at)"
+            " VALUES (?, 'pending', NULL, ?, NULL, 0, ?, ?)",
+            (key, title, now, now),
+        )
+    return None
+
+
+def outbox_finish(
+    key: str,
+    state: str,
+    message_id: Optional[int] = None,
+    error: Optional[str] = None,
+    history: Optional[Dict[str, Any]] = None,
+) -> None:
+    """Cierra el registro; con `history` añade la fila del historial en la misma transacción."""
+    conn = _db()
+    now = time.time()
+    with conn:
+        conn.execute(
+            "UPDATE outbox SET state = ?, message_id = ?, error = ?, updated_at = ?"
+            " WHERE key = ?",
+            (state, message_id, error, now, key),
+        )
+        if history is not None:
+            _append_history(conn, history, message_id, now)
+
+
+def outbox_unreviewed_pending() -> List[Tuple[str, str, float]]:
+    """Envíos que se quedaron a medias y aún no se han notificado; los marca como vistos."""
+    conn = _db()
+    with conn:
+        rows = conn.execute(
+            "SELECT key, title, created_at FROM outbox"
+            " WHERE state = 'pending' AND reviewed = 0 ORDER BY created_at"
+        ).fetchall()
+        conn.execute("UPDATE outbox SET reviewed = 1 WHERE state = 'pending'")
+    return rows
+
+
+def prune_outbox(now: Optional[float] = None) -> int:
+    cutoff = (now if now is not None else time.time()) - OUTBOX_RETENTION_SECONDS
+    conn = _db()
+    with conn:
+        cur = conn.execute(
+            "DELETE FROM outbox WHERE updated_at < ? AND (state != 'pending' OR reviewed = 1)",
+            (cutoff,),
+        )
+    return cur.rowcount
+
+
+def scheduled_draft_key(
+    user_id: int, draft_id: Optional[int], scheduled_at: Optional[datetime], job: Any = None
+) -> str:
+    if scheduled_at is not None:
+        ts = int(scheduled_at.replace(tzinfo=LOCAL_TZ).timestamp())
+        return f"draft:{user_id}:{draft_id or 0}:{ts}"
+    return f"draft:{user_id}:{draft_id or 0}:job:{getattr(job, 'id', '')}"
+
+
+# --------- Historial ---------
+# Cada envío confirmado añade una fila a `history` (índices por fecha y por
+# plantilla). El contenido publicado va aparte en `history_content`, una vez
+# por hash, así repetir la misma publicación no duplica texto ni botones.
+HISTORY_PAGE_SIZE = 10
+
+# Prefijo de la clave de idempotencia -> tipo de envío
+HISTORY_KINDS = {"now": "now", "draft": "scheduled", "rec": "recurring", "cal": "calendar"}
+HISTORY_KIND_LABELS = {
+    "now": "📤 inmediata",
+    "scheduled": "⏰ programada",
+    "recurring": "🔁 recurrente",
+    "calendar": "📅 calendario",
+}
+
+
+def publication_content(draft: Draft) -> Tuple[str, str]:
+    """(hash, json) del contenido publicable: tipo, media, texto, formato y botones."""
+    content: Dict[str, Any] = {
+        "type": draft.type,
+        "file_id": draft.file_id,
+        "text": draft.text,
+        "buttons": buttons_to_data(draft.buttons),
+    }
+    if draft.entities:
+        # Solo si hay formato: el hash de las publicaciones sin él no cambia
+        content["entities"] = entities_to_data(draft.entities)
+    if draft.source:
+        content["source"] = list(draft.source)
+    data = json.dumps(
+        content,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32], data
+
+
+def history_record(draft: Draft, key: str, user_id: Optional[int]) -> Dict[str, Any]:
+    content_hash, data = publication_content(draft)
+    return {
+        "user_id": user_id,
+        "target": str(TARGET_CHAT_ID),
+        "content_hash": content_hash,
+        "data": data,
+        "template_id": draft.template_id,
+        "kind": HISTORY_KINDS.get(key.split(":", 1)[0], "now"),
+    }
+
+
+def _append_history(
+    conn: sqlite3.Connection, record: Dict[str, Any], message_id: Optional[int], sent_at: float
+) -> None:
+    conn.execute(
+        "INSERT OR IGNORE INTO history_content (hash, data) VALUES (?, ?)",
+        (record["content_hash"], record["data"]),
+    )
+    cur = conn.execute(
+        "INSERT INTO history"
+        " (sent_at, user_id, target, message_id, content_hash, template_id, kind)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            sent_at,
+            record["user_id"],
+            record["target"],
+            message_id,
+            record["content_hash"],
+            record["template_id"],
+            record["kind"],
+        ),
+    )
+    if message_id is not None:
+        conn.execute(
+            "INSERT INTO post_tracking (history_id, message_id, sent_at, next_check)"
+            " VALUES (?, ?, ?, ?)",
+            (cur.lastrowid, message_id, sent_at, sent_at + ANALYTICS_INTERVALS[0][1]),
+        )
+
+
+def query_history(
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    template_id: Optional[int] = None,
+    before_id: Optional[int] = None,
+    limit: int = HISTORY_PAGE_SIZE,
+) -> List[Tuple[Any, ...]]:
+    """Una página, de la más reciente a la más antigua (paginación por id)."""
+    clauses: List[str] = []
+    params: List[Any] = []
+    if since is not None:
+        clauses.append("sent_at >= ?")
+        params.append(since)
+    if until is not None:
+        clauses.append("sent_at < ?")
+        params.append(until)
+    if template_id is not None:
+        clauses.append("template_id = ?")
+        params.append(template_id)
+    if before_id is not None:
+        clauses.append("id < ?")
+        params.append(before_id)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    params.append(limit)
+    return _db().execute(
+        "SELECT id, sent_at, message_id, content_hash, template_id, kind FROM history"
+        f"{where} ORDER BY id DESC LIMIT ?",
+        params,
+    ).fetchall()
+
+
+def history_publication(history_id: int) -> Optional[Draft]:
+    """Borrador con el contenido exacto que se publicó (mismos file_id, texto y botones)."""
+    row = _db().execute(
+        "SELECT h.template_id, c.data FROM history h"
+        " JOIN history_content c ON c.hash = h.content_hash WHERE h.id = ?",
+        (history_id,),
+    ).fetchone()
+    if row is None:
+        return None
+    data = json.loads(row[1])
+    return Draft(
+        type=data.get("type"),
+        file_id=data.get("file_id"),
+        text=data.get("text") or "",
+        buttons=buttons_from_data(data.get("buttons")),
+        template_id=row[0],
+        entities=entities_from_data(data.get("entities")),
+        source=tuple(data["source"]) if data.get("source") else None,  # type: ignore[arg-type]
+    )
+
+
+def clone_history_entry(user_id: int, history_id: int) -> Optional[Draft]:
+    """Nuevo borrador activo copiado de la publicación; el anterior se guarda."""
+    draft = history_publication(history_id)
+    if draft is None:
+        return None
+    _shelve_active_draft(user_id)
+    draft.name = f"Copia de #{history_id}"
+    draft_ref(user_id, draft)
+    DRAFTS[user_id] = draft
+    mark_user_dirty(user_id)
+    return draft
+
+
+def parse_history_filter(args: List[str]) -> Dict[str, Any]:
+    """
+    /historial [AAAA-MM-DD [AAAA-MM-DD]] [plantilla N]
+    Las fechas son días locales; la segunda se incluye entera.
+    """
+    result: Dict[str, Any] = {"since": None, "until": None, "template_id": None}
+    dates: List[datetime] = []
+    tokens = list(args)
+    while tokens:
+        token = tokens.pop(0).lower()
+        if token in ("plantilla", "template"):
+            if not tokens:
+                raise ValueError("falta el número de plantilla")
+            try:
+                result["template_id"] = int(tokens.pop(0).lstrip("#"))
+            except ValueError:
+                raise ValueError("el número de plantilla debe ser entero")
+            continue
+        try:
+            dates.append(datetime.strptime(token, "%Y-%m-%d").replace(tzinfo=LOCAL_TZ))
+        except ValueError:
+            raise ValueError(f"no entiendo {token!r}")
+    if len(dates) > 2:
+        raise ValueError("como máximo dos fechas")
+    if dates:
+        result["since"] = dates[0].timestamp()
+        result["until"] = (dates[-1] + timedelta(days=1)).timestamp()
+    return result
+
+
+def build_history_page(
+    history_filter: Dict[str, Any], before_id: Optional[int]
+) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Una página del historial con botones para duplicar o reprogramar cada entrada."""
+    rows = query_history(
+        history_filter["since"],
+        history_filter["until"],
+        history_filter["template_id"],
+        before_id,
+        HISTORY_PAGE_SIZE + 1,
+    )
+    has_more = len(rows) > HISTORY_PAGE_SIZE
+    rows = rows[:HISTORY_PAGE_SIZE]
+    if not rows:
+        if before_id is None:
+            return "No hay publicaciones en el historial con ese filtro.", None
+        return "No hay más publicaciones.", None
+    lines = ["🗃 Historial de publicaciones:"]
+    for row_id, sent_at, message_id, content_hash, template_id, kind in rows:
+        when = datetime.fromtimestamp(sent_at, LOCAL_TZ).strftime("%Y-%m-%d %H:%M")
+        url = "https://t.me/JohaaleTrader_es"
+        if message_id is not None:
+            url = f"{url}/{message_id}"
+        template = f" · plantilla #{template_id}" if template_id is not None else ""
+        lines.append(
+            f"#{row_id} {when} · {HISTORY_KIND_LABELS.get(kind, kind)}{template}\n{url}"
+        )
+    keyboard = [
+        [
+            InlineKeyboardButton(f"📋 Duplicar #{row[0]}", callback_data=f"HIST_DUP_{row[0]}"),
+            InlineKeyboardButton(f"⏰ Reprogramar #{row[0]}", callback_data=f"HIST_RESCHED_{row[0]}"),
+        ]
+        for row in rows
+    ]
+    if has_more:
+        keyboard.append(
+            [InlineKeyboardButton("⬇️ Más antiguas", callback_data=f"HIST_PAGE_{rows[-1][0]}")]
+        )
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
+# --------- Estadísticas del canal ---------
+# La Bot API no da vistas ni reenvíos de los mensajes de un canal. Las vistas
+# sí aparecen en el widget público (t.me/<canal>/<id>?embed=1) de los canales
+# públicos, así que el recolector lee de ahí; los reenvíos no se publican en
+# ningún sitio accesible y no se recogen. Un job revisa en cada pasada como
+# mucho ANALYTICS_BATCH_SIZE publicaciones vencidas, con pocas peticiones en
+# paralelo. Cada una se vuelve a mirar según su edad (y con menos frecuencia
+# si las vistas no cambian); pasado el último tramo se deja de seguir.
+ANALYTICS_INTERVALS: Tuple[Tuple[float, float], ...] = (
+    # (edad máxima, intervalo entre lecturas) en segundos
+    (3600, 5 * 60),
+    (24 * 3600, 30 * 60),
+    (7 * 24 * 3600, 6 * 3600),
+    (30 * 24 * 3600, 24 * 3600),
+)
+_ANALYTICS: Dict[str, Any] = {"client": None, "pause_until": 0.0, "fetched": 0, "errors": 0}
+_VIEWS_RE = re.compile(r'tgme_widget_message_views">\s*([0-9.,]+)\s*([KMkm]?)\s*<')
+
+
+def parse_view_count(html: str) -> Optional[int]:
+    match = _VIEWS_RE.search(html)
+    if match is None:
+        return None
+    number = float(match.group(1).replace(",", "."))
+    scale = {"": 1, "k": 1_000, "m": 1_000_000}[match.group(2).lower()]
+    return int(number * scale)
+
+
+def next_analytics_check(sent_at: float, now: float, unchanged: int) -> Optional[float]:
+    age = now - sent_at
+    for max_age, interval in ANALYTICS_INTERVALS:
+        if age < max_age:
+            # Si las vistas no se mueven se espera más, hasta 8 veces el intervalo
+            return now + interval * min(2 ** unchanged, 8)
+    return None
+
+
+async def fetch_post_views(message_id: int) -> Optional[int]:
+    client = _ANALYTICS["client"]
+    if client is None:
+        client = _ANALYTICS["client"] = httpx.AsyncClient(
+            timeout=10.0, headers={"User-Agent": "Mozilla/5.0 (postbot stats)"}
+        )
+    response = await client.get(
+        f"https://t.me/{ANALYTICS_CHANNEL}/{message_id}", params={"embed": "1"}
+    )
+    if response.status_code == 429:
+        retry_after = float(response.headers.get("Retry-After", "300") or 300)
+        _ANALYTICS["pause_until"] = time.time() + retry_after
+        return None
+    response.raise_for_status()
+    views = parse_view_count(response.text)
+    if views is None:
+        # Si cambia el HTML del widget hay que enterarse, no contarlo como "sin cambios"
+        raise ValueError("la página no trae el contador de vistas")
+    return views
+
+
+def record_post_views(history_id: int, sent_at: float, views: Optional[int], now: float) -> None:
+    conn = _db()
+    row = conn.execute(
+        "SELECT last_views, unchanged FROM post_tracking WHERE history_id = ?", (history_id,)
+    ).fetchone()
+    if row is None:
+        return
+    last_views, unchanged = row
+    if views is None or views == last_views:
+        unchanged += 1
+    else:
+        unchanged = 0
+    with conn:
+        if views is not None and views != last_views:
+            conn.execute(
+                "INSERT OR REPLACE INTO post_views (history_id, ts, views) VALUES (?, ?, ?)",
+                (history_id, int(now), views),
+            )
+        conn.execute(
+            "UPDATE post_tracking SET last_views = COALESCE(?, last_views), unchanged = ?,"
+            " next_check = ? WHERE history_id = ?",
+            (views, unchanged, next_analytics_check(sent_at, now, unchanged), history_id),
+        )
+
+
+async def collect_post_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    begin_job_trace(context)
+    if not ANALYTICS_CHANNEL:
+        return
+    now = time.time()
+    if now < _ANALYTICS["pause_until"]:
+        return
+    due = _db().execute(
+        "SELECT history_id, message_id, sent_at FROM post_tracking"
+        " WHERE next_check IS NOT NULL AND next_check <= ?"
+        " ORDER BY next_check LIMIT ?",
+        (now, ANALYTICS_BATCH_SIZE),
+    ).fetchall()
+    if not due:
+        return
+    semaphore = asyncio.Semaphore(ANALYTICS_CONCURRENCY)
+
+    async def refresh(history_id: int, message_id: int, sent_at: float) -> None:
+        async with semaphore:
+            if time.time() < _ANALYTICS["pause_until"]:
+                return
+            try:
+                views = await fetch_post_views(message_id)
+                _ANALYTICS["fetched"] += 1
+            except Exception as exc:
+                _ANALYTICS["errors"] += 1
+                logging.info("No se pudieron leer las vistas de %s: %s", message_id, exc)
+                views = None
+            record_post_views(history_id, sent_at, views, time.time())
+
+    await asyncio.gather(*(refresh(*row) for row in due))
+
+
+async def close_analytics() -> None:
+    client = _ANALYTICS["client"]
+    _ANALYTICS["client"] = None
+    if client is not None:
+        await client.aclose()
+
+
+def template_performance(user_id: int, limit: int = 10) -> List[Tuple[Any, ...]]:
+    """(template_id, publicaciones, media de vistas, máximo) de las plantillas del usuario."""
+    return _db().execute(
+        "SELECT h.template_id, COUNT(*), AVG(t.last_views), MAX(t.last_views)"
+        " FROM history h JOIN post_tracking t ON t.history_id = h.id"
+        " WHERE h.user_id = ? AND h.template_id IS NOT NULL AND t.last_views IS NOT NULL"
+        " GROUP BY h.template_id ORDER BY AVG(t.last_views) DESC LIMIT ?",
+        (user_id, limit),
+    ).fetchall()
+
+
+def top_posts(limit: int = 5) -> List[Tuple[Any, ...]]:
+    return _db().execute(
+        "SELECT h.message_id, h.sent_at, t.last_views FROM post_tracking t"
+        " JOIN history h ON h.id = t.history_id WHERE t.last_views IS NOT NULL"
+        " ORDER BY t.last_views DESC LIMIT ?",
+        (limit,),
+    ).fetchall()
+
+
+async def send_publication_to_target(
+    draft: Draft,
+    context: ContextTypes.DEFAULT_TYPE,
+    key: Optional[str] = None,
+    user_id: Optional[int] = None,
+    values: Optional[Dict[str, str]] = None,
+) -> Any:
+    """
+    Envía el borrador al canal. Con `key` el envío pasa por el outbox: si la
+    clave ya estaba registrada devuelve un OutboxHit en lugar de reenviar. Los
+    envíos confirmados quedan en el historial. Con `values` se sustituyen
+    las {variables} del texto.
+    """
+    if not draft_has_content(draft):
+        return None
+
+    if values is not None:
+        rendered, entities = render_with_entities(draft.text, draft.entities, values)
+        if rendered != draft.text:
+            draft = draft.copy()
+            draft.text = rendered
+            draft.entities = entities
+
+    buttons = draft.buttons
+    reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
+    parts = publication_parts(draft)
+    title = _make_template_title(draft.text, 0)
+
+    # Cada trozo tiene su propia clave (key, key#2, ...): si un reintento llega
+    # tras enviar parte de la publicación, sigue por el primer trozo pendiente.
+    # Los botones van en el último mensaje.
+    first: Any = None
+    sent_any = False
+    for index, (part, part_entities) in enumerate(parts):
+        part_key = key if key is None or index == 0 else f"{key}#{index + 1}"
+        if part_key is not None:
+            hit = outbox_claim(part_key, title)
+            if hit is not None:
+                if hit.state != "sent":
+                    # No se sabe si llegó: no se envía nada detrás
+                    logging.warning("Envío duplicado evitado (%s, estado %s).", part_key, hit.state)
+                    return hit
+                if index == 0:
+                    first = hit
+                continue
+
+        last = index == len(parts) - 1
+        # Envíos en curso: la parada ordenada espera a que terminen
+        _SHUTDOWN_STATE["inflight_sends"] += 1
+        try:
+            message = await send_content(
+                context,
+                TARGET_CHAT_ID,
+                draft.type if index == 0 else "text",
+                draft.file_id if index == 0 else None,
+                part,
+                reply_markup if last else None,
+                part_entities,
+                draft.source if index == 0 else None,
+            )
+        except Exception as exc:
+            if part_key is not None:
+                # Si no se sabe si llegó al canal se queda en "pending" y no se reintenta
+                state = "pending" if classify_send_error(exc) == "unknown" else "failed"
+                outbox_finish(part_key, state, error=str(exc))
+            raise
+        finally:
+            _SHUTDOWN_STATE["inflight_sends"] -= 1
+
+        sent_any = True
+        if index == 0:
+            first = message
+        if part_key is not None:
+            outbox_finish(
+                part_key,
+                "sent",
+                message_id=getattr(message, "message_id", None),
+                history=history_record(draft, key, user_id) if index == 0 else None,
+            )
+
+    if isinstance(first, OutboxHit):
+        if sent_any:
+            logging.info("Publicación %s completada tras un envío parcial.", key)
+        else:
+            logging.warning("Envío duplicado evitado (%s, estado %s).", key, first.state)
+    else:
+        logging.info(
+            "Publicación enviada al canal.",
+            extra={
+                "event": "published",
+                "message_id": getattr(first, "message_id", None),
+                "parts": len(parts),
+            },
+        )
+    return first
+
+
+# --------- Reintentos ---------
+# Los errores transitorios (429, no se pudo conectar) pasan a una cola (en
+# memoria y en la tabla send_retries, para retomarlos tras un reinicio) y se
+# reintentan con un job por intento. Los definitivos (file_id
+# borrado, sin permisos en el canal...) y los que pueden haber llegado al
+# canal (timeout leyendo la respuesta) no se reintentan. El admin recibe un
+# único aviso cuando el envío se da por perdido.
+_RETRY_QUEUE: Dict[str, Dict[str, Any]] = {}
+_RETRY_STATS: Dict[str, int] = {
+    "errors": 0,
+    "retries": 0,
+    "recovered": 0,
+    "exhausted": 0,
+    "fatal": 0,
+    "unknown": 0,
+}
+
+# Fallos de httpx en los que la petición no llegó a Telegram
+_UNSENT_NETWORK_ERRORS = frozenset(
+    {"ConnectError", "ConnectTimeout", "PoolTimeout", "WriteError", "WriteTimeout"}
+)
+
+
+def classify_send_error(exc: BaseException) -> str:
+    """"retry" (seguro reintentar), "unknown" (pudo llegar al canal) o "fatal"."""
+    if isinstance(exc, RetryAfter):
+        return "retry"
+    if isinstance(exc, BadRequest):
+        # Subclase de NetworkError, pero es un rechazo definitivo
+        return "fatal"
+    if isinstance(exc, NetworkError):
+        cause = exc.__cause__
+        if cause is None and not isinstance(exc, TimedOut):
+            # 5xx de Telegram: la petición no se procesó
+            return "retry"
+        if type(cause).__name__ in _UNSENT_NETWORK_ERRORS:
+            return "retry"
+        return "unknown"
+    return "fatal"
+
+
+def retry_delay(attempt: int, exc: BaseException) -> float:
+    # Backoff exponencial con "full jitter": cualquier espera entre 0 y el tope
+    delay = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** attempt))
+    delay = random.uniform(0, delay)
+    if isinstance(exc, RetryAfter):
+        delay = max(delay, float(exc.retry_after) + random.uniform(0, 1))
+    return delay
+
+
+def store_send_retry(item: Dict[str, Any]) -> None:
+    data = {
+        "publication": item["publication"].to_data(),
+        "values": item["values"],
+        "user_id": item["user_id"],
+        "label": item["label"],
+        "attempt": item["attempt"],
+        "corr": item.get("corr"),
+    }
+    conn = _db()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO send_retries (key, data) VALUES (?, ?)",
+            (item["key"], json.dumps(data, ensure_ascii=False)),
+        )
+
+
+def drop_send_retry(key: str) -> None:
+    _RETRY_QUEUE.pop(key, None)
+    conn = _db()
+    with conn:
+        conn.execute("DELETE FROM send_retries WHERE key = ?", (key,))
+
+
+def restore_send_retries(job_queue: Any) -> int:
+    """Vuelve a encolar los reintentos que quedaron pendientes al parar."""
+    rows = _db().execute("SELECT key, data FROM send_retries").fetchall()
+    for key, raw in rows:
+        data = json.loads(raw)
+        _RETRY_QUEUE[key] = {
+            "key": key,
+            "publication": Draft.from_data(data["publication"]),
+            "values": data.get("values"),
+            "user_id": data["user_id"],
+            "label": data["label"],
+            "attempt": data["attempt"],
+            "corr": data.get("corr"),
+        }
+        job_queue.run_once(
+            run_send_retry,
+            random.uniform(RETRY_BASE_DELAY_SECONDS, 2 * RETRY_BASE_DELAY_SECONDS),
+            data=key,
+            name=f"retry:{key}",
+        )
+    return len(rows)
+
+
+async def publish_with_retry(
+    context: ContextTypes.DEFAULT_TYPE,
+    publication: Draft,
+    key: str,
+    user_id: int,
+    label: str,
+    variables: Optional[Dict[str, str]] = None,
+) -> Any:
+    """
+    Envía al canal; si falla, encola el reintento o avisa del fallo definitivo.
+    Devuelve el mensaje (o un OutboxHit) y None si ahora no se pudo enviar.
+    Las {variables} se resuelven con la hora de este primer intento.
+    """
+    values = template_values(user_id, variables)
+    token = _PUBLICATION_KEY.set(key)
+    try:
+        return await send_publication_to_target(
+            publication, context, key=key, user_id=user_id, values=values
+        )
+    except Exception as exc:
+        item = {
+            "key": key,
+            "publication": publication.copy(),
+            "values": values,
+            "user_id": user_id,
+            "label": label,
+            "attempt": 0,
+            "corr": _CORRELATION_ID.get(),
+        }
+        await handle_send_error(context, item, exc)
+        return None
+    finally:
+        _PUBLICATION_KEY.reset(token)
+
+
+async def handle_send_error(
+    context: ContextTypes.DEFAULT_TYPE, item: Dict[str, Any], exc: BaseException
+) -> None:
+    _RETRY_STATS["errors"] += 1
+    key = item["key"]
+    kind = classify_send_error(exc)
+    if kind == "retry" and item["attempt"] + 1 < RETRY_MAX_ATTEMPTS:
+        delay = retry_delay(item["attempt"], exc)
+        item["attempt"] += 1
+        _RETRY_QUEUE[key] = item
+        store_send_retry(item)
+        _RETRY_STATS["retries"] += 1
+        context.application.job_queue.run_once(  # type: ignore[union-attr]
+            run_send_retry, delay, data=key, name=f"retry:{key}"
+        )
+        logging.warning(
+            "Envío %s falló (%s); reintento %s en %.1fs.", key, exc, item["attempt"], delay
+        )
+        return
+
+    drop_send_retry(key)
+    if kind == "fatal":
+        _RETRY_STATS["fatal"] += 1
+        text = (
+            f"❌ No se pudo publicar {item['label']}: {exc}\n"
+            "El error es definitivo; no se reintentará."
+        )
+    elif kind == "unknown":
+        _RETRY_STATS["unknown"] += 1
+        text = (
+            f"❓ {item['label']}: no consta si llegó al canal ({exc}).\n"
+            "Revisa el canal; no se reenviará automáticamente."
+        )
+    else:
+        _RETRY_STATS["exhausted"] += 1
+        text = f"❌ No se pudo publicar {item['label']} tras {item['attempt'] + 1} intentos: {exc}"
+    logging.error("Envío %s abandonado (%s): %s", key, kind, exc)
+    try:
+        await context.bot.send_message(chat_id=item["user_id"], text=text)
+    except Exception as notify_exc:
+        logging.error("No se pudo avisar al admin %s: %s", item["user_id"], notify_exc)
+
+
+async def run_send_retry(context: ContextTypes.DEFAULT_TYPE) -> None:
+    key = context.job.data if context.job else None  # type: ignore[union-attr]
+    item = _RETRY_QUEUE.get(key)  # type: ignore[arg-type]
+    if item is None:
+        return
+    begin_job_trace(context, item.get("corr"))
+    _PUBLICATION_KEY.set(key)
+    try:
+        message = await send_publication_to_target(
+            item["publication"],
+            context,
+            key=key,
+            user_id=item["user_id"],
+            values=item["values"],
+        )
+    except Exception as exc:
+        await handle_send_error(context, item, exc)
+        return
+    drop_send_retry(key)  # type: ignore[arg-type]
+    if isinstance(message, OutboxHit) and message.state != "sent":
+        _RETRY_STATS["unknown"] += 1
+        text = f"❓ {item['label']}: hay un envío previo sin confirmar. Revisa el canal."
+    else:
+        _RETRY_STATS["recovered"] += 1
+        url = "https://t.me/JohaaleTrader_es"
+        post_id = getattr(message, "message_id", None)
+        if post_id is not None:
+            url = f"{url}/{post_id}"
+        text = f"✅ {item['label'].capitalize()} enviada tras {item['attempt']} reintento(s): {url}"
+    try:
+        await context.bot.send_message(chat_id=item["user_id"], text=text)
+    except Exception as exc:
+        logging.error("No se pudo avisar al admin %s: %s", item["user_id"], exc)
 
 
 
@@ -332,6 +2783,250 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await send_main_menu_simple(context, chat_id, user_id)
 
 
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/exportar [gz]: envía plantillas y botones predeterminados como JSONL."""
+    if not is_admin_private(update):
+        return
+
+    user_id = update.effective_user.id  # type: ignore[union-attr]
+    chat_id = update.effective_chat.id  # type: ignore[union-attr]
+    compress = bool(context.args) and context.args[0].lower() in ("gz", "gzip")
+
+    filename = "plantillas.jsonl.gz" if compress else "plantillas.jsonl"
+    fd, path = tempfile.mkstemp(suffix=".jsonl")
+    os.close(fd)
+    try:
+        count = write_export_file(user_id, path, compress)
+        with open(path, "rb") as fh:
+            await context.bot.send_document(
+                chat_id=chat_id,
+                document=fh,
+                filename=filename,
+                caption=f"Exportación: {count} registros.",
+            )
+    finally:
+        os.unlink(path)
+
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_admin_private(update):
+        return
+
+    chat_id = update.effective_chat.id  # type: ignore[union-attr]
+    context.user_data["state"] = "AWAITING_IMPORT_DOCUMENT"
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=(
+            "Envía ahora el archivo .jsonl (o .jsonl.gz) generado con /exportar.\n"
+            "Las plantillas repetidas se ignoran."
+        ),
+    )
+
+
+async def variable_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/variable [nombre [valor]]: lista, borra o fija valores para {nombre}."""
+    if not is_admin_private(update):
+        return
+
+    user_id = update.effective_user.id  # type: ignore[union-attr]
+    chat_id = update.effective_chat.id  # type: ignore[union-attr]
+    variables = get_defaults(user_id)["variables"]
+    args = context.args or []
+
+    if not args:
+        lines = ["🔤 Variables para las plantillas:"]
+        lines.append("{fecha}, {hora} y {dia}: automáticas, con la hora del envío.")
+        for name, value in sorted(variables.items()):
+            lines.append(f"{{{name}}} = {value}")
+        lines.append("")
+        lines.append("Uso: /variable nombre valor · /variable nombre (borra)")
+        await context.bot.send_message(chat_id=chat_id, text="\n".join(lines))
+        return
+
+    name = args[0].strip("{}")
+    try:
+        parse_variable_assignments(f"{name}=x")
+    except ValueError as exc:
+        await context.bot.send_message(chat_id=chat_id, text=f"Variable inválida: {exc}")
+        return
+    if name in ("fecha", "hora", "dia"):
+        await context.bot.send_message(
+            chat_id=chat_id, text=f"{{{name}}} es automática y no se puede cambiar."
+        )
+        return
+    if len(args) == 1:
+        removed = variables.pop(name, None)
+        text = f"Variable {{{name}}} eliminada." if removed is not None else f"{{{name}}} no tenía valor."
+    else:
+        variables[name] = " ".join(args[1:])
+        text = f"✅ {{{name}}} = {variables[name]}"
+    mark_user_dirty(user_id)
+    await context.bot.send_message(chat_id=chat_id, text=text)
+
+
+async def format_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/formato [html|normal]: cómo se interpreta el texto que escribes."""
+    if not is_admin_private(update):
+        return
+
+    user_id = update.effective_user.id  # type: ignore[union-attr]
+    chat_id = update.effective_chat.id  # type: ignore[union-attr]
+    defaults = get_defaults(user_id)
+    choice = (context.args or [""])[0].lower()
+
+    if choice == "html":
+        defaults["format"] = "html"
+    elif choice == "normal":
+        defaults["format"] = ""
+    elif choice:
+        await context.bot.send_message(chat_id=chat_id, text="Uso: /formato html · /formato normal")
+        return
+    mark_user_dirty(user_id)
+
+    if defaults["format"] == "html":
+        text = (
+            "Modo HTML activo: <b>, <i>, <u>, <s>, <code>, <pre>, <a href=\"...\"> "
+            "y <tg-spoiler> se convierten en formato al guardar el texto.\n"
+            "El formato hecho con el editor de Telegram se respeta siempre."
+        )
+    else:
+        text = (
+            "Modo normal: se guarda el formato hecho con el editor de Telegram "
+            "(negrita, cursiva, enlaces...).\nPara escribir HTML usa /formato html."
+        )
+    await context.bot.send_message(chat_id=chat_id, text=text)
+
+
+async def copy_mode_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/copia [on|off]: publicar también foto, video y voz copiando tu mensaje."""
+    if not is_admin_private(update):
+        return
+
+    user_id = update.effective_user.id  # type: ignore[union-attr]
+    chat_id = update.effective_chat.id  # type: ignore[union-attr]
+    defaults = get_defaults(user_id)
+    choice = (context.args or [""])[0].lower()
+
+    if choice in ("on", "si", "sí"):
+        defaults["copy_mode"] = True
+    elif choice in ("off", "no"):
+        defaults["copy_mode"] = False
+    elif choice:
+        await context.bot.send_message(chat_id=chat_id, text="Uso: /copia on · /copia off")
+        return
+    mark_user_dirty(user_id)
+
+    if defaults["copy_mode"]:
+        text = (
+            "Modo copia activo: todo lo que envíes como publicación se copiará al "
+            "canal tal cual (con copy_message). No borres los originales de este chat."
+        )
+    else:
+        text = (
+            "Modo copia desactivado: foto, video y voz se reenvían por file_id. "
+            "GIF, documentos, encuestas y demás se copian siempre."
+        )
+    await context.bot.send_message(chat_id=chat_id, text=text)
+
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/historial [AAAA-MM-DD [AAAA-MM-DD]] [plantilla N]"""
+    if not is_admin_private(update):
+        return
+
+    chat_id = update.effective_chat.id  # type: ignore[union-attr]
+    try:
+        history_filter = parse_history_filter(context.args or [])
+    except ValueError as exc:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=(
+                f"Filtro inválido: {exc}.\n"
+                "Uso: /historial [AAAA-MM-DD [AAAA-MM-DD]] [plantilla N]"
+            ),
+        )
+        return
+    # El filtro se guarda para las páginas siguientes
+    context.user_data["history_filter"] = history_filter
+    text, keyboard = build_history_page(history_filter, None)
+    await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard)
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/estadisticas: plantillas y publicaciones con más vistas."""
+    if not is_admin_private(update):
+        return
+
+    user_id = update.effective_user.id  # type: ignore[union-attr]
+    chat_id = update.effective_chat.id  # type: ignore[union-attr]
+    if not ANALYTICS_CHANNEL:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=(
+                "Las estadísticas están desactivadas: define ANALYTICS_CHANNEL "
+                "con el @usuario público del canal."
+            ),
+        )
+        return
+
+    lines = ["📊 Plantillas con más vistas (media por publicación):"]
+    ranking = template_performance(user_id)
+    if not ranking:
+        lines.append("Todavía no hay datos de publicaciones hechas con plantillas.")
+    for template_id, posts, avg_views, max_views in ranking:
+        tpl = get_template_by_id(user_id, template_id)
+        title = tpl["title"] if tpl else f"Plantilla #{template_id} (eliminada)"
+        lines.append(f"• {title}: {avg_views:.0f} vistas · {posts} publ. · máx. {max_views}")
+    best = top_posts()
+    if best:
+        lines.append("")
+        lines.append("🏆 Publicaciones con más vistas:")
+        for message_id, sent_at, views in best:
+            when = datetime.fromtimestamp(sent_at, LOCAL_TZ).strftime("%Y-%m-%d")
+            lines.append(f"• {views} vistas · {when} · https://t.me/{ANALYTICS_CHANNEL}/{message_id}")
+    lines.append("")
+    lines.append("Las vistas salen del widget público del canal; Telegram no da los reenvíos.")
+    await context.bot.send_message(chat_id=chat_id, text="\n".join(lines))
+
+
+def _format_seconds(value: Optional[float]) -> str:
+    return "—" if value is None else f"{value:.2f}s"
+
+
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/memoria: uso de memoria del estado por usuario."""
+    if not is_admin_private(update):
+        return
+
+    chat_id = update.effective_chat.id  # type: ignore[union-attr]
+    info = memory_footprint(context.application)
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=(
+            "🧠 Estado en memoria:\n"
+            f"Usuarios activos: {info['active_users']} (máx. {STATE_MAX_ACTIVE_USERS})\n"
+            f"Usuarios guardados en disco: {info['stored_users']}\n"
+            f"Pendientes de guardar: {info['dirty_users']}\n"
+            f"Borradores: ~{info['drafts_bytes'] / 1024:.1f} KB\n"
+            f"Botones y plantillas: ~{info['defaults_bytes'] / 1024:.1f} KB\n"
+            f"user_data: {info['user_data_entries']} entradas\n"
+            f"Biblioteca de medios: {info['media_library']}/{MEDIA_LIBRARY_CAPACITY}\n"
+            f"Entradas programadas: {info['schedule_entries']}\n"
+            f"Reintentos en cola: {len(_RETRY_QUEUE)} · errores {_RETRY_STATS['errors']} · "
+            f"reintentos {_RETRY_STATS['retries']} · recuperados {_RETRY_STATS['recovered']} · "
+            f"perdidos {_RETRY_STATS['exhausted'] + _RETRY_STATS['fatal']} · "
+            f"sin confirmar {_RETRY_STATS['unknown']}\n"
+            f"Vistas previas: {_PREVIEW_STATS['sent']} enviadas · "
+            f"{_PREVIEW_STATS['edited']} editadas · {_PREVIEW_STATS['unchanged']} sin cambios\n"
+            f"Expulsados: {info['evicted']} · Restaurados: {info['restored']} · "
+            f"Volcados: {info['flushed']}\n"
+            f"Inactividad para expulsar: {STATE_IDLE_TTL_SECONDS // 60} min\n"
+            f"Arranque: listo en {_format_seconds(_STARTUP['ready'])} · "
+            f"primer update en {_format_seconds(_STARTUP['first_update'])}"
+        ),
+    )
+
+
 # --------- Callbacks de botones ---------
 async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
@@ -350,25 +3045,13 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # --- Menú principal ---
     if data == "MENU_CREATE":
+        forget_preview(user_id)
         templates = get_templates(user_id)
         if templates:
-            keyboard = [
-                [
-                    InlineKeyboardButton(
-                        "✔ Sí, usar plantilla", callback_data="NEWPUB_USE_TEMPLATE"
-                    )
-                ],
-                [
-                    InlineKeyboardButton(
-                        "✏️ No, escribir texto nuevo", callback_data="NEWPUB_NO_TEMPLATE"
-                    )
-                ],
-                [InlineKeyboardButton("❌ Cancelar", callback_data="BACK_TO_MENU")],
-            ]
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="¿Quieres usar una plantilla de texto guardada?",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=static_keyboard("use_template"),
             )
         else:
             context.user_data["state"] = "AWAITING_NEW_PUBLICATION_MESSAGE"
@@ -378,7 +3061,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 chat_id=chat_id,
                 text=(
                     "Envía ahora la publicación como si fueras a enviarla al canal "
-                    "(puede ser foto+texto, video+texto, nota de voz o solo texto)."
+                    "(foto, video, nota de voz, texto, GIF, documento, encuesta...)."
                 ),
             )
 
@@ -392,12 +3075,12 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await send_main_menu_simple(context, chat_id, user_id)
         else:
             keyboard_rows: List[List[InlineKeyboardButton]] = []
-            for idx, tpl in enumerate(templates):
+            for tpl in templates:
                 keyboard_rows.append(
                     [
                         InlineKeyboardButton(
                             tpl["title"],
-                            callback_data=f"NEWPUB_TEMPLATE_{idx}",
+                            callback_data=f"NEWPUB_TEMPLATE_{tpl['id']}",
                         )
                     ]
                 )
@@ -412,16 +3095,11 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     elif data.startswith("NEWPUB_TEMPLATE_"):
         try:
-            idx = int(data.split("_")[-1])
+            template_id = int(data.split("_")[-1])
         except ValueError:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Plantilla no válida.",
-            )
-            await send_main_menu_simple(context, chat_id, user_id)
-            return
-        templates = get_templates(user_id)
-        if idx < 0 or idx >= len(templates):
+            template_id = -1
+        selected_tpl = get_template_by_id(user_id, template_id)
+        if selected_tpl is None:
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="Plantilla no válida.",
@@ -429,8 +3107,8 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await send_main_menu_simple(context, chat_id, user_id)
             return
 
-        selected = templates[idx]
-        context.user_data["selected_template_text"] = selected["text"]
+        context.user_data["selected_template_text"] = selected_tpl["text"]
+        context.user_data["selected_template_id"] = selected_tpl["id"]
         context.user_data["state"] = "AWAITING_NEW_PUBLICATION_MESSAGE"
         context.user_data["after_buttons_action"] = "FINAL_MENU"
         await context.bot.send_message(
@@ -449,7 +3127,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             chat_id=chat_id,
             text=(
                 "Envía ahora la publicación como si fueras a enviarla al canal "
-                "(puede ser foto+texto, video+texto, nota de voz o solo texto)."
+                "(foto, video, nota de voz, texto, GIF, documento, encuesta...)."
             ),
         )
 
@@ -458,7 +3136,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await context.bot.send_message(
             chat_id=chat_id,
             text="Gestión de botones para el borrador actual:",
-            reply_markup=InlineKeyboardMarkup(build_buttons_menu_keyboard()),
+            reply_markup=static_keyboard("buttons_menu"),
         )
 
     elif data == "MENU_SCHEDULE":
@@ -474,8 +3152,10 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 chat_id=chat_id,
                 text=(
                     "Introduce la fecha y hora en formato AAAA-MM-DD HH:MM\n"
-                    "Ejemplo: 2025-12-31 18:30"
+                    "Ejemplo: 2025-12-31 18:30\n"
+                    f"Horario de publicación: {describe_post_windows()}."
                 ),
+                reply_markup=slot_keyboard(suggest_slot()),
             )
 
     elif data == "MENU_SEND_NOW":
@@ -486,15 +3166,36 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 text="No hay borrador actual para enviar.",
             )
         else:
-            if draft.get("job") is not None:
+            if draft.job is not None:
                 try:
-                    draft["job"].schedule_removal()
+                    draft.job.schedule_removal()
                 except Exception:
                     pass
-                draft["job"] = None
-                draft["scheduled_at"] = None
-
-            message = await send_publication_to_target(draft, context)
+                draft.job = None
+                draft.scheduled_at = None
+                note_draft_schedule(user_id, draft)
+
+            # El id del callback es el mismo si Telegram reentrega el update tras una caída
+            key = f"now:{query.id}"
+            message = await publish_with_retry(
+                context, draft, key, user_id, "la publicación"
+            )
+            if message is None:
+                if key in _RETRY_QUEUE:
+                    await context.bot.send_message(
+                        chat_id=chat_id,
+                        text="⏳ Telegram no respondió; se reintentará automáticamente.",
+                    )
+                return
+            if isinstance(message, OutboxHit) and message.state != "sent":
+                await context.bot.send_message(
+                    chat_id=chat_id,
+                    text=(
+                        "⚠️ Esta publicación ya se intentó enviar y no consta si llegó. "
+                        "Revisa el canal antes de volver a enviarla."
+                    ),
+                )
+                return
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="✅ Publicación enviada al canal.",
@@ -532,79 +3233,260 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             )
             await send_main_menu_simple(context, chat_id, user_id)
         else:
-            keyboard = [
-                [InlineKeyboardButton("✏️ Editar texto", callback_data="EDIT_TEXT")],
-                [InlineKeyboardButton("🔗 Editar botones", callback_data="EDIT_BUTTONS")],
-                [InlineKeyboardButton("🖼 Cambiar media", callback_data="EDIT_MEDIA")],
-                [InlineKeyboardButton("⬅️ Volver al menú", callback_data="BACK_TO_MENU")],
-            ]
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="Elige qué parte de la publicación quieres editar:",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=static_keyboard("edit_menu"),
             )
 
     elif data == "MENU_TEMPLATES":
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    "💾 Guardar texto actual como plantilla", callback_data="TEMPLATE_SAVE"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "📥 Insertar plantilla en borrador", callback_data="TEMPLATE_INSERT"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "📚 Ver plantillas guardadas", callback_data="TEMPLATE_VIEW"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "🗑 Eliminar plantilla guardada", callback_data="TEMPLATE_DELETE"
-                )
-            ],
-            [InlineKeyboardButton("❌ Cancelar y volver", callback_data="BACK_TO_MENU")],
-        ]
         await context.bot.send_message(
             chat_id=chat_id,
             text="Opciones de plantillas:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=static_keyboard("templates_menu"),
         )
 
     elif data == "MENU_CANCEL_DRAFT":
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    "Sí, cancelar borrador", callback_data="CONFIRM_CANCEL_DRAFT"
-                )
-            ],
-            [InlineKeyboardButton("⬅️ Volver al menú", callback_data="BACK_TO_MENU")],
-        ]
         await context.bot.send_message(
             chat_id=chat_id,
             text="¿Seguro que quieres cancelar y borrar el borrador actual?",
+            reply_markup=static_keyboard("confirm_cancel_draft"),
+        )
+
+    elif data.startswith("SEL_"):
+        selection = context.user_data.get("selection")
+        if selection is None:
+            await query.edit_message_text("Esta selección ha caducado.")
+            await send_main_menu_simple(context, chat_id, user_id)
+        elif data == "SEL_CANCEL":
+            context.user_data.pop("selection", None)
+            await query.edit_message_text(
+                build_main_menu_text(user_id), reply_markup=static_keyboard("main_menu")
+            )
+        elif data == "SEL_APPLY":
+            context.user_data.pop("selection", None)
+            confirmation = apply_selection(user_id, selection)
+            await query.edit_message_text(
+                f"{confirmation}\n\n{build_main_menu_text(user_id)}",
+                reply_markup=static_keyboard("main_menu"),
+            )
+        else:
+            if data == "SEL_ALL":
+                keys = {key for key, _ in selection_items(user_id, selection["kind"])}
+                selection["picked"] = set() if selection["picked"] == keys else keys
+            else:
+                selection["picked"] ^= {data.replace("SEL_TOGGLE_", "")}
+            try:
+                await query.edit_message_reply_markup(
+                    reply_markup=build_selection_keyboard(user_id, selection)
+                )
+            except BadRequest as exc:
+                # Dos pulsaciones seguidas iguales: el teclado no cambia
+                if "not modified" not in str(exc).lower():
+                    raise
+
+    elif data.startswith("HIST_PAGE_"):
+        try:
+            before_id = int(data.replace("HIST_PAGE_", ""))
+        except ValueError:
+            before_id = None
+        history_filter = context.user_data.get("history_filter") or parse_history_filter([])
+        text, keyboard = build_history_page(history_filter, before_id)
+        await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard)
+
+    elif data.startswith("SLOT_AT_"):
+        draft = get_draft(user_id)
+        try:
+            ts = float(data.replace("SLOT_AT_", ""))
+        except ValueError:
+            ts = 0.0
+        if not draft_has_content(draft):
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="No hay borrador actual para programar.",
+            )
+            return
+        if ts < time.time() + 1 or check_slot(ts, own_slot(draft)) is not None:
+            # El hueco sugerido ya pasó o se ha ocupado mientras tanto
+            when = suggest_slot(ts)
+        else:
+            when = datetime.fromtimestamp(ts, LOCAL_TZ).replace(tzinfo=None)
+        if when is None:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"No hay huecos libres en los próximos {SLOT_HORIZON_DAYS} días.",
+            )
+            return
+        schedule_active_draft(context, user_id, when)
+        context.user_data["state"] = None
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"✅ Publicación programada para {when.strftime('%Y-%m-%d %H:%M')}.",
+        )
+
+    elif data.startswith(("HIST_DUP_", "HIST_RESCHED_")):
+        prefix, _, raw_id = data.rpartition("_")
+        try:
+            draft = clone_history_entry(user_id, int(raw_id))
+        except ValueError:
+            draft = None
+        if draft is None:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="Esa publicación ya no está en el historial.",
+            )
+        elif prefix == "HIST_RESCHED":
+            forget_preview(user_id)
+            context.user_data["state"] = "AWAITING_SCHEDULE_DATETIME"
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=(
+                    f"Nuevo borrador activo: {draft_label(draft)}.\n"
+                    "Introduce la fecha y hora en formato AAAA-MM-DD HH:MM\n"
+                    "Ejemplo: 2025-12-31 18:30"
+                ),
+                reply_markup=slot_keyboard(suggest_slot()),
+            )
+        else:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=(
+                    f"Nuevo borrador activo: {draft_label(draft)}.\n"
+                    "El anterior queda en 🗂 Borradores."
+                ),
+            )
+            await send_draft_preview(user_id, chat_id, context, force_new=True)
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="¿Qué quieres hacer ahora?",
+                reply_markup=static_keyboard("final_action"),
+            )
+
+    elif data == "MENU_DRAFTS":
+        text_menu, keyboard = build_drafts_menu(user_id)
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=text_menu,
+            reply_markup=InlineKeyboardMarkup(keyboard),
+        )
+
+    elif data == "DRAFT_NEW":
+        context.user_data["state"] = "AWAITING_DRAFT_NAME"
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=(
+                "Escribe un nombre para el nuevo borrador (o '-' para ninguno).\n"
+                "El borrador actual se guardará en 🗂 Borradores."
+            ),
+        )
+
+    elif data.startswith("DRAFT_SWITCH_"):
+        try:
+            draft_id = int(data.replace("DRAFT_SWITCH_", ""))
+        except ValueError:
+            draft_id = -1
+        draft = switch_draft(user_id, draft_id)
+        if draft is None:
+            await context.bot.send_message(chat_id=chat_id, text="Ese borrador ya no existe.")
+        else:
+            forget_preview(user_id)
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"Borrador activo: {draft_label(draft)}",
+            )
+            if draft_has_content(draft):
+                await send_draft_preview(user_id, chat_id, context)
+        await send_main_menu_simple(context, chat_id, user_id)
+
+    elif data.startswith("DRAFT_DEL_"):
+        try:
+            draft_id = int(data.replace("DRAFT_DEL_", ""))
+        except ValueError:
+            draft_id = -1
+        if delete_shelved_draft(user_id, draft_id):
+            text_menu, keyboard = build_drafts_menu(user_id)
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="Borrador eliminado.\n\n" + text_menu,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+            )
+        else:
+            await context.bot.send_message(chat_id=chat_id, text="Ese borrador ya no existe.")
+
+    elif data == "MENU_RECURRING":
+        text_menu, keyboard = build_recurring_menu(user_id)
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=text_menu,
+            reply_markup=InlineKeyboardMarkup(keyboard),
+        )
+
+    elif data == "REC_NEW":
+        draft = get_draft(user_id)
+        if not draft_has_content(draft):
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="No hay borrador actual para repetir.",
+            )
+            await send_main_menu_simple(context, chat_id, user_id)
+        else:
+            context.user_data["state"] = "AWAITING_RECURRING_SPEC"
+            await context.bot.send_message(chat_id=chat_id, text=RECURRING_HELP)
+
+    elif data == "CAL_UPLOAD":
+        context.user_data["state"] = "AWAITING_CALENDAR_DOCUMENT"
+        await context.bot.send_message(chat_id=chat_id, text=CALENDAR_HELP)
+
+    elif data == "CAL_CLEAR":
+        removed = 0
+        for entry in get_user_calendar(user_id):
+            remove_schedule_entry(entry["id"])
+            removed += 1
+        arm_schedule_dispatcher(context.application.job_queue)
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"Calendario vaciado: {removed} publicaciones eliminadas.",
+        )
+        await send_main_menu_simple(context, chat_id, user_id)
+
+    elif data.startswith("REC_DEL_"):
+        try:
+            rec_id = int(data.split("_")[-1])
+        except ValueError:
+            rec_id = -1
+        entry = SCHEDULE_ENTRIES.get(rec_id)
+        if entry is None or entry["user_id"] != user_id:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="Publicación recurrente no encontrada.",
+            )
+        else:
+            remove_schedule_entry(rec_id)
+            arm_schedule_dispatcher(context.application.job_queue)
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"Publicación recurrente #{rec_id} eliminada.",
+            )
+        text_menu, keyboard = build_recurring_menu(user_id)
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=text_menu,
             reply_markup=InlineKeyboardMarkup(keyboard),
         )
 
     # --- Confirmaciones ---
     elif data == "CONFIRM_CANCEL_DRAFT":
         draft = get_draft(user_id)
-        if draft.get("job") is not None:
+        if draft.job is not None:
             try:
-                draft["job"].schedule_removal()
+                draft.job.schedule_removal()
             except Exception:
                 pass
-        DRAFTS[user_id] = {
-            "type": None,
-            "file_id": None,
-            "text": "",
-            "buttons": [],
-            "scheduled_at": None,
-            "job": None,
-        }
+        if draft.draft_id is not None:
+            drop_draft_schedule(user_id, draft.draft_id)
+        draft.reset()
+        mark_user_dirty(user_id)
+        forget_preview(user_id)
         context.user_data.clear()
         await context.bot.send_message(
             chat_id=chat_id,
@@ -621,17 +3503,22 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     elif data == "FINAL_SAVE_TEMPLATE":
         draft = get_draft(user_id)
-        text = (draft.get("text") or "").strip()
+        text, entities = strip_with_entities(draft.text, draft.entities)
         if not text:
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="No hay texto en el borrador para guardar como plantilla.",
             )
         else:
-            title = save_template_from_text(user_id, text)
+            existing = find_template_by_text(user_id, text, entities)
+            title = save_template_from_text(user_id, text, entities)
             await context.bot.send_message(
                 chat_id=chat_id,
-                text=f"Plantilla guardada: {title}",
+                text=(
+                    f"Esta plantilla ya estaba guardada: {title}"
+                    if existing is not None
+                    else f"Plantilla guardada: {title}"
+                ),
             )
         await send_main_menu_simple(context, chat_id, user_id)
 
@@ -646,7 +3533,8 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             )
             await send_main_menu_simple(context, chat_id, user_id)
         else:
-            draft["buttons"] = copy.deepcopy(defaults["buttons"])
+            draft.buttons = copy.deepcopy(defaults["buttons"])
+            mark_user_dirty(user_id)
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="Botones predeterminados aplicados al borrador.",
@@ -655,7 +3543,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="¿Qué quieres hacer ahora?",
-                reply_markup=InlineKeyboardMarkup(build_final_action_keyboard()),
+                reply_markup=static_keyboard("final_action"),
             )
 
     elif data == "NEW_CREATE_BUTTONS":
@@ -690,7 +3578,8 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 text="No hay botones predeterminados guardados.",
             )
         else:
-            draft["buttons"] = copy.deepcopy(defaults["buttons"])
+            draft.buttons = copy.deepcopy(defaults["buttons"])
+            mark_user_dirty(user_id)
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="Botones predeterminados aplicados al borrador.",
@@ -699,7 +3588,7 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     elif data == "BUTTONS_MENU_EDIT_EXISTING":
         draft = get_draft(user_id)
-        if not draft.get("buttons"):
+        if not draft.buttons:
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="No hay botones en el borrador para editar.",
@@ -719,16 +3608,18 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     elif data == "BUTTONS_MENU_DELETE_ALL":
         draft = get_draft(user_id)
-        draft["buttons"] = []
+        draft.buttons = []
+        mark_user_dirty(user_id)
         await context.bot.send_message(
             chat_id=chat_id,
             text="Todos los botones del borrador han sido eliminados.",
         )
         await send_main_menu_simple(context, chat_id, user_id)
 
-    elif data == "BUTTONS_MENU_DELETE_ONE":
+    # BUTTONS_MENU_DELETE_ONE: teclados enviados antes del cambio de nombre
+    elif data in ("BUTTONS_MENU_DELETE_SOME", "BUTTONS_MENU_DELETE_ONE"):
         draft = get_draft(user_id)
-        buttons = draft.get("buttons") or []
+        buttons = draft.buttons
         if not buttons:
             await context.bot.send_message(
                 chat_id=chat_id,
@@ -736,31 +3627,25 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             )
             await send_main_menu_simple(context, chat_id, user_id)
         else:
-            lines = []
-            for idx, row in enumerate(buttons, start=1):
-                btn = row[0]
-                lines.append(f"{idx}. {btn.text} - {btn.url}")
-            listing = "\n".join(lines)
-            context.user_data["state"] = "AWAITING_DELETE_BUTTON_INDEX"
+            selection = start_selection(user_id, "buttons")
+            context.user_data["selection"] = selection
             await context.bot.send_message(
                 chat_id=chat_id,
-                text=(
-                    "Botones actuales:\n"
-                    f"{listing}\n\n"
-                    "Envía el número del botón que quieres eliminar."
-                ),
+                text=SELECTION_KINDS["buttons"][1],
+                reply_markup=build_selection_keyboard(user_id, selection),
             )
 
     elif data == "BUTTONS_MENU_SAVE_DEFAULTS":
         draft = get_draft(user_id)
-        if not draft.get("buttons"):
+        if not draft.buttons:
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="No hay botones en el borrador para guardar como predeterminados.",
             )
         else:
             defaults = get_defaults(user_id)
-            defaults["buttons"] = copy.deepcopy(draft["buttons"])
+            defaults["buttons"] = copy.deepcopy(draft.buttons)
+            mark_user_dirty(user_id)
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="Botones actuales guardados como predeterminados.",
@@ -789,14 +3674,15 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await context.bot.send_message(
             chat_id=chat_id,
             text="Opciones de botones:",
-            reply_markup=InlineKeyboardMarkup(build_buttons_menu_keyboard()),
+            reply_markup=static_keyboard("buttons_menu"),
         )
 
     # --- Guardar o no como predeterminados tras crear botones ---
     elif data == "SAVE_BUTTONS_YES":
         draft = get_draft(user_id)
         defaults = get_defaults(user_id)
-        defaults["buttons"] = copy.deepcopy(draft.get("buttons") or [])
+        defaults["buttons"] = copy.deepcopy(draft.buttons)
+        mark_user_dirty(user_id)
         await context.bot.send_message(
             chat_id=chat_id,
             text="Botones guardados como predeterminados.",
@@ -813,17 +3699,22 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # --- Plantillas desde menú ---
     elif data == "TEMPLATE_SAVE":
         draft = get_draft(user_id)
-        text = (draft.get("text") or "").strip()
+        text, entities = strip_with_entities(draft.text, draft.entities)
         if not text:
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="No hay texto en el borrador para guardar como plantilla.",
             )
         else:
-            title = save_template_from_text(user_id, text)
+            existing = find_template_by_text(user_id, text, entities)
+            title = save_template_from_text(user_id, text, entities)
             await context.bot.send_message(
                 chat_id=chat_id,
-                text=f"Plantilla guardada: {title}",
+                text=(
+                    f"Esta plantilla ya estaba guardada: {title}"
+                    if existing is not None
+                    else f"Plantilla guardada: {title}"
+                ),
             )
         await send_main_menu_simple(context, chat_id, user_id)
 
@@ -837,12 +3728,12 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await send_main_menu_simple(context, chat_id, user_id)
         else:
             keyboard_rows: List[List[InlineKeyboardButton]] = []
-            for idx, tpl in enumerate(templates):
+            for tpl in templates:
                 keyboard_rows.append(
                     [
                         InlineKeyboardButton(
                             tpl["title"],
-                            callback_data=f"TEMPLATE_INSERT_PICK_{idx}",
+                            callback_data=f"TEMPLATE_INSERT_PICK_{tpl['id']}",
                         )
                     ]
                 )
@@ -857,39 +3748,50 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     elif data.startswith("TEMPLATE_INSERT_PICK_"):
         try:
-            idx = int(data.split("_")[-1])
+            template_id = int(data.split("_")[-1])
         except ValueError:
+            template_id = -1
+        selected_tpl = get_template_by_id(user_id, template_id)
+        if selected_tpl is None:
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="Plantilla no válida.",
             )
             await send_main_menu_simple(context, chat_id, user_id)
             return
-        templates = get_templates(user_id)
-        if idx < 0 or idx >= len(templates):
+
+        tpl = selected_tpl
+        draft = get_draft(user_id)
+        if not draft_accepts_text(draft):
             await context.bot.send_message(
                 chat_id=chat_id,
-                text="Plantilla no válida.",
+                text="Este tipo de publicación no lleva texto.",
             )
             await send_main_menu_simple(context, chat_id, user_id)
             return
-
-        tpl = templates[idx]
-        draft = get_draft(user_id)
-        existing_text = draft.get("text") or ""
+        existing_text = draft.text
+        # El formato es el guardado con la plantilla, no el del modo actual
+        tpl_text, tpl_entities = tpl["text"], tpl["entities"]
         if not draft_has_content(draft):
-            draft["type"] = "text"
-            draft["file_id"] = None
-            draft["text"] = tpl["text"]
+            draft.type = "text"
+            draft.file_id = None
+            draft.text = tpl_text
+            draft.entities = tpl_entities
+            draft.template_id = tpl.get("id")
         else:
             if existing_text.strip():
-                draft["text"] = existing_text + "\n\n" + tpl["text"]
+                draft.text = existing_text + "\n\n" + tpl_text
+                draft.entities = draft.entities + shift_entities(
+                    tpl_entities, utf16_len(existing_text + "\n\n")
+                )
             else:
-                draft["text"] = tpl["text"]
+                draft.text = tpl_text
+                draft.entities = tpl_entities
+        mark_user_dirty(user_id)
 
         await context.bot.send_message(
             chat_id=chat_id,
-            text="Plantilla insertada en el borrador.",
+            text="Plantilla insertada en el borrador." + text_length_notice(draft),
         )
         await send_main_menu_simple(context, chat_id, user_id)
 
@@ -902,18 +3804,12 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             )
             await send_main_menu_simple(context, chat_id, user_id)
         else:
-            lines = []
-            for idx, tpl in enumerate(templates, start=1):
-                lines.append(f"{idx}. {tpl['title']}")
-            listing = "\n".join(lines)
-            context.user_data["state"] = "AWAITING_DELETE_TEMPLATE_INDEX"
+            selection = start_selection(user_id, "templates")
+            context.user_data["selection"] = selection
             await context.bot.send_message(
                 chat_id=chat_id,
-                text=(
-                    "Plantillas guardadas:\n"
-                    f"{listing}\n\n"
-                    "Envía el número de la plantilla que quieres eliminar."
-                ),
+                text=SELECTION_KINDS["templates"][1],
+                reply_markup=build_selection_keyboard(user_id, selection),
             )
 
 
@@ -927,12 +3823,12 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await send_main_menu_simple(context, chat_id, user_id)
         else:
             keyboard_rows: List[List[InlineKeyboardButton]] = []
-            for idx, tpl in enumerate(templates):
+            for tpl in templates:
                 keyboard_rows.append(
                     [
                         InlineKeyboardButton(
                             tpl["title"],
-                            callback_data=f"TEMPLATE_VIEW_PICK_{idx}",
+                            callback_data=f"TEMPLATE_VIEW_PICK_{tpl['id']}",
                         )
                     ]
                 )
@@ -951,16 +3847,11 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     elif data.startswith("TEMPLATE_VIEW_PICK_"):
         try:
-            idx = int(data.split("_")[-1])
+            template_id = int(data.split("_")[-1])
         except ValueError:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Plantilla no válida.",
-            )
-            await send_main_menu_simple(context, chat_id, user_id)
-            return
-        templates = get_templates(user_id)
-        if idx < 0 or idx >= len(templates):
+            template_id = -1
+        selected_tpl = get_template_by_id(user_id, template_id)
+        if selected_tpl is None:
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="Plantilla no válida.",
@@ -968,8 +3859,8 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await send_main_menu_simple(context, chat_id, user_id)
             return
 
-        context.user_data["template_edit_index"] = idx
-        tpl = templates[idx]
+        context.user_data["template_edit_id"] = template_id
+        tpl = selected_tpl
         await context.bot.send_message(
             chat_id=chat_id,
             text=(
@@ -979,28 +3870,15 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 f"{tpl['text']}"
             ),
         )
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    "✏ Editar esta plantilla", callback_data="TEMPLATE_EDIT_CURRENT"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "⬅️ Volver a la lista de plantillas", callback_data="TEMPLATE_VIEW"
-                )
-            ],
-        ]
         await context.bot.send_message(
             chat_id=chat_id,
             text="¿Qué quieres hacer con esta plantilla?",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=static_keyboard("template_actions"),
         )
 
     elif data == "TEMPLATE_EDIT_CURRENT":
-        templates = get_templates(user_id)
-        idx = context.user_data.get("template_edit_index")
-        if not isinstance(idx, int) or idx < 0 or idx >= len(templates):
+        tpl = get_template_by_id(user_id, context.user_data.get("template_edit_id"))
+        if tpl is None:
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="No hay una plantilla válida seleccionada para editar.",
@@ -1025,7 +3903,8 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 text="No hay borrador actualmente.",
             )
         else:
-            await send_draft_preview(user_id, chat_id, context)
+            # Petición explícita: mensaje nuevo aunque no haya cambios
+            await send_draft_preview(user_id, chat_id, context, force_new=True)
         await send_main_menu_simple(context, chat_id, user_id)
 
     elif data == "EDIT_TEXT":
@@ -1081,6 +3960,59 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 ),
             )
 
+    elif data == "EDIT_MEDIA_LIBRARY":
+        entries = list_recent_media()
+        if not entries:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="La biblioteca de medios está vacía.",
+            )
+            await send_main_menu_simple(context, chat_id, user_id)
+        else:
+            keyboard_rows = [
+                [
+                    InlineKeyboardButton(
+                        describe_media(entry), callback_data=f"MEDIA_PICK_{entry['uid']}"
+                    )
+                ]
+                for entry in entries
+            ]
+            keyboard_rows.append(
+                [InlineKeyboardButton("⬅️ Volver al menú", callback_data="BACK_TO_MENU")]
+            )
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="Elige la media para el borrador (de la más reciente a la más antigua):",
+                reply_markup=InlineKeyboardMarkup(keyboard_rows),
+            )
+
+    elif data.startswith("MEDIA_PICK_"):
+        entry = get_media(data[len("MEDIA_PICK_"):])
+        if entry is None:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="Esa media ya no está en la biblioteca.",
+            )
+            await send_main_menu_simple(context, chat_id, user_id)
+        else:
+            draft = get_draft(user_id)
+            draft.type = entry["type"]
+            draft.file_id = entry["file_ids"][-1]
+            draft.source = None
+            draft.media_uid = entry["uid"]
+            entry["uses"] += 1
+            mark_user_dirty(user_id)
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="Media del borrador actualizada desde la biblioteca." + text_length_notice(draft),
+            )
+            await send_draft_preview(user_id, chat_id, context)
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="¿Qué quieres hacer ahora?",
+                reply_markup=static_keyboard("final_action"),
+            )
+
     else:
         await context.bot.send_message(
             chat_id=chat_id,
@@ -1102,7 +4034,7 @@ async def _after_buttons_flow(
         await context.bot.send_message(
             chat_id=chat_id,
             text="¿Qué quieres hacer ahora?",
-            reply_markup=InlineKeyboardMarkup(build_final_action_keyboard()),
+            reply_markup=static_keyboard("final_action"),
         )
     else:
         await send_main_menu_simple(context, chat_id, user_id)
@@ -1131,6 +4063,23 @@ def parse_buttons_from_text(text: str) -> List[List[InlineKeyboardButton]]:
     return rows
 
 
+def buttons_to_data(rows: List[List[InlineKeyboardButton]]) -> List[List[Dict[str, str]]]:
+    return [[{"text": btn.text, "url": btn.url} for btn in row] for row in rows]
+
+
+def buttons_from_data(data: Any) -> List[List[InlineKeyboardButton]]:
+    rows: List[List[InlineKeyboardButton]] = []
+    for row in data or []:
+        buttons = [
+            InlineKeyboardButton(str(btn["text"]), url=str(btn["url"]))
+            for btn in row
+            if btn.get("text") and btn.get("url")
+        ]
+        if buttons:
+            rows.append(buttons)
+    return rows
+
+
 # --------- Manejadores de mensajes según estado ---------
 async def handle_new_publication_message(
     update: Update, context: ContextTypes.DEFAULT_TYPE
@@ -1146,8 +4095,18 @@ async def handle_new_publication_message(
     content_type: Optional[str] = None
     file_id: Optional[str] = None
     text: str = ""
-
-    if message.photo:
+    entities: Any = message.caption_entities
+    source: Optional[Tuple[int, int, str]] = None
+    kind = message_kind(message)
+
+    if kind is not None and kind != "text" and (
+        kind not in ("photo", "video", "voice") or get_defaults(user_id).get("copy_mode")
+    ):
+        # Se publica copiando el mensaje original
+        content_type = "copy"
+        source = (chat_id, message.message_id, kind)
+        text = message.caption or ""
+    elif message.photo:
         content_type = "photo"
         file_id = message.photo[-1].file_id
         text = message.caption or ""
@@ -1163,51 +4122,76 @@ async def handle_new_publication_message(
         content_type = "text"
         file_id = None
         text = message.text
+        entities = message.entities
     else:
         await context.bot.send_message(
             chat_id=chat_id,
-            text="Tipo de mensaje no soportado. Envía foto, video, nota de voz o texto.",
+            text="Tipo de mensaje no soportado.",
         )
         return
 
     selected_template = context.user_data.get("selected_template_text")
+    if source is not None and source[2] not in COPY_CAPTION_KINDS:
+        # Encuestas, stickers...: no llevan texto, la plantilla no se aplica
+        selected_template = None
+        context.user_data["selected_template_text"] = None
+    selected_tpl = (
+        get_template_by_id(user_id, context.user_data.get("selected_template_id"))
+        if selected_template
+        else None
+    )
+    try:
+        if selected_tpl is not None:
+            text, entities = selected_tpl["text"], selected_tpl["entities"]
+        elif selected_template:
+            text, entities = selected_template, ()
+        else:
+            text, entities = format_input(user_id, text, entities)
+    except ValueError as exc:
+        await context.bot.send_message(chat_id=chat_id, text=html_error_text(exc))
+        return
+
+    media = register_media(message)
+    draft.media_uid = media["uid"] if media else None
+    draft.entities = entities
+    draft.source = source
+
     if selected_template:
-        draft["type"] = content_type
-        draft["file_id"] = file_id
-        draft["text"] = selected_template
+        draft.type = content_type
+        draft.file_id = file_id
+        draft.text = text
+        draft.template_id = context.user_data.get("selected_template_id")
         context.user_data["selected_template_text"] = None
+        context.user_data.pop("selected_template_id", None)
     else:
-        draft["type"] = content_type
-        draft["file_id"] = file_id
-        draft["text"] = text
+        draft.type = content_type
+        draft.file_id = file_id
+        draft.text = text
+        draft.template_id = None
+    mark_user_dirty(user_id)
 
     context.user_data["state"] = None
 
     await context.bot.send_message(
         chat_id=chat_id,
-        text="Publicación guardada en el borrador.",
+        text=(
+            "Publicación guardada en el borrador."
+            + (
+                f"\nSe publicará como copia del {COPY_KIND_LABELS[source[2]]} que enviaste: "
+                "no lo borres de este chat."
+                if source is not None
+                else ""
+            )
+            + text_length_notice(draft)
+        ),
     )
 
     defaults = get_defaults(user_id)
     if defaults.get("buttons"):
-        keyboard = [
-            [
-                InlineKeyboardButton(
-                    "✔ Usar botones predeterminados",
-                    callback_data="NEW_USE_DEFAULT_BUTTONS",
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "✏️ No, crear nuevos botones",
-                    callback_data="NEW_CREATE_BUTTONS",
-                )
-            ],
-        ]
         await context.bot.send_message(
             chat_id=chat_id,
             text="¿Quieres usar los botones predeterminados que tienes guardados?",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=static_keyboard("use_default_buttons"),
         )
     else:
         context.user_data["state"] = "AWAITING_NEW_BUTTONS_TEXT"
@@ -1241,27 +4225,14 @@ async def handle_new_buttons_text(
         )
         return
 
-    draft["buttons"] = rows
+    draft.buttons = rows
+    mark_user_dirty(user_id)
     context.user_data["state"] = "AWAITING_SAVE_DEFAULT_BUTTONS_CHOICE"
 
-    keyboard = [
-        [
-            InlineKeyboardButton(
-                "Sí, guardar como predeterminados",
-                callback_data="SAVE_BUTTONS_YES",
-            )
-        ],
-        [
-            InlineKeyboardButton(
-                "No, solo usar en este borrador",
-                callback_data="SAVE_BUTTONS_NO",
-            )
-        ],
-    ]
     await context.bot.send_message(
         chat_id=chat_id,
         text="Botones actualizados. ¿Quieres guardar estos botones como predeterminados?",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=static_keyboard("save_default_buttons"),
     )
 
 
@@ -1287,8 +4258,7 @@ async def handle_schedule_datetime(
         return
 
     # Convertir hora local (UTC-5) a UTC real
-    local_tz = timezone(timedelta(hours=-5))
-    local_dt = scheduled_local.replace(tzinfo=local_tz)
+    local_dt = scheduled_local.replace(tzinfo=LOCAL_TZ)
     utc_dt = local_dt.astimezone(timezone.utc)
 
     now_utc = datetime.now(timezone.utc)
@@ -1302,32 +4272,87 @@ async def handle_schedule_datetime(
         )
         return
 
-    delay = delta
+    problem = check_slot(local_dt.timestamp(), own_slot(draft))
+    if problem is not None:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"No se puede programar a esa hora: {problem}.\nEnvía otra hora o usa el hueco libre.",
+            reply_markup=slot_keyboard(suggest_slot(local_dt.timestamp())),
+        )
+        return
+
+    schedule_active_draft(context, user_id, scheduled_local)
+    context.user_data["state"] = None
+
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=(
+            "✅ Publicación programada para "
+            f"{scheduled_local.strftime('%Y-%m-%d %H:%M')}."
+        ),
+    )
+
+
+def own_slot(draft: Draft) -> Optional[float]:
+    """Hora que ya ocupa el borrador (no choca consigo mismo al reprogramarlo)."""
+    if draft.job is None or draft.scheduled_at is None:
+        return None
+    return _local_timestamp(draft.scheduled_at)
+
 
-    if draft.get("job") is not None:
+def schedule_active_draft(
+    context: ContextTypes.DEFAULT_TYPE, user_id: int, scheduled_local: datetime
+) -> None:
+    """Programa el borrador activo para la hora local indicada (sustituye la anterior)."""
+    draft = get_draft(user_id)
+    delay = max(0.0, _local_timestamp(scheduled_local) - time.time())
+
+    if draft.job is not None:
         try:
-            draft["job"].schedule_removal()
+            draft.job.schedule_removal()
         except Exception:
             pass
-        draft["job"] = None
+        draft.job = None
 
     job = context.application.job_queue.run_once(
         send_scheduled_publication,
         delay,
-        data={"user_id": user_id},
+        data={
+            "user_id": user_id,
+            "draft_id": draft_ref(user_id, draft),
+            "corr": _CORRELATION_ID.get(),
+        },
     )
 
-    draft["scheduled_at"] = scheduled_local  # hora local para mostrar
-    draft["job"] = job
+    draft.scheduled_at = scheduled_local  # hora local para mostrar
+    draft.job = job
+    note_draft_schedule(user_id, draft)
+
+
+async def handle_draft_name(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    message = update.message
+    if message is None or message.text is None:
+        return
+
+    user_id = update.effective_user.id  # type: ignore[union-attr]
+    chat_id = update.effective_chat.id  # type: ignore[union-attr]
+    name = message.text.strip()
+    if name == "-":
+        name = ""
+    draft = new_named_draft(user_id, name[:40])
+    forget_preview(user_id)
     context.user_data["state"] = None
 
     await context.bot.send_message(
         chat_id=chat_id,
         text=(
-            "✅ Publicación programada para "
-            f"{scheduled_local.strftime('%Y-%m-%d %H:%M')}."
+            f"Nuevo borrador activo: {draft_label(draft)}.\n"
+            "Usa ✏️ Crear / cambiar publicación para añadir el contenido."
         ),
     )
+    await send_main_menu_simple(context, chat_id, user_id)
 
 
 async def handle_edit_text(
@@ -1340,19 +4365,35 @@ async def handle_edit_text(
     user_id = update.effective_user.id  # type: ignore[union-attr]
     chat_id = update.effective_chat.id  # type: ignore[union-attr]
     draft = get_draft(user_id)
+    if not draft_accepts_text(draft):
+        context.user_data["state"] = None
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="Este tipo de publicación no lleva texto.",
+        )
+        return
+
+    try:
+        text, entities = format_input(user_id, message.text, message.entities)
+    except ValueError as exc:
+        await context.bot.send_message(chat_id=chat_id, text=html_error_text(exc))
+        return
 
-    draft["text"] = message.text
+    draft.text = text
+    draft.entities = entities
+    draft.template_id = None
+    mark_user_dirty(user_id)
     context.user_data["state"] = None
 
     await context.bot.send_message(
         chat_id=chat_id,
-        text="Texto del borrador actualizado.",
+        text="Texto del borrador actualizado." + text_length_notice(draft),
     )
     await send_draft_preview(user_id, chat_id, context)
     await context.bot.send_message(
         chat_id=chat_id,
         text="¿Qué quieres hacer ahora?",
-        reply_markup=InlineKeyboardMarkup(build_final_action_keyboard()),
+        reply_markup=static_keyboard("final_action"),
     )
 
 
@@ -1390,185 +4431,1189 @@ async def handle_new_media(
         )
         return
 
-    draft["type"] = content_type
-    draft["file_id"] = file_id
+    draft.type = content_type
+    draft.file_id = file_id
+    draft.source = None
+    media = register_media(message)
+    draft.media_uid = media["uid"] if media else None
+    mark_user_dirty(user_id)
+
+    if new_text is not None and new_text.strip() != "":
+        try:
+            draft.text, draft.entities = format_input(
+                user_id, new_text, message.caption_entities
+            )
+        except ValueError as exc:
+            # La media ya se cambió: el pie anterior se conserva
+            await context.bot.send_message(chat_id=chat_id, text=html_error_text(exc))
+
+    context.user_data["state"] = None
+
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="Media del borrador actualizada." + text_length_notice(draft),
+    )
+    await send_draft_preview(user_id, chat_id, context)
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="¿Qué quieres hacer ahora?",
+        reply_markup=static_keyboard("final_action"),
+    )
+
+
+async def handle_edit_template_text(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    message = update.message
+    if message is None or message.text is None:
+        return
+
+    user_id = update.effective_user.id  # type: ignore[union-attr]
+    chat_id = update.effective_chat.id  # type: ignore[union-attr]
+
+    tpl = get_template_by_id(user_id, context.user_data.get("template_edit_id"))
+    if tpl is None:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="No hay una plantilla válida seleccionada para guardar cambios.",
+        )
+        context.user_data["state"] = None
+        return
+
+    try:
+        text, entities = format_input(user_id, message.text, message.entities)
+    except ValueError as exc:
+        await context.bot.send_message(chat_id=chat_id, text=html_error_text(exc))
+        return
+    update_template_text(user_id, tpl, text, entities)
+    context.user_data["state"] = None
+
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="Plantilla actualizada correctamente.",
+    )
+    await send_main_menu_simple(context, chat_id, user_id)
+
+
+
+# --------- Importar / exportar ---------
+def write_export_file(user_id: int, path: str, compress: bool) -> int:
+    """Escribe una línea JSON por registro; devuelve cuántos se escribieron."""
+    defaults = get_defaults(user_id)
+    opener = gzip.open if compress else open
+    count = 0
+    with opener(path, "wt", encoding="utf-8") as fh:  # type: ignore[operator]
+        for tpl in defaults.get("templates", []):
+            record = {"kind": "template", "title": tpl["title"], "text": tpl["text"]}
+            if tpl.get("entities"):
+                record["entities"] = entities_to_data(tpl["entities"])
+            fh.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+        if defaults.get("buttons"):
+            record = {"kind": "buttons", "rows": buttons_to_data(defaults["buttons"])}
+            fh.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def import_records_from_file(user_id: int, path: str) -> Dict[str, Any]:
+    """
+    Lee el archivo línea a línea (acepta gzip) y añade solo las plantillas
+    cuyo hash de contenido no exista todavía.
+    """
+    with open(path, "rb") as probe:
+        compressed = probe.read(2) == b"\x1f\x8b"
+    opener = gzip.open if compressed else open
+
+    result: Dict[str, Any] = {"added": 0, "duplicated": 0, "buttons": False, "errors": []}
+    try:
+        _import_lines(user_id, opener, path, result)
+    except UnicodeDecodeError:
+        result["errors"].append("El archivo debe estar en UTF-8; lectura detenida.")
+    except (EOFError, OSError):
+        # gzip.BadGzipFile es un OSError; EOFError = .gz truncado
+        result["errors"].append("El archivo comprimido está dañado o incompleto; lectura detenida.")
+    return result
+
+
+def _import_lines(user_id: int, opener: Any, path: str, result: Dict[str, Any]) -> None:
+    with opener(path, "rt", encoding="utf-8") as fh:
+        for line_no, line in enumerate(fh, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                kind = record.get("kind")
+                if kind == "template":
+                    text = str(record["text"])
+                    if not text.strip():
+                        raise ValueError("texto vacío")
+                    entities = entities_from_data(record.get("entities"))
+                    if find_template_by_text(user_id, text, entities) is not None:
+                        result["duplicated"] += 1
+                        continue
+                    save_template_from_text(user_id, text, entities)
+                    result["added"] += 1
+                elif kind == "buttons":
+                    rows = buttons_from_data(record["rows"])
+                    if not rows:
+                        raise ValueError("sin botones válidos")
+                    get_defaults(user_id)["buttons"] = rows
+                    mark_user_dirty(user_id)
+                    result["buttons"] = True
+                else:
+                    raise ValueError(f"tipo desconocido {kind!r}")
+            except (ValueError, KeyError, TypeError, AttributeError) as exc:
+                result["errors"].append(f"línea {line_no}: {exc}")
+
+
+async def handle_import_document(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    message = update.message
+    if message is None:
+        return
+
+    user_id = update.effective_user.id  # type: ignore[union-attr]
+    chat_id = update.effective_chat.id  # type: ignore[union-attr]
+
+    if message.document is None:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text="Envía el archivo como documento (.jsonl o .jsonl.gz).",
+        )
+        return
+
+    fd, path = tempfile.mkstemp(suffix=".import")
+    os.close(fd)
+    try:
+        tg_file = await message.document.get_file()
+        await tg_file.download_to_drive(path)
+        result = import_records_from_file(user_id, path)
+    except (BadRequest, NetworkError) as exc:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"No se pudo descargar el archivo ({exc}). Vuelve a enviarlo.",
+        )
+        return
+    finally:
+        os.unlink(path)
+
+    context.user_data["state"] = None
+    lines = [
+        "Importación terminada.",
+        f"Plantillas nuevas: {result['added']}",
+        f"Plantillas repetidas ignoradas: {result['duplicated']}",
+    ]
+    if result["buttons"]:
+        lines.append("Botones predeterminados reemplazados.")
+    if result["errors"]:
+        lines.append(f"Líneas con errores: {len(result['errors'])}")
+        lines.extend(result["errors"][:10])
+    await context.bot.send_message(chat_id=chat_id, text="\n".join(lines))
+    await send_main_menu_simple(context, chat_id, user_id)
+
+
+# --------- JobQueue ---------
+async def send_scheduled_publication(context: ContextTypes.DEFAULT_TYPE) -> None:
+    job = context.job
+    if job is None:
+        return
+    begin_job_trace(context)
+    data = job.data or {}
+    user_id = data.get("user_id")
+    if user_id is None:
+        return
+
+    draft = find_user_draft(user_id, data.get("draft_id"))
+    if not draft_has_content(draft):
+        return
+
+    try:
+        key = scheduled_draft_key(
+            user_id, draft.draft_id, draft.scheduled_at, job  # type: ignore[union-attr]
+        )
+        message = await publish_with_retry(
+            context, draft, key, user_id, "la publicación programada"  # type: ignore[arg-type]
+        )
+        draft.scheduled_at = None  # type: ignore[union-attr]
+        draft.job = None  # type: ignore[union-attr]
+        note_draft_schedule(user_id, draft)  # type: ignore[arg-type]
+        if message is None:
+            return
+        if isinstance(message, OutboxHit) and message.state != "sent":
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=(
+                    "⚠️ La publicación programada ya se había intentado enviar y no "
+                    "consta si llegó. Revisa el canal."
+                ),
+            )
+            return
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="✅ Publicación programada enviada correctamente al canal.",
+        )
+
+        post_id = None
+        try:
+            if message is not None:
+                post_id = message.message_id
+        except Exception:
+            post_id = None
+
+        base_url = "https://t.me/JohaaleTrader_es"
+        url = base_url
+        if post_id is not None:
+            url = f"{base_url}/{post_id}"
+
+        buttons_after_send = [
+            [InlineKeyboardButton("🔗 Así se publicó en el canal", url=url)],
+            [InlineKeyboardButton("Volver al menú", callback_data="BACK_TO_MENU")],
+        ]
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="Selecciona una opción:",
+            reply_markup=InlineKeyboardMarkup(buttons_after_send),
+        )
+    except Exception as exc:
+        logging.error("Error enviando publicación programada: %s", exc)
+
+
+# --------- Publicaciones recurrentes y calendario ---------
+# Cada entrada guarda una copia del borrador y, si es recurrente, su regla tipo
+# cron (las del calendario tienen rule=None y se envían una sola vez). Un único
+# job (el despachador) se programa para la próxima entrada que vence; el
+# montículo solo contiene (próximo_disparo, id, generación), así que con miles
+# de entradas el JobQueue sigue teniendo un solo job.
+SCHEDULE_ENTRIES: Dict[int, Dict[str, Any]] = {}
+_SCHEDULE_HEAP: List[Tuple[float, int, int]] = []
+_SCHEDULE_SEQ = 0
+_SCHEDULE_DISPATCHER: Dict[str, Any] = {"job": None, "when": None}
+# Las entradas se guardan en disco en el mantenimiento periódico y al parar
+_SCHEDULE_STORE: Dict[str, bool] = {"dirty": False}
+
+_CRON_FIELDS = (
+    ("minutes", 0, 59),
+    ("hours", 0, 23),
+    ("days", 1, 31),
+    ("months", 1, 12),
+    ("weekdays", 0, 7),
+)
+
+_WEEKDAY_NAMES = {
+    "lunes": 1,
+    "martes": 2,
+    "miercoles": 3,
+    "miércoles": 3,
+    "jueves": 4,
+    "viernes": 5,
+    "sabado": 6,
+    "sábado": 6,
+    "domingo": 0,
+}
+
+RECURRING_HELP = (
+    "Envía la regla de repetición (hora local UTC-5). Formatos:\n"
+    "• diario HH:MM\n"
+    "• laborables HH:MM  (lunes a viernes)\n"
+    "• semanal <día> HH:MM  (ej: semanal lunes 09:00)\n"
+    "• cron: minuto hora día mes día_semana  (ej: 30 8 * * 1-5)\n"
+    "Opcional: valores para las {variables} del texto tras '|'\n"
+    "(ej: diario 09:00 | par=EURUSD; precio=1.0850)"
+)
+
+
+def _parse_cron_field(field: str, low: int, high: int) -> Tuple[int, ...]:
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_str = part.split("/", 1)
+            step = int(step_str)
+            if step < 1:
+                raise ValueError(f"Paso inválido: {step_str}")
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            a, b = part.split("-", 1)
+            start, end = int(a), int(b)
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise ValueError(f"Valor fuera de rango: {part}")
+        values.update(range(start, end + 1, step))
+    return tuple(sorted(values))
+
+
+def parse_recurrence_spec(spec: str) -> Dict[str, Any]:
+    """
+    Convierte la regla escrita por el admin en una regla cron normalizada.
+    Los días de la semana se guardan con la numeración de Python (lunes=0).
+    """
+    words = " ".join((spec or "").strip().lower().split()).split(" ")
+    if words[0] in ("diario", "laborables", "semanal"):
+        if words[0] == "semanal":
+            if len(words) != 3 or words[1] not in _WEEKDAY_NAMES:
+                raise ValueError("Usa: semanal <día> HH:MM")
+            dow = str(_WEEKDAY_NAMES[words[1]])
+        elif len(words) != 2:
+            raise ValueError(f"Usa: {words[0]} HH:MM")
+        else:
+            dow = "1-5" if words[0] == "laborables" else "*"
+        try:
+            hhmm = datetime.strptime(words[-1], "%H:%M")
+        except ValueError:
+            raise ValueError("La hora debe tener formato HH:MM.")
+        fields = [str(hhmm.minute), str(hhmm.hour), "*", "*", dow]
+    else:
+        fields = words
+    if len(fields) != 5:
+        raise ValueError("Una expresión cron necesita 5 campos.")
+
+    rule: Dict[str, Any] = {}
+    for (name, low, high), field in zip(_CRON_FIELDS, fields):
+        try:
+            rule[name] = _parse_cron_field(field, low, high)
+        except ValueError as exc:
+            raise ValueError(f"Campo '{field}' inválido: {exc}")
+    # cron: 0 y 7 = domingo; Python: lunes=0 ... domingo=6
+    rule["weekdays"] = tuple(sorted({(d - 1) % 7 for d in rule["weekdays"]}))
+    rule["dom_any"] = fields[2] == "*"
+    rule["dow_any"] = fields[4] == "*"
+    return rule
+
+
+def _cron_day_matches(rule: Dict[str, Any], dt: datetime) -> bool:
+    dom_ok = dt.day in rule["days"]
+    dow_ok = dt.weekday() in rule["weekdays"]
+    if rule["dom_any"] and rule["dow_any"]:
+        return True
+    if rule["dom_any"]:
+        return dow_ok
+    if rule["dow_any"]:
+        return dom_ok
+    return dom_ok or dow_ok
+
+
+def compute_next_fire(rule: Dict[str, Any], after: datetime) -> datetime:
+    """
+    Próximo instante (estrictamente posterior a `after`) que cumple la regla.
+    Avanza saltando campo a campo (mes, día, hora, minuto) en lugar de
+    recorrer minuto a minuto.
+    """
+    months, hours, minutes = rule["months"], rule["hours"], rule["minutes"]
+    t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    # Como mucho unos pocos años de días candidatos (p. ej. un 29 de febrero)
+    for _ in range(3000):
+        if t.month not in months:
+            i = bisect_left(months, t.month)
+            if i == len(months):
+                t = t.replace(year=t.year + 1, month=months[0], day=1, hour=0, minute=0)
+            else:
+                t = t.replace(month=months[i], day=1, hour=0, minute=0)
+            continue
+        if not _cron_day_matches(rule, t):
+            t = (t + timedelta(days=1)).replace(hour=0, minute=0)
+            continue
+        if t.hour not in hours:
+            i = bisect_left(hours, t.hour)
+            if i == len(hours):
+                t = (t + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            t = t.replace(hour=hours[i], minute=0)
+        if t.minute not in minutes:
+            i = bisect_left(minutes, t.minute)
+            if i == len(minutes):
+                t = (t + timedelta(hours=1)).replace(minute=0)
+                continue
+            t = t.replace(minute=minutes[i])
+        return t
+    raise ValueError("La regla no tiene ninguna fecha válida.")
+
+
+def _push_schedule_entry(entry: Dict[str, Any]) -> None:
+    invalidate_slots()
+    heapq.heappush(
+        _SCHEDULE_HEAP,
+        (entry["next_fire"].timestamp(), entry["id"], entry["generation"]),
+    )
+    # Las entradas borradas o reprogramadas se descartan de forma perezosa;
+    # si se acumulan demasiadas se reconstruye el montículo.
+    if len(_SCHEDULE_HEAP) > 2 * len(SCHEDULE_ENTRIES) + 64:
+        _SCHEDULE_HEAP[:] = [
+            (e["next_fire"].timestamp(), e["id"], e["generation"])
+            for e in SCHEDULE_ENTRIES.values()
+        ]
+        heapq.heapify(_SCHEDULE_HEAP)
+
+
+def _peek_schedule() -> Optional[Tuple[float, int, int]]:
+    while _SCHEDULE_HEAP:
+        ts, rec_id, generation = _SCHEDULE_HEAP[0]
+        entry = SCHEDULE_ENTRIES.get(rec_id)
+        if entry is not None and entry["generation"] == generation:
+            return _SCHEDULE_HEAP[0]
+        heapq.heappop(_SCHEDULE_HEAP)
+    return None
+
+
+def add_recurring(
+    user_id: int,
+    spec: str,
+    draft: Draft,
+    now: Optional[datetime] = None,
+    variables: Optional[Dict[str, str]] = None,
+) -> Dict[str, Any]:
+    rule = parse_recurrence_spec(spec)
+    now = now or datetime.now(LOCAL_TZ)
+    next_fire = compute_next_fire(rule, now.astimezone(LOCAL_TZ))
+    entry = {
+        "id": reserve_schedule_ids(1),
+        "user_id": user_id,
+        "spec": " ".join(spec.split()),
+        "rule": rule,
+        "snapshot": draft.copy(),
+        "template_id": draft.template_id,
+        "variables": variables or {},
+        "next_fire": next_fire,
+        "generation": 0,
+    }
+    SCHEDULE_ENTRIES[entry["id"]] = entry
+    _push_schedule_entry(entry)
+    _SCHEDULE_STORE["dirty"] = True
+    return entry
+
+
+def reserve_schedule_ids(count: int) -> int:
+    """
+    Reserva `count` ids consecutivos y guarda el último en `meta`: las claves
+    cal:<id> / rec:<id> del outbox duran días, así que un id no se reutiliza
+    aunque ya no quede ninguna entrada tras reiniciar. Devuelve el primero.
+    """
+    global _SCHEDULE_SEQ
+    first = _SCHEDULE_SEQ + 1
+    _SCHEDULE_SEQ += count
+    conn = _db()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('schedule_seq', ?)",
+            (_SCHEDULE_SEQ,),
+        )
+    return first
+
+
+def _stored_schedule_seq() -> int:
+    """Último id reservado; en bases anteriores a `meta` se deduce del outbox."""
+    conn = _db()
+    row = conn.execute("SELECT value FROM meta WHERE key = 'schedule_seq'").fetchone()
+    seq = row[0] if row else 0
+    keys = conn.execute("SELECT key FROM outbox WHERE key LIKE 'cal:%' OR key LIKE 'rec:%'")
+    for (key,) in keys:
+        ref = key.split(":")[1].split("#")[0]
+        if ref.isdigit():
+            seq = max(seq, int(ref))
+    return seq
+
+
+def add_calendar_entries(user_id: int, items: List[Draft]) -> int:
+    """Inserta de una vez entradas de envío único ya validadas."""
+    first_id = reserve_schedule_ids(len(items))
+    for offset, item in enumerate(items):
+        entry = {
+            "id": first_id + offset,
+            "user_id": user_id,
+            "spec": "una vez",
+            "rule": None,
+            "snapshot": item,
+            "template_id": None,
+            "next_fire": item.scheduled_at,
+            "generation": 0,
+        }
+        SCHEDULE_ENTRIES[entry["id"]] = entry
+        _SCHEDULE_HEAP.append(
+            (entry["next_fire"].timestamp(), entry["id"], entry["generation"])
+        )
+    heapq.heapify(_SCHEDULE_HEAP)
+    _SCHEDULE_STORE["dirty"] = True
+    invalidate_slots()
+    return len(items)
+
+
+def remove_schedule_entry(rec_id: int) -> Optional[Dict[str, Any]]:
+    _SCHEDULE_STORE["dirty"] = True
+    invalidate_slots()
+    return SCHEDULE_ENTRIES.pop(rec_id, None)
+
+
+def save_schedule_entries() -> int:
+    """Reescribe en una transacción todas las entradas programadas."""
+    rows = [
+        (
+            entry["id"],
+            json.dumps(
+                {
+                    "user_id": entry["user_id"],
+                    "spec": entry["spec"],
+                    "recurring": entry["rule"] is not None,
+                    "template_id": entry["template_id"],
+                    "variables": entry.get("variables") or {},
+                    "next_fire": entry["next_fire"].isoformat(),
+                    "snapshot": entry["snapshot"].to_data(),
+                },
+                ensure_ascii=False,
+            ),
+        )
+        for entry in SCHEDULE_ENTRIES.values()
+    ]
+    conn = _db()
+    with conn:
+        conn.execute("DELETE FROM schedule_entries")
+        conn.executemany("INSERT INTO schedule_entries (id, data) VALUES (?, ?)", rows)
+    _SCHEDULE_STORE["dirty"] = False
+    return len(rows)
+
+
+def load_schedule_entries(now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+    """
+    Carga las entradas guardadas. Las recurrentes vencidas saltan a su
+    próxima fecha futura; las de envío único vencidas se descartan y se
+    devuelven para avisar al admin.
+    """
+    global _SCHEDULE_SEQ
+    now = now or datetime.now(LOCAL_TZ)
+    missed: List[Dict[str, Any]] = []
+    _SCHEDULE_SEQ = max(_SCHEDULE_SEQ, _stored_schedule_seq())
+    for rec_id, raw in _db().execute("SELECT id, data FROM schedule_entries ORDER BY id"):
+        data = json.loads(raw)
+        entry = {
+            "id": rec_id,
+            "user_id": data["user_id"],
+            "spec": data["spec"],
+            "rule": parse_recurrence_spec(data["spec"]) if data["recurring"] else None,
+            "snapshot": Draft.from_data(data["snapshot"]),
+            "template_id": data.get("template_id"),
+            "variables": data.get("variables") or {},
+            "next_fire": datetime.fromisoformat(data["next_fire"]),
+            "generation": 0,
+        }
+        _SCHEDULE_SEQ = max(_SCHEDULE_SEQ, rec_id)
+        if entry["next_fire"] <= now:
+            missed.append(entry)
+            if entry["rule"] is None:
+                continue
+            entry["next_fire"] = compute_next_fire(entry["rule"], now)
+        SCHEDULE_ENTRIES[rec_id] = entry
+        _SCHEDULE_HEAP.append((entry["next_fire"].timestamp(), rec_id, 0))
+    heapq.heapify(_SCHEDULE_HEAP)
+    _SCHEDULE_STORE["dirty"] = bool(missed)
+    invalidate_slots()
+    return missed
+
+
+def get_user_recurring(user_id: int) -> List[Dict[str, Any]]:
+    return [
+        e
+        for e in SCHEDULE_ENTRIES.values()
+        if e["user_id"] == user_id and e["rule"] is not None
+    ]
+
+
+def get_user_calendar(user_id: int) -> List[Dict[str, Any]]:
+    return [
+        e
+        for e in SCHEDULE_ENTRIES.values()
+        if e["user_id"] == user_id and e["rule"] is None
+    ]
+
+
+def _entry_publication(entry: Dict[str, Any]) -> Draft:
+    publication = entry["snapshot"]
+    if entry.get("template_id") is not None:
+        tpl = get_template_by_id(entry["user_id"], entry["template_id"])
+        if tpl is not None:
+            publication = publication.copy()
+            # Texto y formato tal como se guardaron, sin depender de /formato
+            publication.text, publication.entities = tpl["text"], tpl["entities"]
+    return publication
+
+
+def arm_schedule_dispatcher(job_queue: Any) -> None:
+    """(Re)programa el job despachador para el próximo vencimiento."""
+    top = _peek_schedule()
+    current = _SCHEDULE_DISPATCHER.get("job")
+    if top is None:
+        if current is not None:
+            current.schedule_removal()
+        _SCHEDULE_DISPATCHER["job"] = None
+        _SCHEDULE_DISPATCHER["when"] = None
+        return
+    when = top[0]
+    if current is not None and _SCHEDULE_DISPATCHER.get("when") == when:
+        return
+    if current is not None:
+        current.schedule_removal()
+    delay = max(0.0, when - datetime.now(timezone.utc).timestamp())
+    _SCHEDULE_DISPATCHER["job"] = job_queue.run_once(
+        dispatch_scheduled_entries, delay, name="schedule_dispatcher"
+    )
+    _SCHEDULE_DISPATCHER["when"] = when
+
+
+async def dispatch_scheduled_entries(context: ContextTypes.DEFAULT_TYPE) -> None:
+    begin_job_trace(context)
+    _SCHEDULE_DISPATCHER["job"] = None
+    _SCHEDULE_DISPATCHER["when"] = None
+    now = datetime.now(LOCAL_TZ)
+    due: List[Tuple[Dict[str, Any], str]] = []
+    while True:
+        top = _peek_schedule()
+        if top is None or top[0] > now.timestamp() + 0.5:
+            break
+        heapq.heappop(_SCHEDULE_HEAP)
+        entry = SCHEDULE_ENTRIES[top[1]]
+        if entry["rule"] is None:
+            due.append((entry, f"cal:{entry['id']}"))
+        else:
+            due.append((entry, f"rec:{entry['id']}:{int(top[0])}"))
+        if entry["rule"] is None:
+            del SCHEDULE_ENTRIES[entry["id"]]
+            invalidate_slots()
+            continue
+        # Si el bot se retrasó, se salta a la siguiente fecha futura
+        entry["next_fire"] = compute_next_fire(
+            entry["rule"], max(entry["next_fire"], now)
+        )
+        entry["generation"] += 1
+        _push_schedule_entry(entry)
+    if due:
+        _SCHEDULE_STORE["dirty"] = True
+
+    # Un solo aviso por admin aunque venzan muchas entradas a la vez
+    sent_by_user: Dict[int, List[str]] = {}
+    for entry, key in due:
+        try:
+            message = await publish_with_retry(
+                context,
+                _entry_publication(entry),
+                key,
+                entry["user_id"],
+                f"la publicación #{entry['id']}",
+                entry.get("variables"),
+            )
+            if message is None:
+                if key in _RETRY_QUEUE:
+                    sent_by_user.setdefault(entry["user_id"], []).append(
+                        f"⏳ #{entry['id']}: error temporal, se reintentará"
+                    )
+                continue
+            if isinstance(message, OutboxHit) and message.state != "sent":
+                sent_by_user.setdefault(entry["user_id"], []).append(
+                    f"⚠️ #{entry['id']}: envío previo sin confirmar, revisa el canal"
+                )
+                continue
+            post_id = getattr(message, "message_id", None)
+            url = "https://t.me/JohaaleTrader_es"
+            if post_id is not None:
+                url = f"{url}/{post_id}"
+            icon = "🔁" if entry["rule"] is not None else "📅"
+            sent_by_user.setdefault(entry["user_id"], []).append(
+                f"{icon} #{entry['id']}: {url}"
+            )
+        except Exception as exc:
+            logging.error(
+                "Error enviando publicación programada #%s: %s", entry["id"], exc
+            )
+
+    for user_id, lines in sent_by_user.items():
+        text = f"✅ Publicaciones enviadas: {len(lines)}\n" + "\n".join(lines[:20])
+        if len(lines) > 20:
+            text += f"\n... y {len(lines) - 20} más."
+        try:
+            await context.bot.send_message(chat_id=user_id, text=text)
+        except Exception as exc:
+            logging.error("Error avisando al admin %s: %s", user_id, exc)
+
+    arm_schedule_dispatcher(context.application.job_queue)
+
+
+def build_recurring_menu(user_id: int) -> Tuple[str, List[List[InlineKeyboardButton]]]:
+    entries = get_user_recurring(user_id)
+    calendar = get_user_calendar(user_id)
+    keyboard: List[List[InlineKeyboardButton]] = [
+        [InlineKeyboardButton("➕ Nueva desde el borrador actual", callback_data="REC_NEW")],
+        [InlineKeyboardButton("📅 Subir calendario", callback_data="CAL_UPLOAD")],
+    ]
+    if not entries:
+        text = "No hay publicaciones recurrentes."
+    else:
+        lines = ["Publicaciones recurrentes:"]
+        for entry in entries[:20]:
+            title = _make_template_title(entry["snapshot"].text, entry["id"])
+            lines.append(
+                f"#{entry['id']} · {entry['spec']} · próxima "
+                f"{entry['next_fire'].strftime('%Y-%m-%d %H:%M')} · {title}"
+            )
+            keyboard.append(
+                [
+                    InlineKeyboardButton(
+                        f"🗑 Eliminar #{entry['id']}",
+                        callback_data=f"REC_DEL_{entry['id']}",
+                    )
+                ]
+            )
+        if len(entries) > 20:
+            lines.append(f"... y {len(entries) - 20} más.")
+        text = "\n".join(lines)
+    if calendar:
+        first = min(e["next_fire"] for e in calendar)
+        text += (
+            f"\n\n📅 Calendario: {len(calendar)} publicaciones pendientes "
+            f"(próxima {first.astimezone(LOCAL_TZ).strftime('%Y-%m-%d %H:%M')})."
+        )
+        keyboard.append(
+            [InlineKeyboardButton("🗑 Vaciar calendario", callback_data="CAL_CLEAR")]
+        )
+    keyboard.append([InlineKeyboardButton("⬅️ Volver al menú", callback_data="BACK_TO_MENU")])
+    return text, keyboard
+
+
+CALENDAR_HELP = (
+    "Envía el calendario como documento .csv o .jsonl, una publicación por línea.\n"
+    "CSV con cabecera: fecha,texto,tipo,file_id,botones\n"
+    "JSONL: {\"fecha\": ..., \"texto\": ..., \"tipo\": ..., \"file_id\": ..., \"botones\": [...]}\n"
+    "• fecha: AAAA-MM-DD HH:MM (hora local UTC-5)\n"
+    "• tipo: text, photo, video o voice (vacío = text)\n"
+    "• botones: \"Texto - URL | Texto - URL\""
+)
 
-    if new_text is not None and new_text.strip() != "":
-        draft["text"] = new_text
+CALENDAR_MEDIA_TYPES = ("photo", "video", "voice")
 
-    context.user_data["state"] = None
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text="Media del borrador actualizada.",
-    )
-    await send_draft_preview(user_id, chat_id, context)
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text="¿Qué quieres hacer ahora?",
-        reply_markup=InlineKeyboardMarkup(build_final_action_keyboard()),
+def _calendar_item_from_row(row: Dict[str, Any], now: datetime) -> Draft:
+    raw_date = str(row.get("fecha") or "").strip()
+    try:
+        scheduled_local = datetime.strptime(raw_date, "%Y-%m-%d %H:%M")
+    except ValueError:
+        raise ValueError(f"fecha inválida {raw_date!r}")
+    scheduled_at = scheduled_local.replace(tzinfo=LOCAL_TZ)
+    if scheduled_at <= now:
+        raise ValueError(f"la fecha {raw_date} no es futura")
+
+    text = str(row.get("texto") or "")
+    file_id = str(row.get("file_id") or "").strip() or None
+    content_type = str(row.get("tipo") or "").strip().lower() or "text"
+    if content_type in CALENDAR_MEDIA_TYPES:
+        if not file_id:
+            raise ValueError(f"tipo {content_type} sin file_id")
+    elif content_type == "text":
+        if file_id:
+            raise ValueError("file_id indicado pero falta el tipo de media")
+        if not text.strip():
+            raise ValueError("publicación sin texto")
+    else:
+        raise ValueError(f"tipo desconocido {content_type!r}")
+
+    raw_buttons = row.get("botones") or []
+    if isinstance(raw_buttons, str):
+        raw_buttons = raw_buttons.split("|")
+    lines = [
+        f"{b.get('text', '')} - {b.get('url', '')}" if isinstance(b, dict) else str(b)
+        for b in raw_buttons
+    ]
+    buttons = parse_buttons_from_text("\n".join(lines))
+    if len(buttons) != len([line for line in lines if line.strip()]):
+        raise ValueError("botones con formato inválido")
+
+    return Draft(
+        type=content_type,
+        file_id=file_id,
+        text=text,
+        buttons=buttons,
+        scheduled_at=scheduled_at,
     )
 
 
-async def handle_delete_button_index(
+def parse_calendar_file(
+    path: str, now: Optional[datetime] = None
+) -> Tuple[List[Draft], List[str]]:
+    """
+    Recorre el archivo una sola vez, validando cada línea. Devuelve las
+    publicaciones válidas y todos los errores encontrados.
+    """
+    now = now or datetime.now(LOCAL_TZ)
+    items: List[Draft] = []
+    errors: List[str] = []
+
+    with open(path, "r", encoding="utf-8-sig", newline="") as fh:
+        first = ""
+        while True:
+            char = fh.read(1)
+            if not char or not char.isspace():
+                first = char
+                break
+        fh.seek(0)
+
+        if first == "{":
+            rows = (
+                (line_no, line)
+                for line_no, line in enumerate(fh, start=1)
+                if line.strip()
+            )
+            for line_no, line in rows:
+                try:
+                    row = json.loads(line)
+                    if not isinstance(row, dict):
+                        raise ValueError("cada línea debe ser un objeto JSON")
+                    items.append(_calendar_item_from_row(row, now))
+                except (ValueError, TypeError) as exc:
+                    errors.append(f"línea {line_no}: {exc}")
+        else:
+            reader = csv.DictReader(fh)
+            try:
+                if not reader.fieldnames or "fecha" not in reader.fieldnames:
+                    return [], ["La cabecera CSV debe incluir al menos 'fecha'."]
+                for row in reader:
+                    try:
+                        items.append(_calendar_item_from_row(row, now))
+                    except ValueError as exc:
+                        errors.append(f"línea {reader.line_num}: {exc}")
+            except csv.Error as exc:
+                # Comillas mal cerradas o bytes NUL: el lector no puede seguir
+                errors.append(f"línea {reader.line_num}: CSV inválido ({exc})")
+    return items, errors
+
+
+async def handle_calendar_document(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     message = update.message
-    if message is None or message.text is None:
+    if message is None:
         return
 
     user_id = update.effective_user.id  # type: ignore[union-attr]
     chat_id = update.effective_chat.id  # type: ignore[union-attr]
-    draft = get_draft(user_id)
-    buttons = draft.get("buttons") or []
 
+    if message.document is None:
+        await context.bot.send_message(chat_id=chat_id, text=CALENDAR_HELP)
+        return
+
+    fd, path = tempfile.mkstemp(suffix=".calendar")
+    os.close(fd)
     try:
-        idx = int(message.text.strip())
-    except ValueError:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="Debes enviar un número válido.",
-        )
+        tg_file = await message.document.get_file()
+        await tg_file.download_to_drive(path)
+        items, errors = parse_calendar_file(path)
+    except UnicodeDecodeError:
+        items, errors = [], ["El archivo debe estar en UTF-8."]
+    finally:
+        os.unlink(path)
+    if not errors:
+        errors = calendar_slot_errors(items)
+
+    if errors:
+        lines = [
+            f"❌ Calendario rechazado: {len(errors)} errores. No se programó nada.",
+        ]
+        lines.extend(errors[:30])
+        if len(errors) > 30:
+            lines.append(f"... y {len(errors) - 30} más.")
+        await context.bot.send_message(chat_id=chat_id, text="\n".join(lines))
         return
 
-    if idx < 1 or idx > len(buttons):
+    if not items:
         await context.bot.send_message(
-            chat_id=chat_id,
-            text="Número fuera de rango.",
+            chat_id=chat_id, text="El calendario no contiene publicaciones."
         )
         return
 
-    removed = buttons.pop(idx - 1)
-    draft["buttons"] = buttons
+    add_calendar_entries(user_id, items)
+    arm_schedule_dispatcher(context.application.job_queue)
     context.user_data["state"] = None
 
+    first = min(item.scheduled_at for item in items)
+    last = max(item.scheduled_at for item in items)
     await context.bot.send_message(
         chat_id=chat_id,
-        text=f"Botón '{removed[0].text}' eliminado.",
+        text=(
+            f"✅ {len(items)} publicaciones programadas.\n"
+            f"Primera: {first.strftime('%Y-%m-%d %H:%M')}\n"
+            f"Última: {last.strftime('%Y-%m-%d %H:%M')}"
+        ),
     )
     await send_main_menu_simple(context, chat_id, user_id)
 
 
-async def handle_delete_template_index(
+async def handle_recurring_spec(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     message = update.message
-    if message is None or message.text is None:
+    if message is None or not message.text:
         return
 
     user_id = update.effective_user.id  # type: ignore[union-attr]
     chat_id = update.effective_chat.id  # type: ignore[union-attr]
+    draft = get_draft(user_id)
 
-    defaults = get_defaults(user_id)
-    templates = defaults.get("templates", [])
-
+    spec, _, raw_values = message.text.partition("|")
     try:
-        idx = int(message.text.strip())
-    except ValueError:
+        variables = parse_variable_assignments(raw_values)
+        problem = recurring_slot_problem(parse_recurrence_spec(spec))
+        if problem is None:
+            entry = add_recurring(user_id, spec, draft, variables=variables)
+    except ValueError as exc:
         await context.bot.send_message(
             chat_id=chat_id,
-            text="Debes enviar un número válido.",
+            text=f"Regla inválida: {exc}\n\n{RECURRING_HELP}",
         )
         return
-
-    if idx < 1 or idx > len(templates):
+    if problem is not None:
         await context.bot.send_message(
             chat_id=chat_id,
-            text="Número fuera de rango.",
+            text=(
+                f"❌ No se creó la recurrente: {problem}.\n"
+                f"Horario de publicación: {describe_post_windows()}. Envía otra regla."
+            ),
         )
         return
 
-    removed = templates.pop(idx - 1)
-    defaults["templates"] = templates
+    arm_schedule_dispatcher(context.application.job_queue)
     context.user_data["state"] = None
 
     await context.bot.send_message(
         chat_id=chat_id,
-        text=f"Plantilla '{removed['title']}' eliminada.",
+        text=(
+            f"✅ Publicación recurrente #{entry['id']} creada ({entry['spec']}).\n"
+            f"Próximo envío: {entry['next_fire'].strftime('%Y-%m-%d %H:%M')}."
+        ),
     )
     await send_main_menu_simple(context, chat_id, user_id)
 
 
-async def handle_edit_template_text(
-    update: Update, context: ContextTypes.DEFAULT_TYPE
-) -> None:
-    message = update.message
-    if message is None or message.text is None:
-        return
+# --------- Huecos de publicación ---------
+# Entre dos publicaciones al canal tiene que haber al menos POST_SPACING_SECONDS
+# y solo se publica dentro de POST_WINDOWS (minutos del día en hora local;
+# vacío = todo el día). Las horas ocupadas son las de los borradores
+# programados y las próximas repeticiones de recurrentes y calendario. Cada
+# una bloquea (t - margen, t + margen); los bloques se fusionan en dos listas
+# ordenadas y "siguiente hueco libre" es una búsqueda binaria sobre ellas.
+# Solo se recalculan después de un cambio en lo programado.
+POST_SPACING_SECONDS = 60.0
+POST_WINDOWS: Tuple[Tuple[int, int], ...] = ()
+SLOT_HORIZON_DAYS = 14
+SLOT_MAX_REPEATS = 500  # repeticiones por recurrente dentro del horizonte
+
+
+class SlotAllocator:
+    """Horas ocupadas (ordenadas) y bloques fusionados para buscar huecos."""
+
+    __slots__ = ("times", "starts", "ends", "dirty")
+
+    def __init__(self) -> None:
+        self.times: List[float] = []
+        self.starts: List[float] = []
+        self.ends: List[float] = []
+        self.dirty = True
+
+    def rebuild(self, times: List[float]) -> None:
+        times.sort()
+        starts: List[float] = []
+        ends: List[float] = []
+        for t in times:
+            lo, hi = t - POST_SPACING_SECONDS, t + POST_SPACING_SECONDS
+            # Justo a un margen de las dos sigue siendo un hueco válido
+            if ends and lo < ends[-1]:
+                ends[-1] = max(ends[-1], hi)
+            else:
+                starts.append(lo)
+                ends.append(hi)
+        self.times, self.starts, self.ends = times, starts, ends
+        self.dirty = False
+
+    def conflicts(self, ts: float, ignore: Optional[float] = None) -> List[float]:
+        """Horas ocupadas a menos de un margen de `ts` (sin contar `ignore`)."""
+        lo = bisect_right(self.times, ts - POST_SPACING_SECONDS)
+        hi = bisect_left(self.times, ts + POST_SPACING_SECONDS)
+        found = self.times[lo:hi]
+        if ignore is not None and ignore in found:
+            found.remove(ignore)
+        return found
+
+    def next_free(self, after: float) -> Optional[float]:
+        """Primer minuto libre y dentro de las ventanas desde `after` (None si no hay)."""
+        candidate = after
+        limit = after + SLOT_HORIZON_DAYS * 86400
+        while candidate <= limit:
+            candidate = -(-candidate // 60) * 60  # al minuto siguiente
+            window_start = next_window_start(candidate)
+            if window_start != candidate:
+                candidate = window_start
+                continue
+            i = bisect_left(self.starts, candidate) - 1
+            if i >= 0 and candidate < self.ends[i]:
+                candidate = self.ends[i]
+                continue
+            return candidate
+        return None
 
-    user_id = update.effective_user.id  # type: ignore[union-attr]
-    chat_id = update.effective_chat.id  # type: ignore[union-attr]
 
-    defaults = get_defaults(user_id)
-    templates = defaults.get("templates", [])
+SLOTS = SlotAllocator()
 
-    idx = context.user_data.get("template_edit_index")
-    if not isinstance(idx, int) or idx < 0 or idx >= len(templates):
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="No hay una plantilla válida seleccionada para guardar cambios.",
-        )
-        context.user_data["state"] = None
-        return
 
-    templates[idx]["text"] = message.text
-    defaults["templates"] = templates
-    context.user_data["state"] = None
+def invalidate_slots() -> None:
+    SLOTS.dirty = True
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        text="Plantilla actualizada correctamente.",
-    )
-    await send_main_menu_simple(context, chat_id, user_id)
 
+def _local_timestamp(when: datetime) -> float:
+    # Los borradores guardan la hora local sin zona
+    return (when if when.tzinfo else when.replace(tzinfo=LOCAL_TZ)).timestamp()
 
 
-# --------- JobQueue ---------
-async def send_scheduled_publication(context: ContextTypes.DEFAULT_TYPE) -> None:
-    job = context.job
-    if job is None:
-        return
-    data = job.data or {}
-    user_id = data.get("user_id")
-    if user_id is None:
-        return
+def occupied_times(now: Optional[datetime] = None) -> List[float]:
+    now = now or datetime.now(LOCAL_TZ)
+    horizon = now + timedelta(days=SLOT_HORIZON_DAYS)
+    times: List[float] = []
+    for index in DRAFT_INDEX.values():
+        times.extend(_local_timestamp(when) for when in index.scheduled.values())
+    for entry in SCHEDULE_ENTRIES.values():
+        fire = entry["next_fire"]
+        times.append(fire.timestamp())
+        if entry["rule"] is None:
+            continue
+        for _ in range(SLOT_MAX_REPEATS):
+            fire = compute_next_fire(entry["rule"], fire)
+            if fire > horizon:
+                break
+            times.append(fire.timestamp())
+    return times
+
+
+def post_slots() -> SlotAllocator:
+    if SLOTS.dirty:
+        SLOTS.rebuild(occupied_times())
+    return SLOTS
+
+
+def next_window_start(ts: float) -> float:
+    """`ts` si cae dentro de una ventana; si no, el inicio de la siguiente."""
+    if not POST_WINDOWS:
+        return ts
+    local = datetime.fromtimestamp(ts, LOCAL_TZ)
+    minute = local.hour * 60 + local.minute
+    midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    for start, end in POST_WINDOWS:
+        if start <= minute < end:
+            return ts
+        if start > minute:
+            return (midnight + timedelta(minutes=start)).timestamp()
+    return (midnight + timedelta(days=1, minutes=POST_WINDOWS[0][0])).timestamp()
+
+
+def parse_post_windows(raw: str) -> Tuple[Tuple[int, int], ...]:
+    """"08:00-12:00, 18:00-23:30" -> ((480, 720), (1080, 1410)). Admite cruzar medianoche."""
+    windows: List[Tuple[int, int]] = []
+    for part in raw.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            start_raw, end_raw = part.split("-")
+            start = datetime.strptime(start_raw.strip(), "%H:%M")
+            end = datetime.strptime(end_raw.strip(), "%H:%M")
+        except ValueError:
+            raise ValueError(f"ventana inválida {part!r}")
+        start_min = start.hour * 60 + start.minute
+        end_min = end.hour * 60 + end.minute
+        if end_min == start_min:
+            raise ValueError(f"ventana vacía {part!r}")
+        if end_min < start_min:
+            windows.append((start_min, 24 * 60))
+            windows.append((0, end_min))
+        else:
+            windows.append((start_min, end_min))
+    return tuple(sorted(windows))
 
-    draft = DRAFTS.get(user_id)
-    if not draft_has_content(draft):
-        return
 
-    try:
-        message = await send_publication_to_target(draft, context)  # type: ignore[arg-type]
-        draft["scheduled_at"] = None
-        draft["job"] = None
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="✅ Publicación programada enviada correctamente al canal.",
-        )
+def describe_post_windows() -> str:
+    if not POST_WINDOWS:
+        return "todo el día"
+    return ", ".join(
+        f"{start // 60:02d}:{start % 60:02d}-{end // 60 % 24:02d}:{end % 60:02d}"
+        for start, end in POST_WINDOWS
+    )
 
-        post_id = None
-        try:
-            if message is not None:
-                post_id = message.message_id
-        except Exception:
-            post_id = None
 
-        base_url = "https://t.me/JohaaleTrader_es"
-        url = base_url
-        if post_id is not None:
-            url = f"{base_url}/{post_id}"
+def check_slot(ts: float, ignore: Optional[float] = None) -> Optional[str]:
+    """Motivo por el que no se puede publicar a esa hora (None si está libre)."""
+    if next_window_start(ts) != ts:
+        return f"fuera del horario de publicación ({describe_post_windows()})"
+    taken = post_slots().conflicts(ts, ignore)
+    if taken:
+        other = datetime.fromtimestamp(taken[0], LOCAL_TZ).strftime("%H:%M")
+        spacing = int(POST_SPACING_SECONDS // 60)
+        return f"hay otra publicación a las {other} (mínimo {spacing} min entre publicaciones)"
+    return None
+
+
+def recurring_slot_problem(rule: Dict[str, Any], now: Optional[datetime] = None) -> Optional[str]:
+    """Primera repetición dentro del horizonte que no cabe (None si todas caben)."""
+    now = now or datetime.now(LOCAL_TZ)
+    horizon = now + timedelta(days=SLOT_HORIZON_DAYS)
+    fire = compute_next_fire(rule, now)
+    previous: Optional[float] = None
+    for _ in range(SLOT_MAX_REPEATS):
+        if fire > horizon:
+            break
+        ts = fire.timestamp()
+        problem = check_slot(ts)
+        if problem is None and previous is not None and ts - previous < POST_SPACING_SECONDS:
+            problem = "se repite más a menudo que el mínimo entre publicaciones"
+        if problem is not None:
+            return f"{fire.strftime('%Y-%m-%d %H:%M')}: {problem}"
+        previous = ts
+        fire = compute_next_fire(rule, fire)
+    return None
+
+
+def calendar_slot_errors(items: List[Draft]) -> List[str]:
+    """Publicaciones del calendario fuera de horario o demasiado juntas (entre sí o con lo ya programado)."""
+    errors: List[str] = []
+    spacing = int(POST_SPACING_SECONDS // 60)
+    previous: Optional[float] = None
+    for item in sorted(items, key=lambda d: _local_timestamp(d.scheduled_at)):  # type: ignore[arg-type]
+        ts = _local_timestamp(item.scheduled_at)  # type: ignore[arg-type]
+        problem = check_slot(ts)
+        if problem is None and previous is not None and ts - previous < POST_SPACING_SECONDS:
+            problem = f"a menos de {spacing} min de la anterior del archivo"
+        if problem is not None:
+            errors.append(f"{item.scheduled_at.strftime('%Y-%m-%d %H:%M')}: {problem}")  # type: ignore[union-attr]
+        previous = ts
+    return errors
+
+
+def suggest_slot(after: Optional[float] = None) -> Optional[datetime]:
+    """Próximo hueco libre (hora local sin zona, como draft.scheduled_at)."""
+    ts = post_slots().next_free(max(after or 0.0, time.time() + 60))
+    if ts is None:
+        return None
+    return datetime.fromtimestamp(ts, LOCAL_TZ).replace(tzinfo=None)
 
-        buttons_after_send = [
-            [InlineKeyboardButton("🔗 Así se publicó en el canal", url=url)],
-            [InlineKeyboardButton("Volver al menú", callback_data="BACK_TO_MENU")],
+
+def slot_keyboard(when: Optional[datetime]) -> Optional[InlineKeyboardMarkup]:
+    if when is None:
+        return None
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    f"⚡ Próximo hueco libre: {when.strftime('%Y-%m-%d %H:%M')}",
+                    callback_data=f"SLOT_AT_{int(_local_timestamp(when))}",
+                )
+            ]
         ]
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="Selecciona una opción:",
-            reply_markup=InlineKeyboardMarkup(buttons_after_send),
-        )
-    except Exception as exc:
-        logging.error("Error enviando publicación programada: %s", exc)
+    )
 
 
 # --------- Router de mensajes ---------
@@ -1595,12 +5640,16 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await handle_edit_text(update, context)
     elif state == "AWAITING_NEW_MEDIA":
         await handle_new_media(update, context)
-    elif state == "AWAITING_DELETE_BUTTON_INDEX":
-        await handle_delete_button_index(update, context)
-    elif state == "AWAITING_DELETE_TEMPLATE_INDEX":
-        await handle_delete_template_index(update, context)
     elif state == "AWAITING_EDIT_TEMPLATE_TEXT":
         await handle_edit_template_text(update, context)
+    elif state == "AWAITING_RECURRING_SPEC":
+        await handle_recurring_spec(update, context)
+    elif state == "AWAITING_DRAFT_NAME":
+        await handle_draft_name(update, context)
+    elif state == "AWAITING_IMPORT_DOCUMENT":
+        await handle_import_document(update, context)
+    elif state == "AWAITING_CALENDAR_DOCUMENT":
+        await handle_calendar_document(update, context)
     else:
         await context.bot.send_message(
             chat_id=chat_id,
@@ -1613,38 +5662,653 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     logging.error("Excepción en el manejador", exc_info=context.error)
 
 
-# --------- Main ---------
-def main() -> None:
-    logging.basicConfig(
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        level=logging.INFO,
-    )
+# --------- Registro estructurado ---------
+# Cada update lleva un id de correlación ("u<update_id>") que se propaga por
+# los manejadores, las llamadas a la Bot API y los trabajos que programa; los
+# envíos al canal añaden además su clave de outbox ("pub"). Los registros se
+# formatean y escriben en un hilo aparte (QueueHandler -> QueueListener) para
+# no bloquear el bucle de eventos.
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "json"  # "json" o "text"
+# Fracción de ids de correlación cuyo DEBUG se conserva (la traza entera o nada)
+LOG_DEBUG_SAMPLE = 1.0
+
+_CORRELATION_ID: ContextVar[str] = ContextVar("correlation_id", default="-")
+_PUBLICATION_KEY: ContextVar[Optional[str]] = ContextVar("publication_key", default=None)
+_JOB_SEQUENCE = count(1)
+_LOG_LISTENER: Dict[str, Any] = {"listener": None}
+
+_TEXT_LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [%(correlation_id)s] %(message)s"
+# Atributos propios de LogRecord: el resto son campos pasados con extra={...}
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+    "correlation_id",
+    "publication_key",
+}
+
 
-    token = os.getenv("BOT_TOKEN")
-    admin_id_str = os.getenv("ADMIN_ID")
-    target_chat = os.getenv("TARGET_CHAT_ID")
+def new_correlation_id(prefix: str) -> str:
+    return f"{prefix}#{next(_JOB_SEQUENCE)}"
 
-    if not token or not admin_id_str or not target_chat:
+
+def begin_job_trace(context: ContextTypes.DEFAULT_TYPE, parent: Optional[str] = None) -> str:
+    """
+    Da id de correlación a un trabajo programado. Si lo programó un update
+    (data["corr"] o `parent`) cuelga de su id para poder seguir la traza.
+    """
+    job = context.job
+    data = getattr(job, "data", None)
+    if parent is None and isinstance(data, dict):
+        parent = data.get("corr")
+    name = getattr(job, "name", None) or "job"
+    corr = f"{parent}>{name}" if parent else new_correlation_id(name)
+    _CORRELATION_ID.set(corr)
+    _PUBLICATION_KEY.set(None)
+    return corr
+
+
+async def tag_update(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Grupo -3: fija el id de correlación del update antes que ningún otro manejador."""
+    update_id = getattr(update, "update_id", None)
+    _CORRELATION_ID.set(f"u{update_id}" if update_id is not None else new_correlation_id("update"))
+    _PUBLICATION_KEY.set(None)
+    if logging.root.isEnabledFor(logging.DEBUG):
+        user = getattr(update, "effective_user", None)
+        kind = "callback" if getattr(update, "callback_query", None) else "message"
+        logging.debug(
+            "Update recibido.",
+            extra={"event": "update", "kind": kind, "user_id": getattr(user, "id", None)},
+        )
+
+
+class DebugSampler(logging.Filter):
+    """Deja pasar solo el DEBUG de una fracción estable de ids de correlación."""
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate >= 1.0:
+            return True
+        if self.rate <= 0:
+            return False
+        bucket = zlib.crc32(_CORRELATION_ID.get().encode()) % 10000
+        return bucket < self.rate * 10000
+
+
+class ContextQueueHandler(QueueHandler):
+    """Encola el registro ya resuelto junto con el contexto del hilo que lo emite."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.correlation_id = _CORRELATION_ID.get()
+        record.publication_key = _PUBLICATION_KEY.get()
+        return record
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Una línea JSON por registro: ts, level, logger, msg, corr, pub y los extra."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "corr": getattr(record, "correlation_id", None) or _CORRELATION_ID.get(),
+        }
+        publication_key = getattr(record, "publication_key", None)
+        if publication_key:
+            entry["pub"] = publication_key
+        for name, value in record.__dict__.items():
+            if name not in _RECORD_ATTRS:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(
+    level: str = LOG_LEVEL, log_format: str = LOG_FORMAT, debug_sample: float = LOG_DEBUG_SAMPLE
+) -> None:
+    """Sustituye los handlers raíz por la cola; la escritura la hace el QueueListener."""
+    stop_logging()
+    output = logging.StreamHandler()
+    if log_format == "json":
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(logging.Formatter(_TEXT_LOG_FORMAT))
+    log_queue: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+    handler = ContextQueueHandler(log_queue)
+    handler.addFilter(DebugSampler(debug_sample))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    listener = QueueListener(log_queue, output)
+    listener.start()
+    _LOG_LISTENER["listener"] = listener
+
+
+def stop_logging() -> None:
+    """Vacía la cola de registros pendientes y para el hilo escritor."""
+    listener = _LOG_LISTENER["listener"]
+    if listener is not None:
+        _LOG_LISTENER["listener"] = None
+        listener.stop()
+
+
+class LoggedRequest(BaseRequest):
+    """
+    Envuelve la capa HTTP de la Bot API: cada llamada queda en DEBUG con el
+    método, el estado HTTP y la duración, bajo el id de correlación activo.
+    """
+
+    def __init__(self, inner: BaseRequest) -> None:
+        self.inner = inner
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.inner.read_timeout
+
+    async def initialize(self) -> None:
+        await self.inner.initialize()
+
+    async def shutdown(self) -> None:
+        await self.inner.shutdown()
+
+    async def do_request(  # type: ignore[override]
+        self, url: str, method: str, request_data: Any = None, **timeouts: Any
+    ) -> Tuple[int, bytes]:
+        if not logging.root.isEnabledFor(logging.DEBUG):
+            return await self.inner.do_request(url, method, request_data, **timeouts)
+        started = time.perf_counter()
+        status: Any = None
+        try:
+            status, payload = await self.inner.do_request(url, method, request_data, **timeouts)
+            return status, payload
+        except Exception as exc:
+            status = type(exc).__name__
+            raise
+        finally:
+            logging.debug(
+                "Bot API %s.",
+                url.rsplit("/", 1)[-1],
+                extra={
+                    "event": "api_call",
+                    "method": url.rsplit("/", 1)[-1],
+                    "status": status,
+                    "ms": round((time.perf_counter() - started) * 1000, 1),
+                },
+            )
+
+
+# --------- Arranque y parada ---------
+def _startup_elapsed() -> Optional[float]:
+    started = _STARTUP["started"]
+    return None if started is None else time.perf_counter() - started
+
+
+async def record_first_update(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Grupo -2: anota cuánto tardó en llegar el primer update tras el arranque."""
+    if _STARTUP["first_update"] is not None or _STARTUP["started"] is None:
+        return
+    _STARTUP["first_update"] = _startup_elapsed()
+    logging.info("Primer update procesado a los %.2fs del arranque.", _STARTUP["first_update"])
+
+
+async def preflight_target_chat(application: Application) -> None:
+    """Comprueba al arrancar que el bot puede publicar en TARGET_CHAT_ID."""
+    try:
+        chat = await application.bot.get_chat(TARGET_CHAT_ID)
+        member = await application.bot.get_chat_member(chat.id, application.bot.id)
+    except (BadRequest, Forbidden) as exc:
         raise RuntimeError(
-            "Faltan variables de entorno: BOT_TOKEN, ADMIN_ID o TARGET_CHAT_ID."
+            f"TARGET_CHAT_ID={TARGET_CHAT_ID!r} no es accesible para el bot: {exc}"
+        ) from exc
+    except NetworkError as exc:
+        logging.warning("No se pudo verificar TARGET_CHAT_ID (%s); se sigue arrancando.", exc)
+        return
+    if member.status not in ("administrator", "creator"):
+        logging.warning(
+            "El bot no es administrador de %s (estado %s): puede que no pueda publicar.",
+            TARGET_CHAT_ID,
+            member.status,
+        )
+
+
+async def reject_while_draining(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Grupo -1: durante la parada no se empieza ningún trabajo nuevo."""
+    if not _SHUTDOWN_STATE["draining"]:
+        return
+    text = "⏳ El bot se está reiniciando. Inténtalo de nuevo en un momento."
+    if isinstance(update, Update):
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(text, show_alert=True)
+            elif update.effective_chat is not None:
+                await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+        except Exception:
+            pass
+    raise ApplicationHandlerStop
+
+
+async def drain_and_stop(application: Application) -> None:
+    loop = asyncio.get_running_loop()
+    logging.info("Parada solicitada: se dejan de recibir updates y se esperan los envíos en curso.")
+    if application.updater is not None and application.updater.running:
+        await application.updater.stop()
+    deadline = loop.time() + DRAIN_TIMEOUT_SECONDS
+    while _SHUTDOWN_STATE["inflight_sends"] > 0 and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    if _SHUTDOWN_STATE["inflight_sends"] > 0:
+        logging.warning(
+            "Plazo de parada agotado con %s envíos todavía en curso.",
+            _SHUTDOWN_STATE["inflight_sends"],
+        )
+    application.stop_running()
+
+
+def begin_shutdown(application: Application) -> None:
+    if _SHUTDOWN_STATE["draining"]:
+        # Segunda señal: parar ya, sin esperar
+        application.stop_running()
+        return
+    _SHUTDOWN_STATE["draining"] = True
+    _SHUTDOWN_STATE["task"] = asyncio.get_running_loop().create_task(
+        drain_and_stop(application)
+    )
+
+
+def collect_restart_due(now: datetime) -> List[Tuple[str, int, Optional[int], float, str]]:
+    """
+    Borradores programados y entradas recurrentes o de calendario que vencen
+    dentro de la ventana de reinicio (solo para avisarlo en el log al parar).
+    """
+    rows: List[Tuple[str, int, Optional[int], float, str]] = []
+    window_end = now.timestamp() + RESTART_WINDOW_SECONDS
+    for user_id, active in DRAFTS.items():
+        index = DRAFT_INDEX.get(user_id)
+        drafts = [active] + (list(index.shelved.values()) if index else [])
+        for draft in drafts:
+            if draft.job is not None and draft.scheduled_at is not None:
+                due_at = draft.scheduled_at.replace(tzinfo=LOCAL_TZ).timestamp()
+                if due_at <= window_end:
+                    rows.append(
+                        (
+                            "draft",
+                            user_id,
+                            draft_ref(user_id, draft),
+                            due_at,
+                            f"{draft_label(draft)}: {_make_template_title(draft.text, 0)}",
+                        )
+                    )
+    for entry in SCHEDULE_ENTRIES.values():
+        due_at = entry["next_fire"].timestamp()
+        if due_at <= window_end:
+            title = _make_template_title(entry["snapshot"].text, entry["id"])
+            rows.append(("entry", entry["user_id"], entry["id"], due_at, title))
+    return rows
+
+
+async def on_application_stop(application: Application) -> None:
+    """post_stop: guarda todo el estado pendiente y avisa de lo que vence durante el reinicio."""
+    now = datetime.now(LOCAL_TZ)
+    rows = collect_restart_due(now)
+    if _RETRY_QUEUE:
+        # Ya están en send_retries: se retoman al arrancar
+        logging.info("Reintentos pendientes al parar: %s.", len(_RETRY_QUEUE))
+    await close_analytics()
+    flushed = flush_user_states(list(set(DRAFTS) | set(DEFAULTS)))
+    saved = save_schedule_entries()
+    if _MEDIA_STORE["dirty"]:
+        save_media_library()
+    for kind, user_id, ref, due_at, title in rows:
+        logging.warning(
+            "Vence durante el reinicio: %s %s (usuario %s) a las %s: %s",
+            kind,
+            ref or "",
+            user_id,
+            datetime.fromtimestamp(due_at, LOCAL_TZ).strftime("%Y-%m-%d %H:%M"),
+            title,
+        )
+    logging.info(
+        "Estado guardado: %s usuarios, %s entradas programadas.", flushed, saved
+    )
+
+
+def stored_draft_schedules() -> Dict[Tuple[int, int], Tuple[float, str]]:
+    """
+    Borradores programados según el disco: las filas de draft_schedules, las de
+    restart_due de versiones anteriores y los scheduled_at guardados en
+    user_state que no tengan fila (p. ej. si el proceso murió sin post_stop).
+    """
+    conn = _db()
+    found: Dict[Tuple[int, int], Tuple[float, str]] = {}
+    for user_id, draft_id, due_at, title in conn.execute(
+        "SELECT user_id, draft_id, due_at, title FROM draft_schedules"
+    ):
+        found[(user_id, draft_id)] = (due_at, title)
+    for user_id, draft_id, due_at, title in conn.execute(
+        "SELECT user_id, ref, due_at, title FROM restart_due"
+        " WHERE kind = 'draft' AND ref IS NOT NULL"
+    ):
+        found.setdefault((user_id, draft_id), (due_at, title))
+    with conn:
+        conn.execute("DELETE FROM restart_due")
+    # Filtro barato antes de parsear el JSON: solo usuarios con alguna hora guardada
+    for user_id, raw in conn.execute(
+        "SELECT user_id, data FROM user_state WHERE data LIKE '%\"scheduled_at\": \"%'"
+    ).fetchall():
+        data = json.loads(raw)
+        for item in [data.get("draft")] + list(data.get("drafts") or []):
+            if not item or not item.get("scheduled_at") or item.get("draft_id") is None:
+                continue
+            draft = Draft.from_data(item)
+            found.setdefault(
+                (user_id, draft.draft_id),  # type: ignore[arg-type]
+                (
+                    draft.scheduled_at.replace(tzinfo=LOCAL_TZ).timestamp(),  # type: ignore[union-attr]
+                    f"{draft_label(draft)}: {_make_template_title(draft.text, 0)}",
+                ),
+            )
+    return found
+
+
+async def on_application_start(application: Application) -> None:
+    """post_init: señales de parada, entradas guardadas y borradores programados."""
+    await preflight_target_chat(application)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, begin_shutdown, application)
+        except (NotImplementedError, RuntimeError):
+            logging.warning("No se pudo instalar el manejador de la señal %s.", sig)
+
+    load_media_library()
+    now = datetime.now(LOCAL_TZ)
+    notices: Dict[int, List[str]] = {}
+    for entry in load_schedule_entries(now):
+        icon = "🔁" if entry["rule"] is not None else "📅"
+        notices.setdefault(entry["user_id"], []).append(
+            f"{icon} #{entry['id']} ({entry['spec']}): "
+            f"{_make_template_title(entry['snapshot'].text, entry['id'])}"
         )
 
-    global ADMIN_ID, TARGET_CHAT_ID
+    for (user_id, draft_id), (due_at, title) in stored_draft_schedules().items():
+        init_user_structs(user_id)
+        draft = find_user_draft(user_id, draft_id)
+        when_local = datetime.fromtimestamp(due_at, LOCAL_TZ)
+        sent = outbox_get(scheduled_draft_key(user_id, draft_id, when_local))
+        if draft is not None and sent is not None and sent[0] == "sent":
+            draft.scheduled_at = None
+            note_draft_schedule(user_id, draft)
+            continue
+        delay = due_at - now.timestamp()
+        if draft is not None and delay > 1 and draft_has_content(draft):
+            draft.scheduled_at = when_local.replace(tzinfo=None)
+            draft.job = application.job_queue.run_once(
+                send_scheduled_publication,
+                delay,
+                data={"user_id": user_id, "draft_id": draft_id},
+            )
+            note_draft_schedule(user_id, draft)
+            continue
+        if draft is not None:
+            draft.scheduled_at = None
+            mark_user_dirty(user_id)
+        drop_draft_schedule(user_id, draft_id)
+        if sent is not None and sent[0] == "sent":
+            continue
+        when = when_local.strftime("%Y-%m-%d %H:%M")
+        notices.setdefault(user_id, []).append(f"⏰ Borrador de las {when}: {title}")
+    flush_user_states()
+
+    # Envíos que se cortaron a medias: no se reenvían, el admin debe comprobarlos
+    for key, title, created_at in outbox_unreviewed_pending():
+        when = datetime.fromtimestamp(created_at, LOCAL_TZ).strftime("%Y-%m-%d %H:%M")
+        notices.setdefault(ADMIN_ID, []).append(f"❓ Sin confirmar ({when}, {key}): {title}")
+
+    arm_schedule_dispatcher(application.job_queue)
+    retries = restore_send_retries(application.job_queue)
+    if retries:
+        logging.info("Reintentos de envío retomados tras el reinicio: %s.", retries)
+
+    for user_id, lines in notices.items():
+        try:
+            await application.bot.send_message(
+                chat_id=user_id,
+                text=(
+                    "⚠️ Revisa estas publicaciones tras el reinicio (las que vencían "
+                    "con el bot detenido NO se enviaron):\n" + "\n".join(lines[:30])
+                ),
+            )
+        except Exception as exc:
+            logging.error("No se pudo avisar al admin %s: %s", user_id, exc)
+
+    _STARTUP["ready"] = _startup_elapsed()
+    if _STARTUP["ready"] is not None:
+        logging.info("Bot listo a los %.2fs del arranque.", _STARTUP["ready"])
+
+
+# --------- Configuración ---------
+# Formato de token de BotFather: <id numérico>:<35 caracteres aprox.>
+_TOKEN_RE = re.compile(r"^\d{5,}:[A-Za-z0-9_-]{30,}$")
+_CHAT_USERNAME_RE = re.compile(r"^@[A-Za-z][A-Za-z0-9_]{4,31}$")
+
+
+def parse_chat_id(raw: str) -> Any:
+    """-100123... -> int; @canal -> str. Lanza ValueError si no es ninguna de las dos."""
+    value = raw.strip()
+    if re.fullmatch(r"-?\d+", value):
+        return int(value)
+    if _CHAT_USERNAME_RE.match(value):
+        return value
+    raise ValueError(value)
+
+
+def validate_config(env: Any) -> Dict[str, Any]:
+    """
+    Lee y valida toda la configuración del entorno antes de construir nada.
+    Reúne todos los errores en un solo RuntimeError.
+    """
+    errors: List[str] = []
+    config: Dict[str, Any] = {}
+
+    token = (env.get("BOT_TOKEN") or "").strip()
+    if not token:
+        errors.append("Falta BOT_TOKEN.")
+    elif not _TOKEN_RE.match(token):
+        errors.append("BOT_TOKEN no tiene el formato <id>:<clave> de BotFather.")
+    config["token"] = token
+
+    admin_raw = (env.get("ADMIN_ID") or "").strip()
+    config["admin_id"] = 0
+    if not admin_raw:
+        errors.append("Falta ADMIN_ID.")
+    else:
+        try:
+            config["admin_id"] = int(admin_raw)
+        except ValueError:
+            errors.append("ADMIN_ID debe ser un número entero válido.")
+
+    target_raw = env.get("TARGET_CHAT_ID") or ""
+    if not target_raw.strip():
+        errors.append("Falta TARGET_CHAT_ID.")
+        config["target_chat_id"] = None
+    else:
+        try:
+            config["target_chat_id"] = parse_chat_id(target_raw)
+        except ValueError:
+            errors.append(
+                "TARGET_CHAT_ID debe ser un id numérico (p. ej. -100123...) o un @usuario."
+            )
+            config["target_chat_id"] = None
+
+    numbers = (
+        ("STATE_IDLE_TTL", "idle_ttl", int, STATE_IDLE_TTL_SECONDS),
+        ("STATE_MAX_ACTIVE_USERS", "max_active_users", int, STATE_MAX_ACTIVE_USERS),
+        ("DRAIN_TIMEOUT", "drain_timeout", float, DRAIN_TIMEOUT_SECONDS),
+        ("RESTART_WINDOW", "restart_window", float, RESTART_WINDOW_SECONDS),
+        ("PORT", "port", int, 8443),
+        ("POST_SPACING_MINUTES", "post_spacing_minutes", float, POST_SPACING_SECONDS / 60),
+        ("LOG_DEBUG_SAMPLE", "log_debug_sample", float, LOG_DEBUG_SAMPLE),
+    )
+    for env_name, key, kind, default in numbers:
+        raw = env.get(env_name)
+        try:
+            value = kind(raw) if raw not in (None, "") else default
+            if value < 0:
+                raise ValueError
+            config[key] = value
+        except ValueError:
+            errors.append(f"{env_name} debe ser un número positivo.")
+
+    if config.get("log_debug_sample", 0) > 1:
+        errors.append("LOG_DEBUG_SAMPLE debe estar entre 0 y 1.")
+
+    log_level = (env.get("LOG_LEVEL") or LOG_LEVEL).strip().upper()
+    if log_level not in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
+        errors.append("LOG_LEVEL debe ser DEBUG, INFO, WARNING, ERROR o CRITICAL.")
+    config["log_level"] = log_level
+    log_format = (env.get("LOG_FORMAT") or LOG_FORMAT).strip().lower()
+    if log_format not in ("json", "text"):
+        errors.append("LOG_FORMAT debe ser json o text.")
+    config["log_format"] = log_format
+
+    config["state_db_path"] = env.get("STATE_DB_PATH") or STATE_DB_PATH
+
+    webhook_url = (env.get("WEBHOOK_URL") or "").strip()
+    if webhook_url and not webhook_url.startswith("https://"):
+        errors.append("WEBHOOK_URL debe empezar por https://")
+    config["webhook_url"] = webhook_url or None
+
+    # Desactivadas salvo que se indique ANALYTICS_CHANNEL: leer el widget
+    # público de t.me es una petición periódica que hay que pedir a propósito
+    channel = (env.get("ANALYTICS_CHANNEL") or "").strip().lstrip("@")
+    config["analytics_channel"] = None if channel in ("", "-") else channel
+    config["webhook_secret"] = env.get("WEBHOOK_SECRET") or None
+
     try:
-        ADMIN_ID = int(admin_id_str)
-    except ValueError:
-        raise RuntimeError("ADMIN_ID debe ser un número entero válido.")
+        config["post_windows"] = parse_post_windows(env.get("POST_WINDOWS") or "")
+    except ValueError as exc:
+        errors.append(f"POST_WINDOWS: {exc} (formato HH:MM-HH:MM, separadas por comas).")
+
+    if errors:
+        raise RuntimeError("Configuración inválida:\n- " + "\n- ".join(errors))
+    return config
+
+
+def apply_config(config: Dict[str, Any]) -> None:
+    global ADMIN_ID, TARGET_CHAT_ID, STATE_DB_PATH
+    global STATE_IDLE_TTL_SECONDS, STATE_MAX_ACTIVE_USERS
+    global DRAIN_TIMEOUT_SECONDS, RESTART_WINDOW_SECONDS, ANALYTICS_CHANNEL
+    global POST_SPACING_SECONDS, POST_WINDOWS
+    global LOG_LEVEL, LOG_FORMAT, LOG_DEBUG_SAMPLE
+    ADMIN_ID = config["admin_id"]
+    TARGET_CHAT_ID = config["target_chat_id"]
+    STATE_DB_PATH = config["state_db_path"]
+    STATE_IDLE_TTL_SECONDS = config["idle_ttl"]
+    STATE_MAX_ACTIVE_USERS = config["max_active_users"]
+    DRAIN_TIMEOUT_SECONDS = config["drain_timeout"]
+    RESTART_WINDOW_SECONDS = config["restart_window"]
+    ANALYTICS_CHANNEL = config["analytics_channel"]
+    POST_SPACING_SECONDS = config["post_spacing_minutes"] * 60
+    POST_WINDOWS = config["post_windows"]
+    LOG_LEVEL = config["log_level"]
+    LOG_FORMAT = config["log_format"]
+    LOG_DEBUG_SAMPLE = config["log_debug_sample"]
+    invalidate_slots()
 
-    TARGET_CHAT_ID = target_chat
 
-    application = ApplicationBuilder().token(token).build()
+# --------- Main ---------
+def build_application(token: str, request: Optional[BaseRequest] = None) -> Application:
+    """
+    Construye la aplicación con todos los manejadores. `request` permite
+    sustituir la capa HTTP (lo usa bench_post_bot.py con una Bot API falsa).
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .post_init(on_application_start)
+        .post_stop(on_application_stop)
+    )
+    # Las llamadas de los manejadores pasan por LoggedRequest; getUpdates no
+    if request is None:
+        builder = builder.request(LoggedRequest(HTTPXRequest(connection_pool_size=256)))
+    else:
+        builder = builder.request(LoggedRequest(request)).get_updates_request(request)
+    application = builder.build()
 
+    application.add_handler(TypeHandler(Update, tag_update), group=-3)
+    application.add_handler(TypeHandler(Update, record_first_update), group=-2)
+    application.add_handler(TypeHandler(Update, reject_while_draining), group=-1)
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("exportar", export_command))
+    application.add_handler(CommandHandler("importar", import_command))
+    application.add_handler(CommandHandler("memoria", memory_command))
+    application.add_handler(CommandHandler("historial", history_command))
+    application.add_handler(CommandHandler(["variable", "variables"], variable_command))
+    application.add_handler(CommandHandler("formato", format_command))
+    application.add_handler(CommandHandler("copia", copy_mode_command))
+    application.add_handler(CommandHandler("estadisticas", stats_command))
     application.add_handler(CallbackQueryHandler(on_button))
     application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, on_message))
     application.add_error_handler(error_handler)
 
-    application.run_polling()
+    application.job_queue.run_repeating(
+        maintain_user_state,
+        interval=STATE_MAINTENANCE_INTERVAL_SECONDS,
+        first=STATE_MAINTENANCE_INTERVAL_SECONDS,
+        name="state_maintenance",
+    )
+    application.job_queue.run_repeating(
+        collect_post_stats,
+        interval=ANALYTICS_TICK_SECONDS,
+        first=ANALYTICS_TICK_SECONDS,
+        name="post_stats",
+    )
+    return application
+
+
+def main() -> None:
+    _STARTUP["started"] = time.perf_counter()
+
+    config = validate_config(os.environ)
+    apply_config(config)
+    setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_DEBUG_SAMPLE)
+    _STARTUP["config"] = _startup_elapsed()
+
+    application = build_application(config["token"])
+    _STARTUP["built"] = _startup_elapsed()
+
+    # Las señales las gestiona on_application_start para poder drenar antes de parar
+    try:
+        if config["webhook_url"]:
+            # El servidor del webhook (tornado) solo se importa en este modo
+            application.run_webhook(
+                listen="0.0.0.0",
+                port=config["port"],
+                url_path="telegram",
+                webhook_url=config["webhook_url"].rstrip("/") + "/telegram",
+                secret_token=config["webhook_secret"],
+                stop_signals=None,
+            )
+        else:
+            application.run_polling(stop_signals=None)
+    finally:
+        stop_logging()
 
 
 if __name__ == "__main__":